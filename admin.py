@@ -30,7 +30,9 @@ class PylimsAdmin(VersionAdmin):
                     instance.user = request.user
                 instance.save()
         else:
-            formset.save()
+            # tags update the modified time of the parent object once
+            with models.coalesce_parent_updates():
+                formset.save()
 
 
 # setup inline admins
@@ -98,8 +100,15 @@ class ParameterAdmin(PylimsAdmin):
     change_form_template = "admin/pylims/parameter/change_form.html"
 
 
+class DataImportJobInline(admin.TabularInline):
+    model = models.DataImportJob
+    fields = ('action', 'status', 'objects_processed', 'message', 'created', 'started', 'finished')
+    readonly_fields = fields
+    extra = 0
+
+
 class DataImportAdmin(PylimsAdmin):
-    inlines = [DataImportTagInline, ]
+    inlines = [DataImportTagInline, DataImportJobInline]
     change_form_template = "admin/pylims/dataimport/change_form.html"
 
 # register models with the admin site
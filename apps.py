@@ -3,3 +3,25 @@ from django.apps import AppConfig
 
 class PylimsConfig(AppConfig):
     name = 'pylims'
+
+    def ready(self):
+        # model classes may have changed if the app registry was reloaded
+        from .data_view_funcs import clear_field_cache
+        clear_field_cache()
+
+        # cached sample counts are invalidated when samples, tags or measurements change
+        from django.db.models.signals import pre_save, post_save, post_delete
+        from .models import Sample, SampleTag, Measurement, invalidate_sample_counts
+        for model_class in (Sample, SampleTag, Measurement):
+            uid = "pylims_sample_count_%s" % model_class.__name__
+            post_save.connect(invalidate_sample_counts, sender=model_class, dispatch_uid=uid)
+            post_delete.connect(invalidate_sample_counts, sender=model_class, dispatch_uid=uid)
+
+        # measurement summaries are updated when measurements (or their samples) change
+        from . import models
+        pre_save.connect(models.measurement_pre_save, sender=Measurement, dispatch_uid="pylims_summary_measurement")
+        post_save.connect(models.measurement_post_save, sender=Measurement, dispatch_uid="pylims_summary_measurement")
+        post_delete.connect(models.measurement_post_delete, sender=Measurement,
+                            dispatch_uid="pylims_summary_measurement")
+        pre_save.connect(models.sample_pre_save, sender=Sample, dispatch_uid="pylims_summary_sample")
+        post_save.connect(models.sample_post_save, sender=Sample, dispatch_uid="pylims_summary_sample")
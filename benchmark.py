@@ -0,0 +1,187 @@
+import io
+import csv
+import json
+import time
+import random
+import datetime
+import tracemalloc
+
+import django
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from . import data_import
+from .models import DataImport, Location, Project, Parameter, Sample, SampleTag, Measurement, \
+    ProjectTag, LocationTag, ParameterTag, bulk_save
+
+
+# model.field columns that can be generated, in the order they are added
+FK_COLUMNS = ("location.slug", "project.slug")
+
+
+def synthetic_csv(rows=1000, tag_columns=5, fk_columns=1, measurement_columns=0, n_fk_values=10, seed=1):
+    """
+    Generate a CSV for benchmarking imports
+    :param rows: The number of samples
+    :param tag_columns: The number of columns that are imported as SampleTags
+    :param fk_columns: The number of model.field columns (at most len(FK_COLUMNS))
+    :param measurement_columns: The number of parameter columns (see wide_csv_import)
+    :param n_fk_values: The number of distinct values in each model.field column
+    :param seed: The random seed
+    :return: A tuple of the CSV text and a dict with lists of the location, project,
+    and parameter slugs that have to exist for the import to succeed
+    """
+    if fk_columns > len(FK_COLUMNS):
+        raise ValueError("At most %s foreign key columns can be generated" % len(FK_COLUMNS))
+
+    rand = random.Random(seed)
+    fk_columns = FK_COLUMNS[:fk_columns]
+    required = {
+        "location": ["bench-location-%d" % i for i in range(n_fk_values)] if "location.slug" in fk_columns else [],
+        "project": ["bench-project-%d" % i for i in range(n_fk_values)] if "project.slug" in fk_columns else [],
+        "parameter": ["bench-param-%d" % i for i in range(measurement_columns)]
+    }
+
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(["name", "collected"] + list(fk_columns) +
+                    ["tag%d" % i for i in range(tag_columns)] + required["parameter"])
+
+    start = datetime.datetime(2017, 1, 1)
+    for i in range(rows):
+        row = ["Sample %d" % i, str(start + datetime.timedelta(minutes=i))]
+        row += [rand.choice(required[column.split(".")[0]]) for column in fk_columns]
+        row += ["value %d" % rand.randint(0, 100) for _ in range(tag_columns)]
+        row += ["%.4f" % rand.uniform(0, 100) for _ in range(measurement_columns)]
+        writer.writerow(row)
+
+    return out.getvalue(), required
+
+
+class QueryCounter(object):
+    """
+    Counts queries run on the default connection (without the 9000 query limit of
+    CaptureQueriesContext when Connection.execute_wrapper() is available)
+    """
+
+    def __init__(self):
+        self.count = 0
+        self._context = None
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+    def __enter__(self):
+        if hasattr(connection, "execute_wrapper"):
+            self._context = connection.execute_wrapper(self)
+        else:
+            self._context = CaptureQueriesContext(connection)
+        self._context.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._context.__exit__(exc_type, exc_value, traceback)
+        if isinstance(self._context, CaptureQueriesContext):
+            self.count = len(self._context)
+
+
+def _timed(fun, n_rows, reset=None):
+    # tracing allocations slows them down, so peak memory is measured in a separate
+    # run that is rolled back (reset() restores anything the run changed in memory)
+    with transaction.atomic():
+        tracemalloc.start()
+        try:
+            fun()
+            peak_memory = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+            transaction.set_rollback(True)
+    if reset is not None:
+        reset()
+
+    with QueryCounter() as queries:
+        start = time.perf_counter()
+        fun()
+        seconds = time.perf_counter() - start
+
+    return {
+        "seconds": seconds,
+        "rows_per_second": n_rows / seconds if seconds > 0 else None,
+        "queries": queries.count,
+        "peak_memory_bytes": peak_memory
+    }
+
+
+def _create_required(required):
+    # bulk_save() also adds the objects to the closure tables
+    bulk_save([Location(name=slug, slug=slug) for slug in required["location"]] +
+              [Project(name=slug, slug=slug) for slug in required["project"]] +
+              [Parameter(name=slug, slug=slug) for slug in required["parameter"]])
+
+
+def run_benchmark(rows=1000, tag_columns=5, fk_columns=1, measurement_columns=0, n_fk_values=10,
+                  bulk=None, import_args=None, user=None, keep=False):
+    """
+    Time the stages of a synthetic import: the importer (csv_import or wide_csv_import),
+    DataImport.run_import(), DataImport.preview() and DataImport.apply_import(save=True).
+    bulk is passed to apply_import() (None uses the importer's default). Everything is
+    rolled back afterward unless keep=True.
+    :return: A dict that can be serialized as JSON
+    """
+    text, required = synthetic_csv(rows, tag_columns, fk_columns, measurement_columns, n_fk_values)
+    driver = "wide_csv_import" if measurement_columns else "csv_import"
+    import_args = dict(import_args or {})
+    models = {model.__name__: model for model in (Project, ProjectTag, Location, LocationTag, Sample,
+                                                  SampleTag, Parameter, ParameterTag, Measurement)}
+
+    results = {}
+    with transaction.atomic():
+        _create_required(required)
+        obj = DataImport(text=text, driver=driver, args=json.dumps(import_args), user=user)
+        obj.save()
+
+        import_fun = data_import.resolve_function(driver)
+
+        def importer():
+            for item in import_fun(text, models=models, **import_args):
+                pass
+
+        def run_import():
+            for chunk in obj.iter_import():
+                pass
+
+        n_preview = 100
+
+        def preview():
+            obj.clear_preview_cache()
+            obj.preview(n_preview)
+
+        results[driver] = _timed(importer, rows)
+        results["run_import"] = _timed(run_import, rows)
+        results["preview"] = _timed(preview, min(rows, n_preview))
+        results["apply_import"] = _timed(lambda: obj.apply_import(save=True, bulk=bulk), rows,
+                                         reset=obj.refresh_from_db)
+
+        if not keep:
+            obj.clear_preview_cache()
+            transaction.set_rollback(True)
+
+    return {
+        "config": {
+            "rows": rows,
+            "tag_columns": tag_columns,
+            "fk_columns": fk_columns,
+            "measurement_columns": measurement_columns,
+            "n_fk_values": n_fk_values,
+            "bulk": bulk,
+            "driver": driver,
+            "import_args": import_args
+        },
+        "environment": {
+            "django": django.get_version(),
+            "database": connection.vendor
+        },
+        "created": datetime.datetime.now().isoformat(),
+        "results": results
+    }
@@ -1,7 +1,18 @@
 
+import re
 import csv
+import datetime
+import codecs
+import itertools
+import multiprocessing
 
-from django.forms.models import fields_for_model
+import django
+from django.apps import apps
+from django.db.models import Q
+from django.conf import settings
+from django.utils import timezone
+
+from .data_view_funcs import list_fields
 
 
 # keep a dictionary of importers that can be registered
@@ -25,15 +36,23 @@ def register_importer(import_function, name=None, app=None):
     _IMPORTERS[app][name] = import_function
 
 
-# decorator to register an import function
+# decorator to register an import function. Import functions registered with
+# streaming=True are passed the stored text of a DataImport as a models.CompressedText
+# (which can be read using text_lines()) instead of a str, so that it is decompressed
+# as it is read. The output of import functions registered with bulk=True is saved
+# using multi-row inserts unless DataImport.save_import() is called with bulk=False
 class pylims_importer(object):
-    def __init__(self, app=None, name=None):
+    def __init__(self, app=None, name=None, streaming=False, bulk=False):
         self.name = name
         self.app = app
+        self.streaming = streaming
+        self.bulk = bulk
 
     def __call__(self, f):
         if self.name is None:
             self.name = f.__name__
+        f.pylims_streaming = self.streaming
+        f.pylims_bulk = self.bulk
         register_importer(f, self.name, self.app)
         return f
 
@@ -57,31 +76,255 @@ def resolve_function(importer_name):
     return None
 
 
-def list_fields(model):
-    """
-    Lists fields and field classes from a model.
-    :param model: A django model
-    :return: A dict with a name: class mapping
-    """
-    return {name: field for name, field in fields_for_model(model).items()}
-
-
-def _resolve_object(model, field, value, models):
+def _model_class(model, models):
     # turn model into a model class name
     model_class_name = model.replace('_', ' ').title().replace(' ', '')
     if model_class_name not in models:
         raise ValueError("Model class for %s was not provided to the import function" % model_class_name)
-    model_class = models[model_class_name]
+    return models[model_class_name]
+
+
+def _resolve_object(model, field, value, models, resolver=None):
+    if resolver is not None:
+        return resolver.resolve(model, field, value)
+    model_class = _model_class(model, models)
     query_args = {field: value}
     return model_class.objects.get(**query_args)
 
 
-def _row_as_model(row_model_obj, row_model_tag_obj, row, models, **kwargs):
+class ObjectResolver(object):
+    """
+    Resolves model.field=value lookups (e.g. location.name=Site A) for one
+    import run. Lookups are collected using add(), fetched using one
+    field__in query per model and field using prefetch(), and answered
+    from memory by resolve(). Values that were not prefetched, could not be
+    found, or match more than one object are passed to objects.get() so that
+    the same errors are raised.
+    """
+
+    # maximum number of values in one field__in query
+    chunk_size = 500
+
+    def __init__(self, models):
+        self.models = models
+        self._pending = {}
+        self._objects = {}
+
+    @staticmethod
+    def _lookup_field(model_class, field):
+        # only plain field lookups can be matched in memory
+        if field == "pk":
+            return model_class._meta.pk
+        if "__" in field:
+            return None
+        try:
+            model_field = model_class._meta.get_field(field)
+        except Exception:
+            return None
+        return model_field if model_field.concrete else None
+
+    def add(self, model, field, value):
+        try:
+            model_class = _model_class(model, self.models)
+        except ValueError:
+            # the error is raised when the row is turned into a model
+            return
+        key = (model_class, field)
+        if key not in self._objects or value not in self._objects[key]:
+            self._pending.setdefault(key, set()).add(value)
+
+    def prefetch(self):
+        for (model_class, field), values in self._pending.items():
+            found = self._objects.setdefault((model_class, field), {})
+            model_field = self._lookup_field(model_class, field)
+            if model_field is None:
+                continue
+
+            # map normalized values to the value(s) as they appear in the table
+            wanted = {}
+            for value in values:
+                try:
+                    wanted.setdefault(model_field.to_python(value), []).append(value)
+                except Exception:
+                    # invalid values are left for objects.get() to raise an error
+                    pass
+
+            matches = {}
+            values_list = list(wanted)
+            for start in range(0, len(values_list), self.chunk_size):
+                query_args = {field + "__in": values_list[start:start + self.chunk_size]}
+                for obj in model_class.objects.filter(**query_args):
+                    matches.setdefault(getattr(obj, model_field.attname), []).append(obj)
+
+            for normalized, objects in matches.items():
+                # ambiguous values are left for objects.get() to raise an error
+                if len(objects) == 1 and normalized in wanted:
+                    for value in wanted[normalized]:
+                        found[value] = objects[0]
+
+        self._pending = {}
+
+    def resolve(self, model, field, value):
+        model_class = _model_class(model, self.models)
+        found = self._objects.setdefault((model_class, field), {})
+        if value not in found:
+            found[value] = model_class.objects.get(**{field: value})
+        return found[value]
+
+
+def _copy_unimported_fields(obj, existing):
+    # fields that cannot be imported (e.g., slug, created) are kept from the existing object
+    for field in obj._meta.concrete_fields:
+        if not field.editable and not field.primary_key and \
+                field.name not in ("user", "data_import", "modified"):
+            setattr(obj, field.attname, getattr(existing, field.attname))
+
+
+def _comparable(value):
+    # cleaned datetimes are naive, but those from the database are aware if USE_TZ is set
+    if isinstance(value, datetime.datetime):
+        if settings.USE_TZ and timezone.is_naive(value):
+            return timezone.make_aware(value)
+        elif not settings.USE_TZ and timezone.is_aware(value):
+            return timezone.make_naive(value)
+    return value
+
+
+def _same(obj, existing, attname):
+    return _comparable(getattr(obj, attname)) == _comparable(getattr(existing, attname))
+
+
+def _match_existing(obj, existing, compare):
+    """
+    Turn obj into an update of existing, marking it as unchanged if none of
+    the fields in compare are different. The previous values of fields that
+    will change are kept in obj._pylims_previous so that the update can be reverted.
+    """
+    obj.pk = existing.pk
+    obj._state.adding = False
+    obj._state.db = existing._state.db
+    _copy_unimported_fields(obj, existing)
+    if all(_same(obj, existing, name) for name in compare):
+        obj._pylims_unchanged = True
+    else:
+        obj._pylims_previous = {field.attname: getattr(existing, field.attname)
+                                for field in obj._meta.concrete_fields
+                                if not field.primary_key and not _same(obj, existing, field.attname)}
+
+
+class NaturalKeyMatcher(object):
+    """
+    Matches imported objects to existing objects using a natural key declared
+    by the user (e.g. name, location and collected), so that importing corrected
+    data updates existing objects instead of creating duplicates. Matched objects
+    get the primary key of the existing object, and their tags (matched by key) and
+    measurements (matched by parameter, with replicates matched in order) are matched
+    in the same way. Objects that would not change are marked with
+    _pylims_unchanged = True. Existing objects are fetched using a few field__in
+    queries per chunk.
+    """
+
+    # maximum number of keys in one query
+    batch_size = 250
+
+    def __init__(self, models, row_model, match_on):
+        if isinstance(match_on, str) or not match_on:
+            raise ValueError("match_on must be a list of field names")
+        self.model_class = models[row_model]
+        self.tag_class = models.get(row_model + "Tag")
+        self.measurement_class = models.get("Measurement") if row_model == "Sample" else None
+        self.key_fields = [self.model_class._meta.get_field(name) for name in match_on]
+        self.compare = [field.attname for field in self.model_class._meta.concrete_fields
+                        if field.editable and not field.primary_key]
+        # IDs of matched objects, whose tags and measurements may be in a later chunk
+        self._matched = set()
+
+    def key(self, obj):
+        return tuple(_comparable(getattr(obj, field.attname)) for field in self.key_fields)
+
+    def _fetch(self, keys):
+        # objects matching each field of any key, which are then matched by the whole key
+        existing = {}
+        for start in range(0, len(keys), self.batch_size):
+            batch = keys[start:start + self.batch_size]
+            queryset = self.model_class.objects.all()
+            for i, field in enumerate(self.key_fields):
+                values = {key[i] for key in batch}
+                condition = Q(**{field.attname + "__in": [value for value in values if value is not None]})
+                if None in values:
+                    condition |= Q(**{field.attname + "__isnull": True})
+                queryset = queryset.filter(condition)
+            for obj in queryset:
+                existing.setdefault(self.key(obj), []).append(obj)
+        return existing
+
+    def match(self, chunk):
+        """
+        Match the objects in chunk (a list of unsaved objects) to existing objects
+        """
+        incoming = {}
+        for obj in chunk:
+            if type(obj) is self.model_class:
+                key = self.key(obj)
+                if key in incoming:
+                    raise ValueError("More than one %s has the key %s" % (self.model_class.__name__, key))
+                incoming[key] = obj
+
+        existing = self._fetch(list(incoming)) if incoming else {}
+        for key, obj in incoming.items():
+            found = existing.get(key, [])
+            if len(found) > 1:
+                raise ValueError("The key %s matches %s existing %s objects" %
+                                 (key, len(found), self.model_class.__name__))
+            elif found:
+                _match_existing(obj, found[0], self.compare)
+                self._matched.add(obj.pk)
+
+        if self._matched and self.tag_class is not None:
+            self._match_related(chunk, self.tag_class, "parent", "key", ["value"])
+        if self._matched and self.measurement_class is not None:
+            self._match_related(chunk, self.measurement_class, "sample", "param_id", ["value", "tags"])
+
+    def _match_related(self, chunk, related_class, parent_field, match_attr, compare):
+        related = [obj for obj in chunk if type(obj) is related_class and
+                   getattr(getattr(obj, parent_field), "pk", None) in self._matched]
+        if not related:
+            return
+
+        # existing related objects by parent ID and match_attr (lowest ID first)
+        existing = {}
+        parent_ids = list({getattr(obj, parent_field).pk for obj in related})
+        for start in range(0, len(parent_ids), self.batch_size):
+            query_args = {parent_field + "_id__in": parent_ids[start:start + self.batch_size]}
+            for obj in related_class.objects.filter(**query_args).order_by("pk"):
+                existing.setdefault((getattr(obj, parent_field + "_id"), getattr(obj, match_attr)), []).append(obj)
+
+        # a parent can have several objects with the same match_attr (e.g., replicate
+        # measurements): identical objects are matched first, then the rest in order
+        unmatched = []
+        for obj in related:
+            candidates = existing.get((getattr(obj, parent_field).pk, getattr(obj, match_attr)), [])
+            same = [found for found in candidates if all(_same(obj, found, name) for name in compare)]
+            if same:
+                candidates.remove(same[0])
+                _match_existing(obj, same[0], compare)
+            else:
+                unmatched.append(obj)
+        for obj in unmatched:
+            candidates = existing.get((getattr(obj, parent_field).pk, getattr(obj, match_attr)), [])
+            if candidates:
+                _match_existing(obj, candidates.pop(0), compare)
+
+
+def _row_as_model(row_model_obj, row_model_tag_obj, row, models, resolver=None, fields=None,
+                  lookups=None, **kwargs):
     """
     This function turns a dictionary like {'name'='my sample name'}
-    into a Sample(name='my sample id')
+    into a Sample(name='my sample id'). If lookups is a list, model.field=value
+    lookups are appended to it as (model, field, value) instead of being resolved.
     """
-    fields = list_fields(row_model_obj)
+    if fields is None:
+        fields = list_fields(row_model_obj)
     obj = row_model_obj()
     tags = []
     for key, value in row.items():
@@ -92,7 +335,10 @@ def _row_as_model(row_model_obj, row_model_tag_obj, row, models, **kwargs):
             # if value is blank, don't try to resolve it
             if not value:
                 continue
-            target_object = _resolve_object(model_slug, lookup_field, value, models)
+            if lookups is not None:
+                lookups.append((model_slug, lookup_field, value))
+                continue
+            target_object = _resolve_object(model_slug, lookup_field, value, models, resolver)
             setattr(obj, model_slug, target_object)
 
         else:
@@ -105,40 +351,325 @@ def _row_as_model(row_model_obj, row_model_tag_obj, row, models, **kwargs):
     return [obj, ] + tags
 
 
-def _table_import(header, row_generator, models, row_model, **kwargs):
+def _iter_chunks(iterable, chunk_size):
+    # yield lists of up to chunk_size items from iterable
+    iterator = iter(iterable)
+    chunk = list(itertools.islice(iterator, chunk_size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(iterator, chunk_size))
+
+
+_LINE_END = re.compile(r"\r\n|\r|\n")
+
+
+def _iter_lines(chunks):
+    # split an iterable of text chunks into lines at \n, \r or \r\n (like a file opened
+    # with newline=""), keeping line endings
+    remainder = ""
+    for chunk in chunks:
+        text = remainder + chunk
+        start = 0
+        for match in _LINE_END.finditer(text):
+            # a \r at the end of a chunk may be followed by \n in the next one
+            if match.end() == len(text) and match.group() == "\r":
+                break
+            yield text[start:match.end()]
+            start = match.end()
+        remainder = text[start:]
+    if remainder:
+        yield remainder
+
+
+def text_lines(source, encoding="utf-8", chunk_size=64 * 1024):
+    """
+    Iterate over the lines of source without reading it into memory all at once.
+    :param source: A str, a file-like object with a read() method, or an object with
+    a chunks() method (e.g., an uploaded file or models.CompressedText). Binary files
+    are decoded using encoding.
+    :param encoding: The encoding of binary files
+    :param chunk_size: The number of bytes or characters to read at a time
+    :return: An iterator of lines
+    """
+    if isinstance(source, str):
+        # slices of the str are read so that it is not copied all at once
+        chunks = (source[start:start + chunk_size] for start in range(0, len(source), chunk_size))
+    elif hasattr(source, "chunks") and callable(source.chunks):
+        chunks = source.chunks(chunk_size)
+    elif hasattr(source, "read") and callable(source.read):
+        chunks = iter(lambda: source.read(chunk_size), source.read(0))
+    else:
+        raise TypeError("%s is not a str or file-like object" % type(source).__name__)
+
+    decoder = codecs.getincrementaldecoder(encoding)()
+
+    def decoded():
+        for chunk in chunks:
+            yield decoder.decode(chunk) if isinstance(chunk, bytes) else chunk
+        yield decoder.decode(b"", final=True)
+
+    return _iter_lines(decoded())
+
+
+def _init_shard_worker():
+    # worker processes that were not forked need to set up django
+    if not apps.ready:
+        django.setup()
+
+
+def _build_shard(shard):
+    """
+    Turns rows into validated model objects without using the database (in a worker
+    process). Foreign key lookups are returned to be resolved by the parent process.
+    :param shard: A tuple of (header, numbered_rows, models, row_model, kwargs), where
+    numbered_rows is a list of (row_number, row)
+    :return: A list of (row_number, objects, lookups, error) tuples
+    """
+    header, numbered_rows, models, row_model, kwargs = shard
+    row_model_obj = models[row_model]
+    row_model_tag_obj = models[row_model + "Tag"]
+    fields = list_fields(row_model_obj)
+
+    out = []
+    for row_number, row in numbered_rows:
+        row_dict = {key: value for key, value in zip(header, row)}
+        lookups = []
+        try:
+            objects = _row_as_model(row_model_obj, row_model_tag_obj, row_dict, models,
+                                    fields=fields, lookups=lookups, **kwargs)
+            for obj in objects:
+                _clean_fields(obj)
+            out.append((row_number, objects, lookups, None))
+        except Exception as e:
+            out.append((row_number, None, None, "%s: %s" % (type(e).__name__, e)))
+    return out
+
+
+def _clean_fields(obj):
+    # relations and uniqueness need the database, and are checked separately
+    relations = [field.name for field in obj._meta.fields if field.is_relation]
+    obj.full_clean(exclude=relations, validate_unique=False)
+
+
+# whether each model class has unique fields that can be imported
+_CHECK_UNIQUE = {}
+
+
+def _validate_unique(obj):
+    """
+    Finish validating an object that was validated using _clean_fields() and whose
+    relations were resolved from the database, and mark it as cleaned
+    """
+    model_class = type(obj)
+    if model_class not in _CHECK_UNIQUE:
+        _CHECK_UNIQUE[model_class] = any(field.unique and field.editable and not field.primary_key
+                                         for field in model_class._meta.fields)
+    if _CHECK_UNIQUE[model_class]:
+        obj.validate_unique()
+    obj._pylims_cleaned = True
+
+
+def _resolve_rows(resolver, rows):
+    """
+    Resolve the foreign key lookups of a chunk of rows using one prefetch per model
+    and field, set them on the row object (the first object of each row) and check
+    unique fields
+    :param resolver: An ObjectResolver
+    :param rows: A list of (row number, objects, lookups) tuples, where lookups is a
+    list of (model, field, value) tuples
+    :return: A generator of the objects of each row
+    """
+    for row_number, objects, lookups in rows:
+        for model_slug, lookup_field, value in lookups:
+            resolver.add(model_slug, lookup_field, value)
+    resolver.prefetch()
+
+    for row_number, objects, lookups in rows:
+        try:
+            for model_slug, lookup_field, value in lookups:
+                setattr(objects[0], model_slug, resolver.resolve(model_slug, lookup_field, value))
+            for obj in objects:
+                _validate_unique(obj)
+        except Exception as e:
+            raise ValueError("Row %s: %s: %s" % (row_number, type(e).__name__, e))
+        for obj in objects:
+            yield obj
+
+
+def _table_import_parallel(header, row_generator, models, row_model, chunk_size=1000,
+                           processes=2, **kwargs):
+    """
+    Like _table_import(), but rows in each chunk are split into shards that are turned
+    into validated objects in a process pool. Foreign key lookups are then resolved
+    and unique fields are checked in this process. Objects are marked as cleaned so that
+    DataImport.iter_import() does not validate them again.
+    """
+    resolver = ObjectResolver(models)
+
+    pool = multiprocessing.Pool(processes, initializer=_init_shard_worker)
+    try:
+        # the header is row 1
+        numbered_rows = ((i + 2, row) for i, row in enumerate(row_generator()) if row)
+        for chunk in _iter_chunks(numbered_rows, chunk_size):
+            shard_size = max(len(chunk) // processes, 1)
+            shards = [(header, chunk[start:start + shard_size], models, row_model, kwargs)
+                      for start in range(0, len(chunk), shard_size)]
+            results = [row for shard in pool.map(_build_shard, shards) for row in shard]
+
+            errors = ["Row %s: %s" % (row_number, error) for row_number, _, _, error in results if error]
+            if errors:
+                raise ValueError("; ".join(errors))
+
+            rows = [(row_number, objects, lookups) for row_number, objects, lookups, _ in results]
+            for obj in _resolve_rows(resolver, rows):
+                yield obj
+    finally:
+        pool.terminate()
+
+
+def _table_import(header, row_generator, models, row_model, chunk_size=1000, processes=None, **kwargs):
+    """
+    Lazily turns rows into model objects, chunk_size rows at a time. If processes > 1,
+    objects are built and validated in a process pool (see _table_import_parallel()).
+    """
+    if processes is not None and int(processes) > 1:
+        return _table_import_parallel(header, row_generator, models, row_model,
+                                      chunk_size=chunk_size, processes=int(processes), **kwargs)
+    return _table_import_serial(header, row_generator, models, row_model, chunk_size=chunk_size, **kwargs)
+
+
+def _table_import_serial(header, row_generator, models, row_model, chunk_size=1000, **kwargs):
     row_model_obj = models[row_model]
     row_model_tag_obj = models[row_model + "Tag"]
+    fields = list_fields(row_model_obj)
+
+    # objects referred to by model.field columns are resolved using one
+    # query per column and chunk
+    resolver = ObjectResolver(models)
+    lookup_keys = [key for key in header if '.' in key]
+
+    for chunk in _iter_chunks(row_generator(), chunk_size):
+        # zip with headers to make dictionary for each row
+        rows = [{key: value for key, value in zip(header, row)} for row in chunk if row]
 
-    final_models = []
-    for row in row_generator():
-        if row:
-            # zip with headers to make dictionary for the row
-            row_dict = {key: value for key, value in zip(header, row)}
+        for row_dict in rows:
+            for key in lookup_keys:
+                if row_dict.get(key):
+                    model_slug, lookup_field = key.split('.', maxsplit=1)
+                    resolver.add(model_slug, lookup_field, row_dict[key])
+        resolver.prefetch()
 
+        for row_dict in rows:
             # get model from the row
             models_for_row = _row_as_model(row_model_obj, row_model_tag_obj,
-                                          row_dict, models, **kwargs)
+                                          row_dict, models, resolver=resolver, fields=fields, **kwargs)
             if models_for_row:
                 for obj in models_for_row:
-                    final_models.append(obj)
+                    yield obj
 
-    return final_models
 
-
-@pylims_importer()
-def csv_import(text, models, row_model="Sample", **kwargs):
+@pylims_importer(streaming=True)
+def csv_import(text, models, row_model="Sample", encoding="utf-8", **kwargs):
+    """
+    Import a CSV with one row per object. text can be a str or a (possibly uploaded)
+    file, and objects are generated lazily as the file is read.
+    """
 
     if not text:
         raise ValueError("Value 'text' is empty")
 
-    csv_reader = csv.reader(text.splitlines())
-    csv_iter = iter(csv_reader)
-    header = list(next(csv_reader))
+    csv_reader = csv.reader(text_lines(text, encoding=encoding))
+    header = next(csv_reader, None)
+    if header is None:
+        raise ValueError("Value 'text' is empty")
+    header = list(header)
 
     def row_generator():
-        line = next(csv_iter, None)
-        while line is not None:
+        for line in csv_reader:
             yield line
-            line = next(csv_iter, None)
 
     return _table_import(header, row_generator, models, row_model, **kwargs)
+
+
+@pylims_importer(streaming=True, bulk=True)
+def wide_csv_import(text, models, row_model="Sample", param_columns=None, batch_size=500,
+                    encoding="utf-8", **kwargs):
+    """
+    Import a CSV with one row per sample and one column per parameter. Columns whose
+    header is a Parameter slug (or the headers listed in param_columns) become
+    Measurements; other columns are imported as in csv_import(). Parameters are looked
+    up once per file, and objects are generated batch_size rows at a time, with the
+    Measurements of each batch generated column by column.
+    """
+
+    if not text:
+        raise ValueError("Value 'text' is empty")
+
+    csv_reader = csv.reader(text_lines(text, encoding=encoding))
+    header = next(csv_reader, None)
+    if header is None:
+        raise ValueError("Value 'text' is empty")
+    header = list(header)
+
+    # resolve parameter columns using one query
+    param_model = models["Parameter"]
+    if param_columns is None:
+        params = {param.slug: param for param in param_model.objects.filter(slug__in=header)}
+    else:
+        params = {param.slug: param for param in param_model.objects.filter(slug__in=param_columns)}
+        missing = [slug for slug in param_columns if slug not in params]
+        if missing:
+            raise ValueError("Parameter(s) not found: %s" % ", ".join(missing))
+        missing = [slug for slug in param_columns if slug not in header]
+        if missing:
+            raise ValueError("Parameter column(s) not found: %s" % ", ".join(missing))
+    param_indices = [(i, params[key]) for i, key in enumerate(header) if key in params]
+    row_indices = [i for i, key in enumerate(header) if key not in params]
+    row_header = [header[i] for i in row_indices]
+
+    return _wide_table_import(row_header, row_indices, param_indices, csv_reader, models, row_model,
+                              batch_size=batch_size, **kwargs)
+
+
+def _wide_table_import(row_header, row_indices, param_indices, csv_reader, models, row_model,
+                       batch_size=500, **kwargs):
+    row_model_obj = models[row_model]
+    row_model_tag_obj = models[row_model + "Tag"]
+    measurement_model = models["Measurement"]
+    fields = list_fields(row_model_obj)
+    resolver = ObjectResolver(models)
+
+    # the header is row 1
+    numbered_rows = ((i + 2, row) for i, row in enumerate(csv_reader) if row)
+    for chunk in _iter_chunks(numbered_rows, batch_size):
+        rows = []
+        row_objects = []
+        for row_number, row in chunk:
+            row_dict = {key: row[i] if i < len(row) else "" for key, i in zip(row_header, row_indices)}
+            row_lookups = []
+            try:
+                objects = _row_as_model(row_model_obj, row_model_tag_obj, row_dict, models,
+                                        fields=fields, lookups=row_lookups, **kwargs)
+                for obj in objects:
+                    _clean_fields(obj)
+            except Exception as e:
+                raise ValueError("Row %s: %s: %s" % (row_number, type(e).__name__, e))
+            rows.append((row_number, objects, row_lookups))
+            row_objects.append(objects)
+
+        for obj in _resolve_rows(resolver, rows):
+            yield obj
+
+        # measurements are generated column by column
+        for i, param in param_indices:
+            for (row_number, row), objects in zip(chunk, row_objects):
+                value = row[i] if i < len(row) else ""
+                if value == "":
+                    continue
+                measurement = measurement_model(param=param, sample=objects[0], value=value)
+                try:
+                    _clean_fields(measurement)
+                except Exception as e:
+                    raise ValueError("Row %s: %s: %s" % (row_number, type(e).__name__, e))
+                measurement._pylims_cleaned = True
+                yield measurement
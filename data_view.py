@@ -1,16 +1,25 @@
 
+import copy
+import itertools
+from collections import OrderedDict
+
 from django.db import models
 from django.forms import Form, formset_factory
-from .models import Parameter, Sample, SampleTag, Project, Location
+from .models import Parameter, Sample, SampleTag, Project, Location, Measurement, \
+    ProjectTag, LocationTag, ParameterTag, TagsField
 from .data_view_funcs import as_field, parse_column_spec, list_fields, DEFAULT_FIELD
 
 # create a dict so that models can be passed as strings to DataView()
 MODELS = {
     "Parameter": Parameter,
+    "ParameterTag": ParameterTag,
     "SampleTag": SampleTag,
     "Sample": Sample,
     "Project": Project,
-    "Location": Location
+    "ProjectTag": ProjectTag,
+    "Location": Location,
+    "LocationTag": LocationTag,
+    "Measurement": Measurement
 }
 
 
@@ -20,7 +29,7 @@ def as_model(obj):
     :param obj: An object
     :return: A model class
     """
-    if issubclass(obj, models.Model):
+    if isinstance(obj, type) and issubclass(obj, models.Model):
         return obj
     elif isinstance(obj, str) and (obj in MODELS):
         return MODELS[obj]
@@ -33,7 +42,8 @@ class DataViewForm(Form):
     def __init__(self, data_view, *args, **kwargs):
         super(DataViewForm, self).__init__(*args, **kwargs)
         for item in data_view.column_spec:
-            self.fields[item] = data_view.fields[item]
+            # fields are shared between forms, so each form gets its own copy
+            self.fields[item] = copy.deepcopy(data_view.fields[item])
 
 
 class DataView:
@@ -57,6 +67,9 @@ class DataView:
         self.column_spec = spec
         self.columns = [parse_column_spec(colspec) for colspec in spec]
 
+        # Parameter objects for param::attr columns (see SampleDataView)
+        self.params = {}
+
         # validate fields
         if fields is None:
             fields = {}
@@ -71,8 +84,93 @@ class DataView:
             else:
                 self.fields[item] = DEFAULT_FIELD
 
-    def data_iter(self):
-        pass
+    def access_plan(self):
+        """
+        Compile the column spec into a list of (column, kind, key) tuples describing
+        where the value of each column comes from:
+
+        ('field', attname): a field of the model (the ID for foreign keys)
+        ('tag', key): the value of a tag of the model
+        ('measurement', (param_id, attname)): a field of the parameter's measurement
+        ('measurement_tag', (param_id, key)): a key in the parameter's measurement tags
+        """
+        concrete_fields = {field.name: field for field in self.model._meta.concrete_fields}
+        measurement_fields = {field.name: field for field in Measurement._meta.concrete_fields}
+        plan = []
+        for item, (obj, attr) in zip(self.column_spec, self.columns):
+            if obj == "" and attr in concrete_fields:
+                plan.append((item, "field", concrete_fields[attr].attname))
+            elif obj == "":
+                if self.tag_model() is None:
+                    raise ValueError("%s does not have tags" % self.model.__name__)
+                plan.append((item, "tag", attr))
+            elif item in self.params and attr in measurement_fields:
+                plan.append((item, "measurement", (self.params[item].pk, measurement_fields[attr].attname)))
+            elif item in self.params:
+                plan.append((item, "measurement_tag", (self.params[item].pk, attr)))
+            else:
+                raise ValueError("Column `%s` does not refer to a parameter" % item)
+        return plan
+
+    def tag_model(self):
+        return MODELS.get(self.model.__name__ + "Tag")
+
+    def data_iter(self, queryset=None, chunk_size=500):
+        """
+        Generate one row per object as a dict with the column specs as keys. Objects
+        are fetched chunk_size at a time using QuerySet.iterator(), and the tags and
+        measurements the columns refer to are loaded with one query per chunk, so
+        there are no queries per row or cell. Columns that refer to a missing tag
+        or measurement are None; if an object has more than one measurement of a
+        parameter, the first one is used.
+        :param queryset: The objects to include (all objects of the model by default)
+        :param chunk_size: The number of objects per chunk
+        :return: A generator of dicts
+        """
+        plan = self.access_plan()
+        tag_keys = {key for item, kind, key in plan if kind == "tag"}
+        param_ids = {key[0] for item, kind, key in plan if kind in ("measurement", "measurement_tag")}
+
+        if queryset is None:
+            queryset = self.model.objects.all()
+        objects = queryset.iterator()
+        while True:
+            chunk = list(itertools.islice(objects, chunk_size))
+            if not chunk:
+                return
+            ids = [obj.pk for obj in chunk]
+
+            tags = {}
+            if tag_keys:
+                tag_values = self.tag_model().objects.filter(parent_id__in=ids, key__in=tag_keys)\
+                    .order_by("pk").values_list("parent_id", "key", "value")
+                for parent_id, key, value in tag_values:
+                    tags.setdefault((parent_id, key), value)
+
+            measurements = {}
+            if param_ids:
+                for measurement in Measurement.objects.filter(sample_id__in=ids, param_id__in=param_ids)\
+                        .order_by("pk"):
+                    if (measurement.sample_id, measurement.param_id) not in measurements:
+                        measurement.parsed_tags = TagsField.parse(measurement.tags, dict)
+                        measurements[measurement.sample_id, measurement.param_id] = measurement
+
+            for obj in chunk:
+                row = OrderedDict()
+                for item, kind, key in plan:
+                    if kind == "field":
+                        row[item] = getattr(obj, key)
+                    elif kind == "tag":
+                        row[item] = tags.get((obj.pk, key))
+                    else:
+                        measurement = measurements.get((obj.pk, key[0]))
+                        if measurement is None:
+                            row[item] = None
+                        elif kind == "measurement":
+                            row[item] = getattr(measurement, key[1])
+                        else:
+                            row[item] = measurement.parsed_tags.get(key[1])
+                yield row
 
     def as_form(self, *args, **kwargs):
         return DataViewForm(self, *args, **kwargs)
@@ -97,21 +195,20 @@ class SampleDataView(DataView):
     def __init__(self, spec, fields=None):
         super(SampleDataView, self).__init__(Sample, spec, fields)
 
-        # dealing with meta fields
-        meta_fields = list_fields(SampleMeta)
+        # dealing with measurement fields
+        measurement_fields = list_fields(Measurement)
 
         # need to reassign two-part specifications and check
-        # parameter names
-        self.params = {}
-        for item in self.column_spec:
-            obj, attr = parse_column_spec(item)
+        # parameter names (all parameters are looked up in one query)
+        slugs = {obj for obj, attr in self.columns if obj != ""}
+        params = {param.slug: param for param in Parameter.objects.filter(slug__in=slugs)} if slugs else {}
+        for item, (obj, attr) in zip(self.column_spec, self.columns):
             if obj != "":
-                param = Parameter.objects.filter(slug=obj)
-                if not param:
+                if obj not in params:
                     raise ValueError("Parameter `%s` was not found" % obj)
-                self.params[item] = param[0]
-            if obj != "" and attr in meta_fields:
-                self.fields[item] = meta_fields[attr]
+                self.params[item] = params[obj]
+            if obj != "" and attr in measurement_fields:
+                self.fields[item] = measurement_fields[attr]
 
 
 # class DataView(models.Model):
@@ -38,13 +38,27 @@ def as_field(obj):
         raise TypeError("%s could not be coerced to type Field" % obj)
 
 
+# form fields of each model, built once per model class by list_fields()
+_MODEL_FIELDS = {}
+
+
 def list_fields(model):
     """
-    Lists fields and field classes from a model.
+    Lists fields and field classes from a model. Fields are built once per model
+    and shared between callers, so copy a field before modifying it.
     :param model: A django model
     :return: A dict with a name: class mapping
     """
-    return {name: field for name, field in fields_for_model(model).items()}
+    if model not in _MODEL_FIELDS:
+        _MODEL_FIELDS[model] = fields_for_model(model)
+    return dict(_MODEL_FIELDS[model])
+
+
+def clear_field_cache():
+    """
+    Clears the fields cached by list_fields() (e.g., when the app registry is reloaded)
+    """
+    _MODEL_FIELDS.clear()
 
 
 def parse_column_spec(spec):
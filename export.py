@@ -0,0 +1,170 @@
+import csv
+import json
+import itertools
+from collections import OrderedDict
+
+from django.db.models import CharField, Value
+from django.http import StreamingHttpResponse
+from django.core.serializers.json import DjangoJSONEncoder
+
+from . import models
+from .query_string_filter import filter_samples
+
+EXPORT_FORMATS = OrderedDict([
+    ("csv", "text/csv"),
+    ("ndjson", "application/x-ndjson")
+])
+
+# sample columns in CSV exports, as model.field like the csv_import driver
+SAMPLE_COLUMNS = ("id", "slug", "name", "parent.slug", "user.username", "project.slug",
+                  "location.slug", "collected", "created", "modified")
+
+
+def iter_sample_chunks(queryset, chunk_size=500):
+    """
+    Iterate over samples chunk_size samples at a time using QuerySet.iterator(), so
+    that exports never have the whole table in memory. Tags and measurements are
+    loaded with one query per chunk and are set as export_tags and export_measurements
+    on each sample.
+    :param queryset: A queryset of samples
+    :param chunk_size: The number of samples per chunk
+    :return: A generator of lists of samples
+    """
+    samples = queryset.select_related("parent", "user", "project", "location").iterator()
+    while True:
+        chunk = list(itertools.islice(samples, chunk_size))
+        if not chunk:
+            return
+
+        by_id = OrderedDict()
+        for sample in chunk:
+            sample.export_tags = []
+            sample.export_measurements = []
+            by_id[sample.pk] = sample
+        for tag in models.SampleTag.objects.filter(parent_id__in=list(by_id)).order_by("pk"):
+            by_id[tag.parent_id].export_tags.append(tag)
+        measurements = models.Measurement.objects.filter(sample_id__in=list(by_id)).select_related("param")
+        for measurement in measurements.order_by("pk"):
+            by_id[measurement.sample_id].export_measurements.append(measurement)
+
+        yield chunk
+
+
+def _lookup(sample, column):
+    value = sample
+    for attr in column.split("."):
+        value = getattr(value, attr, None)
+        if value is None:
+            return None
+    return value
+
+
+def _csv_value(value):
+    if value is None:
+        return ""
+    elif hasattr(value, "isoformat"):
+        return value.isoformat()
+    return value
+
+
+class _Echo(object):
+    # csv.writer writes to this, so that each row can be yielded
+    def write(self, value):
+        return value
+
+
+def export_columns(queryset):
+    """
+    The tag keys and parameter slugs of the samples in queryset, found using
+    one query (a UNION of the distinct tag keys and parameter slugs)
+    :return: A tuple of the sorted tag keys and the sorted parameter slugs
+    """
+    sample_ids = queryset.order_by().values("pk")
+    # the column type is an annotation, so it is selected after the key in every Django version
+    tags = models.SampleTag.objects.filter(parent__in=sample_ids)\
+        .annotate(column_type=Value("tag", output_field=CharField())).values_list("key", "column_type")
+    params = models.Measurement.objects.filter(sample__in=sample_ids)\
+        .annotate(column_type=Value("param", output_field=CharField())).values_list("param__slug", "column_type")
+
+    columns = {"tag": [], "param": []}
+    for name, column_type in tags.union(params):
+        columns[column_type].append(name)
+    return sorted(columns["tag"]), sorted(columns["param"])
+
+
+def iter_csv(queryset, chunk_size=500, tag_keys=None, param_slugs=None):
+    """
+    Generate a CSV of the samples in queryset with one column for each tag key and
+    parameter. Samples with more than one measurement of a parameter have the values
+    separated by "; ". This is a report rather than an import file: the id, slug, user,
+    parent, created and modified columns can't be imported.
+
+    The header is written first, so unless tag_keys and param_slugs are given, all of
+    the tag keys and parameters of the samples are looked up (see export_columns())
+    before the first row is generated.
+    """
+    if tag_keys is None or param_slugs is None:
+        all_tag_keys, all_param_slugs = export_columns(queryset)
+        tag_keys = all_tag_keys if tag_keys is None else tag_keys
+        param_slugs = all_param_slugs if param_slugs is None else param_slugs
+
+    writer = csv.writer(_Echo())
+    yield writer.writerow(list(SAMPLE_COLUMNS) + tag_keys + param_slugs)
+    for chunk in iter_sample_chunks(queryset, chunk_size):
+        for sample in chunk:
+            tags = {tag.key: tag.value for tag in sample.export_tags}
+            measurements = OrderedDict()
+            for measurement in sample.export_measurements:
+                measurements.setdefault(measurement.param.slug, []).append(_csv_value(measurement.value))
+
+            row = [_csv_value(_lookup(sample, column)) for column in SAMPLE_COLUMNS]
+            row += [tags.get(key, "") for key in tag_keys]
+            row += ["; ".join(measurements.get(slug, [])) for slug in param_slugs]
+            yield writer.writerow(row)
+
+
+def iter_ndjson(queryset, chunk_size=500):
+    """
+    Generate one JSON object per line for each sample in queryset, with tags as
+    an object and measurements as a list
+    """
+    for chunk in iter_sample_chunks(queryset, chunk_size):
+        for sample in chunk:
+            sample_dict = OrderedDict((column, _lookup(sample, column)) for column in SAMPLE_COLUMNS)
+            sample_dict["tags"] = OrderedDict((tag.key, tag.value) for tag in sample.export_tags)
+            sample_dict["measurements"] = [
+                OrderedDict([("param", measurement.param.slug),
+                             ("value", measurement.value),
+                             ("tags", models.TagsField.parse(measurement.tags))])
+                for measurement in sample.export_measurements
+            ]
+            yield json.dumps(sample_dict, cls=DjangoJSONEncoder) + "\n"
+
+
+def sample_export_response(queryset, q, filename="samples"):
+    """
+    A streaming response exporting the samples in queryset, filtered using
+    the query parameters of filter_sample_table(). The format query parameter
+    can be 'csv' (default) or 'ndjson'. Samples are ordered by order_by if given
+    (otherwise by ID). The CSV columns can be given using export_tag and export_param
+    (tag keys and parameter slugs), which lets the first rows be sent without first
+    finding every tag key and parameter; NDJSON is always sent as it is generated.
+    :param queryset: A queryset of samples
+    :param q: A QueryDict of query parameters
+    :param filename: The name of the downloaded file (without extension)
+    :return: A StreamingHttpResponse
+    """
+    export_format = q.get("format", "csv")
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError("Export format must be one of %s" % ", ".join(EXPORT_FORMATS))
+
+    queryset = filter_samples(queryset, q).order_by(*q.getlist("order_by", ["pk"]))
+    if export_format == "csv":
+        rows = iter_csv(queryset, tag_keys=q.getlist("export_tag") or None,
+                        param_slugs=q.getlist("export_param") or None)
+    else:
+        rows = iter_ndjson(queryset)
+
+    response = StreamingHttpResponse(rows, content_type=EXPORT_FORMATS[export_format])
+    response["Content-Disposition"] = 'attachment; filename="%s.%s"' % (filename, export_format)
+    return response
@@ -0,0 +1,62 @@
+from django.db import transaction
+from django.core.management.base import BaseCommand
+
+from pylims.models import Measurement, rebuild_measurement_summaries
+
+
+def backfill_numeric_values(chunk_size=1000, recompute=False, progress=None):
+    """
+    Set Measurement.numeric_value and Measurement.non_numeric for measurements
+    saved before these fields existed (or written using QuerySet.update())
+    :param chunk_size: The number of measurements updated per transaction
+    :param recompute: Check every measurement instead of only those without a numeric value
+    :param progress: Called with the number of measurements checked after each chunk
+    :return: The number of measurements that were changed
+    """
+    measurements = Measurement.objects.all()
+    if not recompute:
+        measurements = measurements.filter(numeric_value__isnull=True, non_numeric=False)\
+            .exclude(value__isnull=True).exclude(value="")
+
+    n_checked = 0
+    n_changed = 0
+    last_pk = 0
+    while True:
+        # measurements are read in primary key order, which does not change as they are updated
+        chunk = list(measurements.filter(pk__gt=last_pk).order_by("pk")
+                     .values_list("pk", "value", "numeric_value", "non_numeric")[:chunk_size])
+        if not chunk:
+            return n_changed
+
+        with transaction.atomic():
+            for pk, value, numeric_value, non_numeric in chunk:
+                parsed = Measurement.parse_numeric(value)
+                if parsed != (numeric_value, non_numeric):
+                    Measurement.objects.filter(pk=pk).update(numeric_value=parsed[0], non_numeric=parsed[1])
+                    n_changed += 1
+
+        last_pk = chunk[-1][0]
+        n_checked += len(chunk)
+        if progress is not None:
+            progress(n_checked)
+
+
+class Command(BaseCommand):
+    help = "Sets the numeric value of measurements saved without one"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=1000,
+                            help="The number of measurements updated per transaction")
+        parser.add_argument("--all", action="store_true",
+                            help="Recompute the numeric value of every measurement")
+
+    def handle(self, *args, **options):
+        def progress(n_checked):
+            self.stdout.write("Checked %s measurements" % n_checked)
+
+        n_changed = backfill_numeric_values(options["chunk_size"], options["all"], progress)
+        self.stdout.write("Updated %s measurements" % n_changed)
+        # measurements were updated without signals, so summaries are recalculated
+        if n_changed:
+            rebuild_measurement_summaries()
+            self.stdout.write("Rebuilt measurement summaries")
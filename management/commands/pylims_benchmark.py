@@ -0,0 +1,42 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from pylims.benchmark import run_benchmark
+
+
+class Command(BaseCommand):
+    help = "Times importing a synthetic CSV and writes the results as JSON"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=1000)
+        parser.add_argument("--tag-columns", type=int, default=5)
+        parser.add_argument("--fk-columns", type=int, default=1)
+        parser.add_argument("--measurement-columns", type=int, default=0)
+        parser.add_argument("--fk-values", type=int, default=10,
+                            help="The number of distinct values in each foreign key column")
+        parser.add_argument("--bulk", action="store_true", default=None,
+                            help="Use bulk inserts to apply the import (the default for wide imports)")
+        parser.add_argument("--processes", type=int, default=None,
+                            help="The number of processes used to build and validate rows")
+        parser.add_argument("--keep", action="store_true",
+                            help="Keep the imported data instead of rolling it back")
+        parser.add_argument("--output", default=None, help="The JSON file to write (default: stdout)")
+
+    def handle(self, *args, **options):
+        import_args = {}
+        if options["processes"]:
+            import_args["processes"] = options["processes"]
+
+        result = run_benchmark(rows=options["rows"], tag_columns=options["tag_columns"],
+                               fk_columns=options["fk_columns"],
+                               measurement_columns=options["measurement_columns"],
+                               n_fk_values=options["fk_values"], bulk=options["bulk"],
+                               import_args=import_args, keep=options["keep"])
+
+        out = json.dumps(result, indent=4)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(out)
+        else:
+            self.stdout.write(out)
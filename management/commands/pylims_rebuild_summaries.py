@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from pylims.models import rebuild_measurement_summaries
+
+
+class Command(BaseCommand):
+    help = "Recalculates measurement summaries from all measurements"
+
+    def handle(self, *args, **options):
+        n_summaries = rebuild_measurement_summaries()
+        self.stdout.write("Rebuilt %s measurement summaries" % n_summaries)
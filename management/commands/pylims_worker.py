@@ -0,0 +1,74 @@
+import os
+import time
+import logging
+import socket
+import multiprocessing
+
+from django import db
+from django.core.management.base import BaseCommand
+
+from pylims.models import DataImportJob
+
+logger = logging.getLogger(__name__)
+
+
+def run_worker(name, poll_interval=2.0, once=False):
+    """
+    Run queued DataImportJobs until interrupted (or until the queue is empty if once=True)
+    :param name: A name identifying the worker
+    :param poll_interval: The number of seconds to wait between checks of an empty queue
+    :param once: Exit when there are no more queued jobs
+    """
+    while True:
+        # connections that were dropped (e.g., when the database restarted) are reopened
+        db.close_old_connections()
+        try:
+            job = DataImportJob.claim_next(name)
+            if job is not None:
+                job.run()
+        except Exception:
+            # the worker keeps running after database errors (e.g., lost connections or locks)
+            logger.exception("Worker %s could not claim or run a job", name)
+            job = None
+
+        if job is None:
+            if once:
+                return
+            time.sleep(poll_interval)
+
+
+class Command(BaseCommand):
+    help = "Runs queued data import jobs in one or more worker processes"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--processes", type=int, default=1,
+                            help="The number of worker processes to start")
+        parser.add_argument("--poll-interval", type=float, default=2.0,
+                            help="Seconds to wait between checks of an empty queue")
+        parser.add_argument("--once", action="store_true",
+                            help="Exit when there are no more queued jobs")
+
+    def handle(self, *args, **options):
+        n_processes = max(options["processes"], 1)
+        base_name = "%s:%s" % (socket.gethostname(), os.getpid())
+
+        if n_processes == 1:
+            run_worker(base_name, options["poll_interval"], options["once"])
+            return
+
+        # worker processes must not share the parent's database connection
+        db.connections.close_all()
+        processes = []
+        for i in range(n_processes):
+            process = multiprocessing.Process(target=run_worker,
+                                              args=("%s/%s" % (base_name, i),
+                                                    options["poll_interval"], options["once"]))
+            process.start()
+            processes.append(process)
+
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            for process in processes:
+                process.terminate()
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 00:47
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('pylims', '0002_auto_20171123_1413'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DataImportJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('action', models.CharField(choices=[('preview', 'Preview'), ('apply', 'Apply')], default='apply', max_length=55)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='queued', max_length=55)),
+                ('objects_processed', models.IntegerField(default=0)),
+                ('message', models.TextField(blank=True)),
+                ('worker', models.CharField(blank=True, max_length=255)),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='created')),
+                ('started', models.DateTimeField(blank=True, null=True, verbose_name='started')),
+                ('finished', models.DateTimeField(blank=True, null=True, verbose_name='finished')),
+                ('data_import', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='pylims.DataImport')),
+                ('user', models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.PROTECT, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 00:48
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pylims', '0003_data_import_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dataimport',
+            name='content_hash',
+            field=models.CharField(blank=True, editable=False, max_length=40),
+        ),
+    ]
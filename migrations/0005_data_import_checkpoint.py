@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 00:52
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pylims', '0004_data_import_content_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dataimport',
+            name='apply_error',
+            field=models.TextField(blank=True, editable=False),
+        ),
+        migrations.AddField(
+            model_name='dataimport',
+            name='apply_status',
+            field=models.CharField(blank=True, choices=[('', 'Not applied'), ('in_progress', 'In progress'), ('failed', 'Failed'), ('applied', 'Applied')], default='', editable=False, max_length=55),
+        ),
+        migrations.AddField(
+            model_name='dataimport',
+            name='checkpoint',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+    ]
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 01:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import pylims.models
+
+
+def compress_text(apps, schema_editor):
+    DataImport = apps.get_model('pylims', 'DataImport')
+    for pk, text in DataImport.objects.values_list('pk', 'text').iterator():
+        DataImport.objects.filter(pk=pk).update(compressed_text=text)
+
+
+def decompress_text(apps, schema_editor):
+    DataImport = apps.get_model('pylims', 'DataImport')
+    for pk, text in DataImport.objects.values_list('pk', 'compressed_text').iterator():
+        DataImport.objects.filter(pk=pk).update(text=text)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pylims', '0005_data_import_checkpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dataimport',
+            name='compressed_text',
+            field=pylims.models.CompressedTextField(null=True),
+        ),
+        # nullable so that the column can be added back (and filled) when unapplied
+        migrations.AlterField(
+            model_name='dataimport',
+            name='text',
+            field=models.TextField(null=True),
+        ),
+        migrations.RunPython(compress_text, decompress_text),
+        migrations.RemoveField(
+            model_name='dataimport',
+            name='text',
+        ),
+        migrations.RenameField(
+            model_name='dataimport',
+            old_name='compressed_text',
+            new_name='text',
+        ),
+        migrations.AlterField(
+            model_name='dataimport',
+            name='text',
+            field=pylims.models.CompressedTextField(),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 00:57
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import pylims.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pylims', '0006_compress_data_import_text'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DataImportChangeset',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('changes', pylims.models.CompressedTextField(blank=True, editable=False)),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='created')),
+                ('modified', models.DateTimeField(auto_now=True, verbose_name='modified')),
+                ('data_import', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='pylims.DataImport')),
+            ],
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 01:01
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pylims', '0007_data_import_changeset'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='sample',
+            index=models.Index(fields=['modified', 'id'], name='pylims_sample_modified_idx'),
+        ),
+    ]
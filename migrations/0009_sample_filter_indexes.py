@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 01:02
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pylims', '0008_sample_modified_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='measurement',
+            index=models.Index(fields=['param', 'sample'], name='pylims_measurement_param_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='sampletag',
+            index=models.Index(fields=['key', 'parent'], name='pylims_sampletag_key_idx'),
+        ),
+    ]
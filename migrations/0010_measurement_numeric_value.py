@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 01:07
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pylims', '0009_sample_filter_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='measurement',
+            name='non_numeric',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.AddField(
+            model_name='measurement',
+            name='numeric_value',
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='measurement',
+            index=models.Index(fields=['param', 'numeric_value'], name='pylims_measurement_numeric_idx'),
+        ),
+    ]
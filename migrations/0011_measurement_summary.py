@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 01:10
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import math
+
+
+# these are copies of Measurement.parse_numeric() and models._summary_aggregates() when
+# this migration was written, so that later changes to them don't change this migration
+def parse_numeric(value):
+    if value is None or str(value).strip() == '':
+        return None, False
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None, True
+    if math.isnan(number) or math.isinf(number):
+        return None, True
+    return number, False
+
+
+def summary_aggregates():
+    return {
+        'count': models.Count('pk'),
+        'numeric_count': models.Count('numeric_value'),
+        'non_numeric_count': models.Sum(models.Case(models.When(non_numeric=True, then=1), default=0,
+                                                    output_field=models.IntegerField())),
+        'sum': models.Sum('numeric_value'),
+        'sum_squares': models.Sum(models.ExpressionWrapper(models.F('numeric_value') * models.F('numeric_value'),
+                                                           output_field=models.FloatField())),
+        'min': models.Min('numeric_value'),
+        'max': models.Max('numeric_value')
+    }
+
+
+def backfill_numeric_values(apps, schema_editor):
+    # measurements saved before 0010 have no numeric value, which the summaries need
+    Measurement = apps.get_model('pylims', 'Measurement')
+    measurements = Measurement.objects.filter(numeric_value__isnull=True, non_numeric=False)\
+        .exclude(value__isnull=True).exclude(value='')
+    last_pk = 0
+    while True:
+        chunk = list(measurements.filter(pk__gt=last_pk).order_by('pk').values_list('pk', 'value')[:1000])
+        if not chunk:
+            return
+        non_numeric_ids = []
+        for pk, value in chunk:
+            numeric_value, non_numeric = parse_numeric(value)
+            if non_numeric:
+                non_numeric_ids.append(pk)
+            elif numeric_value is not None:
+                Measurement.objects.filter(pk=pk).update(numeric_value=numeric_value)
+        Measurement.objects.filter(pk__in=non_numeric_ids).update(non_numeric=True)
+        last_pk = chunk[-1][0]
+
+
+def summarise_measurements(apps, schema_editor):
+    Measurement = apps.get_model('pylims', 'Measurement')
+    MeasurementSummary = apps.get_model('pylims', 'MeasurementSummary')
+    rows = Measurement.objects.order_by().values('param_id', 'sample__project_id', 'sample__location_id')\
+        .annotate(**summary_aggregates())
+    MeasurementSummary.objects.bulk_create([
+        MeasurementSummary(param_id=row['param_id'], project_id=row['sample__project_id'],
+                           location_id=row['sample__location_id'], count=row['count'],
+                           numeric_count=row['numeric_count'], non_numeric_count=row['non_numeric_count'] or 0,
+                           sum=row['sum'] or 0, sum_squares=row['sum_squares'] or 0,
+                           min=row['min'], max=row['max'])
+        for row in rows.iterator()
+    ], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pylims', '0010_measurement_numeric_value'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MeasurementSummary',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('count', models.IntegerField(default=0)),
+                ('numeric_count', models.IntegerField(default=0)),
+                ('non_numeric_count', models.IntegerField(default=0)),
+                ('sum', models.FloatField(default=0)),
+                ('sum_squares', models.FloatField(default=0)),
+                ('min', models.FloatField(blank=True, null=True)),
+                ('max', models.FloatField(blank=True, null=True)),
+                ('modified', models.DateTimeField(auto_now=True, verbose_name='modified')),
+                ('location', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='pylims.Location')),
+                ('param', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='pylims.Parameter')),
+                ('project', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='pylims.Project')),
+            ],
+            options={
+                'unique_together': set([('param', 'project', 'location')]),
+            },
+        ),
+        migrations.RunPython(backfill_numeric_values, migrations.RunPython.noop),
+        migrations.RunPython(summarise_measurements, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 01:13
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def closure_links(parents):
+    # a copy of models.closure_links() when this migration was written
+    for pk in parents:
+        ancestor = pk
+        depth = 0
+        seen = set()
+        while ancestor is not None and ancestor not in seen:
+            yield ancestor, pk, depth
+            seen.add(ancestor)
+            ancestor = parents.get(ancestor)
+            depth += 1
+
+
+def index_hierarchies(apps, schema_editor):
+    for name in ('Project', 'Location', 'Parameter', 'Sample'):
+        model_class = apps.get_model('pylims', name)
+        closure_model = apps.get_model('pylims', name + 'Closure')
+        parents = dict(model_class.objects.values_list('pk', 'parent_id'))
+        closure_model.objects.bulk_create(
+            [closure_model(ancestor_id=ancestor_id, descendant_id=descendant_id, depth=depth)
+             for ancestor_id, descendant_id, depth in closure_links(parents)],
+            batch_size=500
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pylims', '0011_measurement_summary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SampleClosure',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.IntegerField()),
+                ('ancestor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='descendant_links', to='pylims.Sample')),
+                ('descendant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ancestor_links', to='pylims.Sample')),
+            ],
+            options={
+                'unique_together': set([('ancestor', 'descendant')]),
+            },
+        ),
+        migrations.CreateModel(
+            name='ProjectClosure',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.IntegerField()),
+                ('ancestor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='descendant_links', to='pylims.Project')),
+                ('descendant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ancestor_links', to='pylims.Project')),
+            ],
+            options={
+                'unique_together': set([('ancestor', 'descendant')]),
+            },
+        ),
+        migrations.CreateModel(
+            name='ParameterClosure',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.IntegerField()),
+                ('ancestor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='descendant_links', to='pylims.Parameter')),
+                ('descendant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ancestor_links', to='pylims.Parameter')),
+            ],
+            options={
+                'unique_together': set([('ancestor', 'descendant')]),
+            },
+        ),
+        migrations.CreateModel(
+            name='LocationClosure',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.IntegerField()),
+                ('ancestor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='descendant_links', to='pylims.Location')),
+                ('descendant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ancestor_links', to='pylims.Location')),
+            ],
+            options={
+                'unique_together': set([('ancestor', 'descendant')]),
+            },
+        ),
+        migrations.RunPython(index_hierarchies, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 01:20
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pylims', '0012_hierarchy_closure'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dataimportjob',
+            name='heartbeat',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='heartbeat'),
+        ),
+    ]
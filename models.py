@@ -1,12 +1,23 @@
+import os
 import json
+import math
+import zlib
+import codecs
+import hashlib
 import datetime
+import threading
+import contextlib
+from collections import OrderedDict
 
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.conf import settings
 from django.core import serializers
+from django.core.cache import caches
 from django.contrib.auth.models import User
-from django.core.exceptions import ValidationError
+from django.core.exceptions import ValidationError, ObjectDoesNotExist
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
 from django.utils.text import slugify
-import reversion
 
 from . import data_import
 
@@ -50,7 +61,367 @@ class TagsField(models.TextField):
             return None
 
 
-class Project(models.Model):
+class CompressedText(object):
+    """
+    The stored value of a CompressedTextField, which is only decompressed when the
+    text is first used. Unchanged values are saved again without recompressing them,
+    and chunks() decompresses the text a piece at a time.
+    """
+
+    def __init__(self, compressed):
+        self.compressed = compressed
+        self._text = None
+
+    @classmethod
+    def from_chunks(cls, chunks, encoding="utf-8"):
+        """
+        Compress text from an iterable of str or bytes pieces (e.g., the chunks()
+        of an uploaded file) without joining them
+        :param chunks: An iterable of str or bytes
+        :param encoding: The encoding of bytes pieces
+        :return: A CompressedText
+        """
+        compressor = zlib.compressobj()
+        decoder = codecs.getincrementaldecoder(encoding)()
+        compressed = []
+        for chunk in chunks:
+            if isinstance(chunk, bytes):
+                chunk = decoder.decode(chunk)
+            compressed.append(compressor.compress(chunk.encode("utf-8")))
+        compressed.append(compressor.compress(decoder.decode(b"", final=True).encode("utf-8")))
+        compressed.append(compressor.flush())
+        return cls(b"".join(compressed))
+
+    @property
+    def text(self):
+        if self._text is None:
+            self._text = zlib.decompress(self.compressed).decode("utf-8")
+        return self._text
+
+    def byte_chunks(self, chunk_size=64 * 1024):
+        # the UTF-8 encoded text, without decompressing all of it at once
+        decompressor = zlib.decompressobj()
+        for start in range(0, len(self.compressed), chunk_size):
+            chunk = decompressor.decompress(self.compressed[start:start + chunk_size])
+            if chunk:
+                yield chunk
+        chunk = decompressor.flush()
+        if chunk:
+            yield chunk
+
+    def chunks(self, chunk_size=64 * 1024):
+        """
+        Iterate over the text in pieces (see data_import.text_lines())
+        """
+        if self._text is not None:
+            for start in range(0, len(self._text), chunk_size):
+                yield self._text[start:start + chunk_size]
+            return
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        for chunk in self.byte_chunks(chunk_size):
+            text = decoder.decode(chunk)
+            if text:
+                yield text
+        text = decoder.decode(b"", final=True)
+        if text:
+            yield text
+
+    def __str__(self):
+        return self.text
+
+
+class CompressedTextDescriptor(object):
+    """
+    Decompresses the value of a CompressedTextField when the attribute is read,
+    loading it first if the field was deferred
+    """
+
+    def __init__(self, field):
+        self.field = field
+
+    def raw(self, instance):
+        """
+        The value without decompressing it (a CompressedText if it was loaded from
+        the database and not changed, otherwise a str or None)
+        """
+        attname = self.field.attname
+        if attname not in instance.__dict__:
+            # load the (still compressed) value of a deferred field
+            instance.__dict__[attname] = type(instance)._base_manager.using(instance._state.db)\
+                .filter(pk=instance.pk).values_list(attname, flat=True).get()
+        return instance.__dict__[attname]
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        value = self.raw(instance)
+        return value.text if isinstance(value, CompressedText) else value
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.field.attname] = value
+
+
+class CompressedTextField(models.TextField):
+    """
+    Text that is stored zlib-compressed in a binary column. The value is a str in
+    Python and the field uses a Textarea in forms, like a TextField. Values cannot
+    be used in lookups. Loaded values are kept compressed (as CompressedText) until
+    the attribute is read.
+    """
+
+    def get_internal_type(self):
+        return "BinaryField"
+
+    def contribute_to_class(self, cls, name, *args, **kwargs):
+        super(CompressedTextField, self).contribute_to_class(cls, name, *args, **kwargs)
+        setattr(cls, self.attname, CompressedTextDescriptor(self))
+
+    def pre_save(self, model_instance, add):
+        # values that were never read are saved as they were loaded
+        return model_instance.__dict__.get(self.attname)
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        if isinstance(value, CompressedText):
+            return connection.Database.Binary(value.compressed)
+        value = super(CompressedTextField, self).get_db_prep_value(value, connection, prepared)
+        if value is not None:
+            return connection.Database.Binary(zlib.compress(value.encode("utf-8")))
+        return value
+
+    def from_db_value(self, value, *args, **kwargs):
+        if value is None:
+            return value
+        return CompressedText(bytes(value))
+
+    def to_python(self, value):
+        if isinstance(value, CompressedText):
+            return value.text
+        if isinstance(value, (bytes, memoryview)):
+            return zlib.decompress(bytes(value)).decode("utf-8")
+        return super(CompressedTextField, self).to_python(value)
+
+
+_parent_updates = threading.local()
+
+
+@contextlib.contextmanager
+def coalesce_parent_updates():
+    """
+    Within this block, the modified time of the parents of saved tags is updated
+    with one UPDATE per parent model at the end of the block instead of one per tag
+    """
+    if getattr(_parent_updates, "pending", None) is not None:
+        # nested blocks are updated by the outermost block
+        yield
+        return
+
+    _parent_updates.pending = OrderedDict()
+    try:
+        yield
+        pending = _parent_updates.pending
+    finally:
+        _parent_updates.pending = None
+
+    for model_class, parent_ids in pending.items():
+        touch_parents(model_class, parent_ids)
+
+
+_signal_updates = threading.local()
+
+
+@contextlib.contextmanager
+def suspend_signal_updates():
+    """
+    Within this block, the signal receivers that invalidate cached sample counts and
+    update MeasurementSummary do nothing, so that many objects can be changed without
+    a query per object. The caller is responsible for these updates.
+    """
+    suspended = getattr(_signal_updates, "suspended", False)
+    _signal_updates.suspended = True
+    try:
+        yield
+    finally:
+        _signal_updates.suspended = suspended
+
+
+def signal_updates_suspended():
+    return getattr(_signal_updates, "suspended", False)
+
+
+def touch_parents(model_class, parent_ids):
+    """
+    Set the modified time of the model_class objects with parent_ids to now
+    (deferred to the end of a coalesce_parent_updates() block if there is one)
+    """
+    pending = getattr(_parent_updates, "pending", None)
+    if pending is not None:
+        pending.setdefault(model_class, set()).update(parent_ids)
+        return
+
+    parent_ids = sorted(set(parent_ids))
+    now = timezone.now()
+    for start in range(0, len(parent_ids), 500):
+        model_class.objects.filter(pk__in=parent_ids[start:start + 500]).update(modified=now)
+    if model_class is Sample and parent_ids:
+        invalidate_sample_counts()
+
+
+def is_loaded(instance, field_name):
+    # True if the related object field_name of instance was loaded (without loading it)
+    field = instance._meta.get_field(field_name)
+    if hasattr(field, "is_cached"):
+        return field.is_cached(instance)
+    return hasattr(instance, field.get_cache_name())
+
+
+def touch_parent(tag):
+    # update the parent instance if it was loaded, but don't load it to do so
+    if is_loaded(tag, "parent"):
+        tag.parent.modified = timezone.now()
+    touch_parents(tag._meta.get_field("parent").remote_field.model, [tag.parent_id])
+
+
+def closure_links(parents):
+    """
+    The closure table rows of a tree
+    :param parents: A dict of parent IDs (or None) by ID
+    :return: A generator of (ancestor ID, descendant ID, depth) tuples, including
+    (ID, ID, 0) for each ID
+    """
+    for pk in parents:
+        ancestor = pk
+        depth = 0
+        seen = set()
+        while ancestor is not None and ancestor not in seen:
+            yield ancestor, pk, depth
+            seen.add(ancestor)
+            ancestor = parents.get(ancestor)
+            depth += 1
+
+
+class HierarchyModel(models.Model):
+    """
+    A model with a self-referencing parent whose ancestors are indexed in a closure
+    table (e.g., ProjectClosure), so that a subtree can be selected with one query
+    instead of one per level. The closure table is updated when objects are saved
+    (or inserted by bulk_save()); like other validation, clean() checks that the
+    parent is not a descendant.
+    """
+
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def closure_model(cls):
+        # the closure model refers to this model with related_name="descendant_links"
+        return cls.descendant_links.field.model
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(HierarchyModel, cls).from_db(db, field_names, values)
+        if "parent_id" in instance.__dict__:
+            instance._saved_parent_id = instance.parent_id
+        return instance
+
+    def clean(self):
+        super(HierarchyModel, self).clean()
+        # the parent can't be this object or one of its descendants
+        if self.pk is not None and self.parent_id is not None and \
+                self.closure_model().objects.filter(ancestor_id=self.pk, descendant_id=self.parent_id).exists():
+            raise ValidationError({"parent": "%s cannot be a descendant of itself" % self})
+
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        if adding:
+            moved = False
+        else:
+            if hasattr(self, "_saved_parent_id"):
+                saved_parent_id = self._saved_parent_id
+            else:
+                saved_parent_id = type(self).objects.filter(pk=self.pk).values_list("parent_id", flat=True).first()
+            moved = saved_parent_id != self.parent_id
+
+        with transaction.atomic():
+            super(HierarchyModel, self).save(*args, **kwargs)
+            if adding:
+                insert_closures(type(self), [self])
+            elif moved:
+                move_closures(self)
+        self._saved_parent_id = self.parent_id
+
+    def descendants(self, include_self=True):
+        links = self.closure_model().objects.filter(ancestor=self)
+        if not include_self:
+            links = links.filter(depth__gt=0)
+        return type(self).objects.filter(pk__in=links.values("descendant"))
+
+    def ancestors(self, include_self=True):
+        links = self.closure_model().objects.filter(descendant=self)
+        if not include_self:
+            links = links.filter(depth__gt=0)
+        return type(self).objects.filter(pk__in=links.values("ancestor"))
+
+
+def insert_closures(model_class, objects):
+    """
+    Add the closure table rows of newly inserted objects (whose parents, if any,
+    must already be in the closure table)
+    """
+    closure_model = model_class.closure_model()
+    parent_ids = sorted({item.parent_id for item in objects if item.parent_id is not None})
+    ancestors = {}
+    for start in range(0, len(parent_ids), 500):
+        for ancestor_id, descendant_id, depth in closure_model.objects\
+                .filter(descendant_id__in=parent_ids[start:start + 500])\
+                .values_list("ancestor_id", "descendant_id", "depth"):
+            ancestors.setdefault(descendant_id, []).append((ancestor_id, depth))
+
+    links = []
+    for item in objects:
+        links.append(closure_model(ancestor_id=item.pk, descendant_id=item.pk, depth=0))
+        for ancestor_id, depth in ancestors.get(item.parent_id, ()):
+            links.append(closure_model(ancestor_id=ancestor_id, descendant_id=item.pk, depth=depth + 1))
+    closure_model.objects.bulk_create(links, batch_size=500)
+
+
+def move_closures(obj):
+    """
+    Update the closure table rows of obj and its descendants after the parent of obj changed
+    """
+    closure_model = obj.closure_model()
+    subtree = list(closure_model.objects.filter(ancestor_id=obj.pk).values_list("descendant_id", "depth"))
+    subtree_ids = [pk for pk, depth in subtree]
+    old_ancestor_ids = list(closure_model.objects.filter(descendant_id=obj.pk, depth__gt=0)
+                            .values_list("ancestor_id", flat=True))
+    for start in range(0, len(subtree_ids), 500):
+        closure_model.objects.filter(ancestor_id__in=old_ancestor_ids,
+                                     descendant_id__in=subtree_ids[start:start + 500]).delete()
+
+    if obj.parent_id is not None:
+        new_ancestors = closure_model.objects.filter(descendant_id=obj.parent_id).values_list("ancestor_id", "depth")
+        closure_model.objects.bulk_create([
+            closure_model(ancestor_id=ancestor_id, descendant_id=pk, depth=ancestor_depth + depth + 1)
+            for ancestor_id, ancestor_depth in new_ancestors for pk, depth in subtree
+        ], batch_size=500)
+
+
+def rebuild_closures(model_class):
+    """
+    Recreate the closure table of model_class (e.g., after parents were changed
+    using QuerySet.update())
+    """
+    closure_model = model_class.closure_model()
+    parents = dict(model_class.objects.values_list("pk", "parent_id"))
+    with transaction.atomic():
+        closure_model.objects.all().delete()
+        closure_model.objects.bulk_create(
+            [closure_model(ancestor_id=ancestor_id, descendant_id=descendant_id, depth=depth)
+             for ancestor_id, descendant_id, depth in closure_links(parents)],
+            batch_size=500
+        )
+
+
+class Project(HierarchyModel):
     name = models.CharField(max_length=55, unique=True)
     slug = models.SlugField(unique=True)
     parent = models.ForeignKey('self', on_delete=models.PROTECT, null=True, blank=True)
@@ -75,6 +446,16 @@ class Project(models.Model):
         return self.name
 
 
+class ProjectClosure(models.Model):
+    # the ancestors of each project (including itself, at depth 0)
+    ancestor = models.ForeignKey(Project, on_delete=models.CASCADE, related_name="descendant_links")
+    descendant = models.ForeignKey(Project, on_delete=models.CASCADE, related_name="ancestor_links")
+    depth = models.IntegerField()
+
+    class Meta:
+        unique_together = ("ancestor", "descendant")
+
+
 class ProjectTag(models.Model):
     parent = models.ForeignKey(Project, on_delete=models.CASCADE)
     key = models.SlugField(max_length=55)
@@ -83,15 +464,15 @@ class ProjectTag(models.Model):
                                     null=True, blank=True, editable=False)
 
     def save(self, *args, **kwargs):
-        # update parent param modified tag
-        self.parent.modified = datetime.datetime.now()
         super(ProjectTag, self).save(*args, **kwargs)
+        # update parent modified time
+        touch_parent(self)
 
     def __str__(self):
         return '%s="%s"' %(self.key, self.value)
 
 
-class Location(models.Model):
+class Location(HierarchyModel):
     name = models.CharField(max_length=55, unique=True)
     slug = models.SlugField(unique=True)
     parent = models.ForeignKey('self', on_delete=models.PROTECT, null=True, blank=True)
@@ -117,6 +498,16 @@ class Location(models.Model):
         return self.name
 
 
+class LocationClosure(models.Model):
+    # the ancestors of each location (including itself, at depth 0)
+    ancestor = models.ForeignKey(Location, on_delete=models.CASCADE, related_name="descendant_links")
+    descendant = models.ForeignKey(Location, on_delete=models.CASCADE, related_name="ancestor_links")
+    depth = models.IntegerField()
+
+    class Meta:
+        unique_together = ("ancestor", "descendant")
+
+
 class LocationTag(models.Model):
     parent = models.ForeignKey(Location, on_delete=models.CASCADE)
     key = models.SlugField(max_length=55)
@@ -125,15 +516,15 @@ class LocationTag(models.Model):
                                     null=True, blank=True, editable=False)
 
     def save(self, *args, **kwargs):
-        # update parent param modified tag
-        self.parent.modified = datetime.datetime.now()
         super(LocationTag, self).save(*args, **kwargs)
+        # update parent modified time
+        touch_parent(self)
 
     def __str__(self):
         return '%s="%s"' %(self.key, self.value)
 
 
-class Sample(models.Model):
+class Sample(HierarchyModel):
     name = models.CharField(max_length=255, blank=True)
     slug = models.CharField(max_length=55, unique=True, editable=False)
     parent = models.ForeignKey('self', on_delete=models.PROTECT, null=True, blank=True, editable=False)
@@ -148,27 +539,60 @@ class Sample(models.Model):
     project = models.ForeignKey(Project, on_delete=models.CASCADE, blank=True, null=True)
     location = models.ForeignKey(Location, on_delete=models.PROTECT, blank=True, null=True)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Sample, cls).from_db(db, field_names, values)
+        # the summary group of the measurements of this sample (see MeasurementSummary)
+        if "project_id" in instance.__dict__ and "location_id" in instance.__dict__:
+            instance._summary_group = (instance.project_id, instance.location_id)
+        return instance
+
+    class Meta:
+        # sample tables are paged by (modified, id) by default (see query_string_filter)
+        indexes = [
+            models.Index(fields=["modified", "id"], name="pylims_sample_modified_idx")
+        ]
+
     def save(self, *args, **kwargs):
-        if not self.pk:
+        if not self.pk and not self.slug:
             self.set_slug()
         super(Sample, self).save(*args, **kwargs)
 
-    def set_slug(self):
+    def slug_candidates(self):
+        """
+        Lists possible slugs for this sample in order of preference
+        """
         dt = self.collected if self.collected else self.created if self.created else datetime.datetime.now()
         location_slug = self.location.slug[:10] if self.location else ""
         user = self.user.username if self.user else ""
         hint = slugify(self.name)
 
+        candidates = []
         for date_fun in [self.short_date, self.long_date, self.longest_date]:
             dt_str = date_fun(dt)
             id_str = "_".join(item for item in [user, dt_str, location_slug, hint] if item)
-            id_str = id_str[:55]
-            other_objects = Sample.objects.filter(slug = id_str)
-            if len(other_objects) == 0:
+            candidates.append(id_str[:55])
+        return candidates
+
+    def set_slug(self, allocator=None):
+        """
+        Sets the slug to the first candidate slug that is not in use (see
+        numbered_slug() if all of them are). Pass a SlugAllocator to set slugs
+        for many samples at once.
+        """
+        if allocator is not None:
+            self.slug = allocator.allocate(self)
+            return
+
+        # only the candidates (and numbered versions of the last one) are queried
+        candidates = self.slug_candidates()
+        taken = set(Sample.objects.filter(slug__in=candidates).values_list("slug", flat=True))
+        for id_str in candidates:
+            if id_str not in taken:
                 self.slug = id_str
                 return
-
-        self.slug = str(self.pk)
+        numbered = Sample.objects.filter(slug__startswith=candidates[-1][:NUMBERED_SLUG_PREFIX])
+        self.slug = numbered_slug(candidates[-1], set(numbered.values_list("slug", flat=True)))
 
     def short_date(self, dt):
         return str(dt.date())
@@ -186,6 +610,76 @@ class Sample(models.Model):
         return self.slug
 
 
+class SampleClosure(models.Model):
+    # the ancestors of each sample (including itself, at depth 0)
+    ancestor = models.ForeignKey(Sample, on_delete=models.CASCADE, related_name="descendant_links")
+    descendant = models.ForeignKey(Sample, on_delete=models.CASCADE, related_name="ancestor_links")
+    depth = models.IntegerField()
+
+    class Meta:
+        unique_together = ("ancestor", "descendant")
+
+
+# numbered slugs (up to _99999) start with this many characters of the slug they number
+NUMBERED_SLUG_PREFIX = 49
+
+
+def numbered_slug(id_str, taken):
+    """
+    Number a slug whose candidates are all taken (e.g., replicates)
+    :param id_str: The slug to number
+    :param taken: A set of slugs that are in use (which must include those starting
+    with the first NUMBERED_SLUG_PREFIX characters of id_str)
+    :return: id_str with the first free suffix (_2, _3, ...), shortened to fit
+    """
+    n = 2
+    while True:
+        suffix = "_%s" % n
+        numbered = id_str[:55 - len(suffix)] + suffix
+        if numbered not in taken:
+            return numbered
+        n += 1
+
+
+class SlugAllocator(object):
+    """
+    Allocates unique slugs for a batch of samples. Existing slugs that share a
+    prefix with a sample's candidate slugs are loaded with one query, and allocated
+    slugs are reserved so that unsaved samples in the same batch never share a slug.
+    """
+
+    def __init__(self):
+        self.reserved = set()
+        self._loaded_prefixes = set()
+
+    def _load(self, prefix):
+        # slugs starting with prefix are already loaded if a shorter prefix was loaded
+        if any(prefix[:i] in self._loaded_prefixes for i in range(len(prefix) + 1)):
+            return
+        existing = Sample.objects.filter(slug__startswith=prefix).values_list("slug", flat=True)
+        self.reserved.update(existing)
+        self._loaded_prefixes.add(prefix)
+
+    def allocate(self, sample):
+        """
+        Reserve and return a slug for sample
+        :param sample: A Sample
+        :return: The first of sample.slug_candidates() that is not in use
+        """
+        candidates = sample.slug_candidates()
+        self._load(os.path.commonprefix(candidates))
+        for id_str in candidates:
+            if id_str not in self.reserved:
+                self.reserved.add(id_str)
+                return id_str
+
+        # all candidates are taken (e.g., replicates): number the most specific one
+        self._load(candidates[-1][:NUMBERED_SLUG_PREFIX])
+        id_str = numbered_slug(candidates[-1], self.reserved)
+        self.reserved.add(id_str)
+        return id_str
+
+
 class SampleTag(models.Model):
     parent = models.ForeignKey(Sample, on_delete=models.CASCADE)
     key = models.SlugField(max_length=55)
@@ -193,16 +687,23 @@ class SampleTag(models.Model):
     data_import = models.ForeignKey('DataImport', on_delete=models.SET_NULL,
                                     null=True, blank=True, editable=False)
 
+    class Meta:
+        # tag_* filters (see query_string_filter) look up the tags of a sample by key; the
+        # value is not indexed because it is an unbounded TextField
+        indexes = [
+            models.Index(fields=["key", "parent"], name="pylims_sampletag_key_idx")
+        ]
+
     def save(self, *args, **kwargs):
-        # update parent param modified tag
-        self.parent.modified = datetime.datetime.now()
         super(SampleTag, self).save(*args, **kwargs)
+        # update parent modified time
+        touch_parent(self)
 
     def __str__(self):
         return '%s="%s"' %(self.key, self.value)
 
 
-class Parameter(models.Model):
+class Parameter(HierarchyModel):
     name = models.CharField(max_length=55, unique=True)
     slug = models.SlugField(unique=True)
     parent = models.ForeignKey('self', on_delete=models.PROTECT, null=True, blank=True)
@@ -227,6 +728,16 @@ class Parameter(models.Model):
         return self.slug if self.slug else self.name
 
 
+class ParameterClosure(models.Model):
+    # the ancestors of each parameter (including itself, at depth 0)
+    ancestor = models.ForeignKey(Parameter, on_delete=models.CASCADE, related_name="descendant_links")
+    descendant = models.ForeignKey(Parameter, on_delete=models.CASCADE, related_name="ancestor_links")
+    depth = models.IntegerField()
+
+    class Meta:
+        unique_together = ("ancestor", "descendant")
+
+
 class ParameterTag(models.Model):
     parent = models.ForeignKey(Parameter, on_delete=models.CASCADE)
     key = models.SlugField(max_length=55)
@@ -235,9 +746,9 @@ class ParameterTag(models.Model):
                                     null=True, blank=True, editable=False)
 
     def save(self, *args, **kwargs):
-        # update parent param modified tag
-        self.parent.modified = datetime.datetime.now()
         super(ParameterTag, self).save(*args, **kwargs)
+        # update parent modified time
+        touch_parent(self)
 
     def __str__(self):
         return '%s="%s"' %(self.key, self.value)
@@ -248,6 +759,10 @@ class Measurement(models.Model):
     sample = models.ForeignKey(Sample, on_delete=models.CASCADE)
     value = models.TextField(blank=True, null=True)
     tags = TagsField()
+    # value as a number (set on save), so that values can be filtered and aggregated
+    # in the database; values that are not numbers (e.g., "<DL") are flagged as non_numeric
+    numeric_value = models.FloatField(null=True, blank=True, editable=False)
+    non_numeric = models.BooleanField(default=False, editable=False)
 
     user = models.ForeignKey(User, on_delete=models.PROTECT, null=True, blank=True, editable=False)
     created = models.DateTimeField("created", auto_now_add=True)
@@ -255,6 +770,48 @@ class Measurement(models.Model):
     data_import = models.ForeignKey('DataImport', on_delete=models.SET_NULL,
                                     null=True, blank=True, editable=False)
 
+    class Meta:
+        # param_* filters (see query_string_filter) check for a measurement by parameter and sample
+        indexes = [
+            models.Index(fields=["param", "sample"], name="pylims_measurement_param_idx"),
+            models.Index(fields=["param", "numeric_value"], name="pylims_measurement_numeric_idx")
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Measurement, cls).from_db(db, field_names, values)
+        # the values last counted in MeasurementSummary
+        if all(name in instance.__dict__ for name in SUMMARY_STATE_FIELDS):
+            instance._summary_state = instance.summary_state()
+        return instance
+
+    def summary_state(self):
+        return tuple(getattr(self, name) for name in SUMMARY_STATE_FIELDS)
+
+    def save(self, *args, **kwargs):
+        self.set_numeric_value()
+        super(Measurement, self).save(*args, **kwargs)
+
+    @staticmethod
+    def parse_numeric(value):
+        """
+        Parse a measurement value as a number
+        :param value: A value (usually a str)
+        :return: A tuple of the number (or None) and whether a non-blank value was not a number
+        """
+        if value is None or str(value).strip() == "":
+            return None, False
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            return None, True
+        if math.isnan(number) or math.isinf(number):
+            return None, True
+        return number, False
+
+    def set_numeric_value(self):
+        self.numeric_value, self.non_numeric = self.parse_numeric(self.value)
+
     def parse_tags(self):
         return json.load(self.tags)
 
@@ -279,12 +836,489 @@ class Measurement(models.Model):
             return "%s = %s" % (self.param, self.value)
 
 
+# the Measurement fields that MeasurementSummary depends on
+SUMMARY_STATE_FIELDS = ("param_id", "sample_id", "numeric_value", "non_numeric")
+
+
+class MeasurementSummary(models.Model):
+    """
+    Running totals of the measurements of a parameter for each project and
+    location, so that statistics can be read without scanning measurements. Rows are
+    updated when measurements (or the project/location of their sample) change
+    (see SummaryChanges) and can be rebuilt using rebuild_measurement_summaries().
+    """
+    param = models.ForeignKey(Parameter, on_delete=models.CASCADE)
+    project = models.ForeignKey(Project, on_delete=models.CASCADE, null=True, blank=True)
+    location = models.ForeignKey(Location, on_delete=models.CASCADE, null=True, blank=True)
+
+    count = models.IntegerField(default=0)
+    numeric_count = models.IntegerField(default=0)
+    non_numeric_count = models.IntegerField(default=0)
+    sum = models.FloatField(default=0)
+    sum_squares = models.FloatField(default=0)
+    min = models.FloatField(null=True, blank=True)
+    max = models.FloatField(null=True, blank=True)
+
+    modified = models.DateTimeField("modified", auto_now=True)
+
+    class Meta:
+        unique_together = ("param", "project", "location")
+
+    @staticmethod
+    def combine(summaries):
+        """
+        Combine summary rows (e.g., for all locations of a project)
+        :param summaries: An iterable of MeasurementSummary objects
+        :return: A dict with count, numeric_count, non_numeric_count, min, max, mean and sd
+        """
+        stats = {"count": 0, "numeric_count": 0, "non_numeric_count": 0, "min": None, "max": None}
+        total = 0.0
+        total_squares = 0.0
+        for summary in summaries:
+            stats["count"] += summary.count
+            stats["numeric_count"] += summary.numeric_count
+            stats["non_numeric_count"] += summary.non_numeric_count
+            total += summary.sum
+            total_squares += summary.sum_squares
+            if summary.min is not None and (stats["min"] is None or summary.min < stats["min"]):
+                stats["min"] = summary.min
+            if summary.max is not None and (stats["max"] is None or summary.max > stats["max"]):
+                stats["max"] = summary.max
+
+        n = stats["numeric_count"]
+        stats["mean"] = total / n if n else None
+        if n > 1:
+            stats["sd"] = math.sqrt(max(total_squares - n * stats["mean"] ** 2, 0) / (n - 1))
+        else:
+            stats["sd"] = None
+        return stats
+
+    @classmethod
+    def table(cls, **filters):
+        """
+        Statistics for each parameter, combining the summary rows matching filters
+        :return: A list of dicts (see combine()) with the parameter as param
+        """
+        by_param = OrderedDict()
+        for summary in cls.objects.filter(**filters).select_related("param").order_by("param__slug"):
+            by_param.setdefault(summary.param, []).append(summary)
+        table = []
+        for param, summaries in by_param.items():
+            stats = cls.combine(summaries)
+            stats["param"] = param
+            table.append(stats)
+        return table
+
+    def __str__(self):
+        return "%s (%s, %s)" % (self.param, self.project, self.location)
+
+
+def _sample_groups(sample_ids):
+    # the (project ID, location ID) of each sample
+    sample_ids = list(set(sample_ids))
+    groups = {}
+    for start in range(0, len(sample_ids), 500):
+        for pk, project_id, location_id in Sample.objects.filter(pk__in=sample_ids[start:start + 500])\
+                .values_list("pk", "project_id", "location_id"):
+            groups[pk] = (project_id, location_id)
+    return groups
+
+
+def _summary_filter(param_id, group):
+    project_id, location_id = group
+    return {"param_id": param_id,
+            "project_id" if project_id is not None else "project__isnull": project_id or True,
+            "location_id" if location_id is not None else "location__isnull": location_id or True}
+
+
+def _summary_aggregates():
+    return {
+        "count": models.Count("pk"),
+        "numeric_count": models.Count("numeric_value"),
+        "non_numeric_count": models.Sum(models.Case(models.When(non_numeric=True, then=1), default=0,
+                                                    output_field=models.IntegerField())),
+        "sum": models.Sum("numeric_value"),
+        "sum_squares": models.Sum(models.ExpressionWrapper(models.F("numeric_value") * models.F("numeric_value"),
+                                                           output_field=models.FloatField())),
+        "min": models.Min("numeric_value"),
+        "max": models.Max("numeric_value")
+    }
+
+
+class SummaryChanges(object):
+    """
+    Collects changes to MeasurementSummary rows so that they can be applied
+    with a few queries per row (see apply())
+    """
+
+    def __init__(self):
+        self._pending = []
+        self._deltas = OrderedDict()
+
+    def add(self, state, sign=1, group=None):
+        """
+        Count (sign=1) or uncount (sign=-1) a measurement
+        :param state: The Measurement.summary_state() of the measurement
+        :param group: The (project ID, location ID) of the sample, if known
+        """
+        self._pending.append((state, sign, group))
+
+    def add_totals(self, param_id, group, totals, sign=1):
+        """
+        Count or uncount measurements using totals with the keys of _summary_aggregates()
+        """
+        delta = self._delta(param_id, group)
+        for name in ("count", "numeric_count", "non_numeric_count", "sum", "sum_squares"):
+            delta[name] += sign * (totals[name] or 0)
+        if totals["min"] is not None:
+            self._extend(delta, sign, totals["min"], totals["max"])
+
+    def _delta(self, param_id, group):
+        return self._deltas.setdefault((param_id, group), {
+            "count": 0, "numeric_count": 0, "non_numeric_count": 0, "sum": 0.0, "sum_squares": 0.0,
+            "min": None, "max": None, "removed_min": None, "removed_max": None
+        })
+
+    @staticmethod
+    def _extend(delta, sign, low, high):
+        # new values can lower the min or raise the max; removed values may have been the min or max
+        names = ("min", "max") if sign > 0 else ("removed_min", "removed_max")
+        if delta[names[0]] is None or low < delta[names[0]]:
+            delta[names[0]] = low
+        if delta[names[1]] is None or high > delta[names[1]]:
+            delta[names[1]] = high
+
+    def apply(self):
+        groups = _sample_groups([state[1] for state, sign, group in self._pending if group is None])
+        for (param_id, sample_id, number, non_numeric), sign, group in self._pending:
+            if group is None:
+                group = groups.get(sample_id)
+            if group is None:
+                continue
+            delta = self._delta(param_id, group)
+            delta["count"] += sign
+            if non_numeric:
+                delta["non_numeric_count"] += sign
+            if number is not None:
+                delta["numeric_count"] += sign
+                delta["sum"] += sign * number
+                delta["sum_squares"] += sign * number * number
+                self._extend(delta, sign, number, number)
+        self._pending = []
+
+        for (param_id, group), delta in self._deltas.items():
+            self._apply_delta(param_id, group, delta)
+        self._deltas = OrderedDict()
+
+    @staticmethod
+    def _apply_delta(param_id, group, delta):
+        summaries = MeasurementSummary.objects.filter(**_summary_filter(param_id, group))
+        updates = {name: models.F(name) + delta[name]
+                   for name in ("count", "numeric_count", "non_numeric_count", "sum", "sum_squares")}
+        if delta["min"] is not None:
+            updates["min"] = models.Case(models.When(min__isnull=True, then=models.Value(delta["min"])),
+                                         models.When(min__gt=delta["min"], then=models.Value(delta["min"])),
+                                         default=models.F("min"), output_field=models.FloatField())
+            updates["max"] = models.Case(models.When(max__isnull=True, then=models.Value(delta["max"])),
+                                         models.When(max__lt=delta["max"], then=models.Value(delta["max"])),
+                                         default=models.F("max"), output_field=models.FloatField())
+
+        if not summaries.update(**updates):
+            if delta["count"] <= 0:
+                # nothing to remove from (summaries may need to be rebuilt)
+                return
+            project_id, location_id = group
+            try:
+                with transaction.atomic():
+                    MeasurementSummary.objects.create(
+                        param_id=param_id, project_id=project_id, location_id=location_id,
+                        **{name: delta[name] for name in ("count", "numeric_count", "non_numeric_count",
+                                                          "sum", "sum_squares", "min", "max")})
+            except IntegrityError:
+                # created by another process in the meantime
+                summaries.update(**updates)
+            return
+
+        # only a removed value that was the min or max requires a query of the measurements
+        if delta["removed_min"] is not None:
+            current = summaries.values("count", "min", "max").first()
+            if current["count"] <= 0:
+                summaries.delete()
+            elif (current["min"] is not None and delta["removed_min"] <= current["min"]) or \
+                    (current["max"] is not None and delta["removed_max"] >= current["max"]):
+                project_id, location_id = group
+                extremes = Measurement.objects.filter(param_id=param_id, sample__project_id=project_id,
+                                                      sample__location_id=location_id)\
+                    .aggregate(min=models.Min("numeric_value"), max=models.Max("numeric_value"))
+                summaries.update(**extremes)
+        elif delta["count"] < 0:
+            summaries.filter(count__lte=0).delete()
+
+
+def rebuild_measurement_summaries():
+    """
+    Recalculate MeasurementSummary from all measurements (e.g., after measurements were
+    changed using QuerySet.update())
+    :return: The number of summary rows
+    """
+    rows = Measurement.objects.order_by().values("param_id", "sample__project_id", "sample__location_id")\
+        .annotate(**_summary_aggregates())
+    with transaction.atomic():
+        MeasurementSummary.objects.all().delete()
+        summaries = [MeasurementSummary(param_id=row["param_id"], project_id=row["sample__project_id"],
+                                        location_id=row["sample__location_id"], count=row["count"],
+                                        numeric_count=row["numeric_count"],
+                                        non_numeric_count=row["non_numeric_count"] or 0,
+                                        sum=row["sum"] or 0, sum_squares=row["sum_squares"] or 0,
+                                        min=row["min"], max=row["max"])
+                     for row in rows.iterator()]
+        MeasurementSummary.objects.bulk_create(summaries, batch_size=500)
+    return len(summaries)
+
+
+# signal receivers that keep MeasurementSummary up to date (connected in apps.py)
+
+def measurement_pre_save(sender, instance, raw=False, **kwargs):
+    # updated measurements that were not loaded from the database (e.g., imported updates)
+    if not raw and not signal_updates_suspended() and not instance._state.adding and \
+            not hasattr(instance, "_summary_state"):
+        instance._summary_state = Measurement.objects.filter(pk=instance.pk)\
+            .values_list(*SUMMARY_STATE_FIELDS).first()
+
+
+def measurement_post_save(sender, instance, created, raw=False, **kwargs):
+    if raw or signal_updates_suspended():
+        return
+    old_state = None if created else getattr(instance, "_summary_state", None)
+    new_state = instance.summary_state()
+    if old_state == new_state:
+        return
+    changes = SummaryChanges()
+    if old_state is not None:
+        changes.add(old_state, -1)
+    changes.add(new_state, 1)
+    changes.apply()
+    instance._summary_state = new_state
+
+
+def measurement_post_delete(sender, instance, **kwargs):
+    if signal_updates_suspended():
+        return
+    changes = SummaryChanges()
+    changes.add(getattr(instance, "_summary_state", None) or instance.summary_state(), -1)
+    changes.apply()
+
+
+def sample_pre_save(sender, instance, raw=False, **kwargs):
+    if not raw and not signal_updates_suspended() and not instance._state.adding and \
+            not hasattr(instance, "_summary_group"):
+        instance._summary_group = Sample.objects.filter(pk=instance.pk)\
+            .values_list("project_id", "location_id").first()
+
+
+def sample_post_save(sender, instance, created, raw=False, **kwargs):
+    # the measurements of a sample that moved to another project or location are moved too
+    old_group = None if created else getattr(instance, "_summary_group", None)
+    new_group = (instance.project_id, instance.location_id)
+    instance._summary_group = new_group
+    if raw or signal_updates_suspended() or old_group is None or old_group == new_group:
+        return
+    changes = SummaryChanges()
+    totals = Measurement.objects.filter(sample=instance).order_by().values("param_id")\
+        .annotate(**_summary_aggregates())
+    for row in totals:
+        changes.add_totals(row["param_id"], old_group, row, -1)
+        changes.add_totals(row["param_id"], new_group, row, 1)
+    changes.apply()
+
+
+# objects returned by importers are inserted in this order so that
+# the objects they refer to already have primary keys
+BULK_SAVE_ORDER = ("Project", "Location", "Parameter",
+                   "ProjectTag", "LocationTag", "ParameterTag",
+                   "Sample", "SampleTag", "Measurement")
+
+
+def _refresh_foreign_keys(item):
+    """
+    Copy the primary keys of related objects that were saved after being
+    assigned to item (e.g. tag.parent) into the foreign key id attributes
+    :param item: A model instance
+    :return: True if item still refers to an object without a primary key
+    """
+    has_unsaved = False
+    for field in item._meta.concrete_fields:
+        if not field.is_relation or not field.many_to_one:
+            continue
+        try:
+            related = getattr(item, field.name)
+        except ObjectDoesNotExist:
+            continue
+        if related is None:
+            continue
+        if related.pk is None:
+            has_unsaved = True
+        else:
+            setattr(item, field.attname, related.pk)
+    return has_unsaved
+
+
+def _prepare_insert(item):
+    # bulk inserts skip save(), so apply what save() would have done
+    if isinstance(item, Sample):
+        if not item.slug:
+            item.set_slug()
+    elif isinstance(item, (Project, Location, Parameter)):
+        if not item.slug:
+            item.slug = slugify(item.name)
+    elif isinstance(item, Measurement):
+        item.set_numeric_value()
+
+
+def _set_inserted_pks(model_class, objects):
+    """
+    Backends that cannot return IDs from bulk inserts leave pk as None. Models
+    with a unique slug can be looked up in one query so that objects referring
+    to them can be inserted afterward.
+    """
+    missing = {obj.slug: obj for obj in objects if obj.pk is None and getattr(obj, "slug", None)}
+    slug_field = [f for f in model_class._meta.concrete_fields if f.name == "slug"]
+    if missing and slug_field and slug_field[0].unique:
+        pks = model_class.objects.filter(slug__in=list(missing)).values_list("slug", "pk")
+        for slug, pk in pks:
+            missing[slug].pk = pk
+
+    for obj in objects:
+        if obj.pk is not None:
+            obj._state.adding = False
+            obj._state.db = model_class.objects.db
+
+
+def bulk_save(items, batch_size=None):
+    """
+    Insert unsaved model instances using multi-row inserts. Instances are grouped
+    by model class and inserted in dependency order (see BULK_SAVE_ORDER), and
+    foreign key IDs are set from related objects after each group is inserted.
+    Instances that already exist in the database are updated using save().
+    :param items: An iterable of unsaved model instances
+    :param batch_size: The maximum number of objects per INSERT query
+    :return: The number of objects inserted
+    """
+    groups = OrderedDict()
+    for item in items:
+        groups.setdefault(type(item), []).append(item)
+
+    def order(model_class):
+        name = model_class.__name__
+        return BULK_SAVE_ORDER.index(name) if name in BULK_SAVE_ORDER else len(BULK_SAVE_ORDER)
+
+    # tags update the modified time of their parents once per parent
+    with coalesce_parent_updates():
+        n_saved = 0
+        for model_class in sorted(groups, key=order):
+            pending = groups[model_class]
+            # objects that refer to unsaved objects of the same class (e.g. sub-samples)
+            # are inserted after the objects they refer to
+            while pending:
+                ready = []
+                waiting = []
+                for item in pending:
+                    if _refresh_foreign_keys(item):
+                        waiting.append(item)
+                    else:
+                        ready.append(item)
+                if not ready:
+                    raise ValueError("Could not resolve references between %s objects" % model_class.__name__)
+
+                # objects matched to existing objects (see DataImport.iter_import()) are updated
+                inserts = []
+                for item in ready:
+                    if item._state.adding:
+                        _prepare_insert(item)
+                        inserts.append(item)
+                    else:
+                        item.save()
+                model_class.objects.bulk_create(inserts, batch_size=batch_size)
+                _set_inserted_pks(model_class, inserts)
+                if issubclass(model_class, HierarchyModel) and inserts:
+                    insert_closures(model_class, inserts)
+                # bulk inserts skip save() and signals, so measurements are counted here
+                if model_class is Measurement and inserts:
+                    changes = SummaryChanges()
+                    for item in inserts:
+                        item._summary_state = item.summary_state()
+                        if is_loaded(item, "sample"):
+                            changes.add(item._summary_state, 1, (item.sample.project_id, item.sample.location_id))
+                        else:
+                            changes.add(item._summary_state, 1)
+                    changes.apply()
+                # bulk inserts skip save(), so tag parents are touched here
+                if model_class in (ProjectTag, LocationTag, SampleTag, ParameterTag):
+                    touch_parents(model_class._meta.get_field("parent").remote_field.model,
+                                  [item.parent_id for item in inserts])
+                n_saved += len(ready)
+                pending = waiting
+
+    # bulk inserts skip the signals that invalidate cached sample counts
+    if any(model_class in (Sample, SampleTag, Measurement) for model_class in groups):
+        invalidate_sample_counts()
+
+    return n_saved
+
+
+def preview_cache():
+    return caches[getattr(settings, "PYLIMS_PREVIEW_CACHE", "default")]
+
+
+def sample_count_cache():
+    return caches[getattr(settings, "PYLIMS_COUNT_CACHE", "default")]
+
+
+SAMPLE_COUNT_GENERATION_KEY = "pylims:sample_count:generation"
+
+
+def sample_count_generation():
+    """
+    Cached sample counts (see query_string_filter.count_samples()) include this
+    number in their key, so that incrementing it invalidates all of them
+    """
+    return sample_count_cache().get(SAMPLE_COUNT_GENERATION_KEY, 0)
+
+
+def invalidate_sample_counts(*args, **kwargs):
+    # called with the arguments of the post_save and post_delete signals (see apps.py)
+    if signal_updates_suspended():
+        return
+    cache = sample_count_cache()
+    try:
+        cache.incr(SAMPLE_COUNT_GENERATION_KEY)
+    except ValueError:
+        cache.set(SAMPLE_COUNT_GENERATION_KEY, 1, None)
+
+
 class DataImport(models.Model):
-    text = models.TextField()
+    NOT_APPLIED = ""
+    IN_PROGRESS = "in_progress"
+    FAILED = "failed"
+    APPLIED = "applied"
+    APPLY_STATUS_CHOICES = (
+        (NOT_APPLIED, "Not applied"),
+        (IN_PROGRESS, "In progress"),
+        (FAILED, "Failed"),
+        (APPLIED, "Applied")
+    )
+
+    text = CompressedTextField()
     applied = models.BooleanField(default=False, editable=False)
+    apply_status = models.CharField(max_length=55, choices=APPLY_STATUS_CHOICES, default=NOT_APPLIED,
+                                    blank=True, editable=False)
+    apply_error = models.TextField(blank=True, editable=False)
+    # the number of importer objects that have been committed by save_import(commit_every=N)
+    checkpoint = models.IntegerField(default=0, editable=False)
     driver = models.CharField(max_length=255, default="csv_import")
     args = TagsField()
     description = models.TextField(blank=True)
+    content_hash = models.CharField(max_length=40, blank=True, editable=False)
 
     user = models.ForeignKey(User, on_delete=models.PROTECT, null=True, blank=True, editable=False)
     created = models.DateTimeField("created", auto_now_add=True)
@@ -297,24 +1331,159 @@ class DataImport(models.Model):
     def as_json(self):
         return pretty_json(self)
 
+    def clean_fields(self, exclude=None):
+        # compressed text (e.g., of an uploaded file) is validated by running the importer,
+        # not by decompressing it here
+        if isinstance(self.__dict__.get("text"), CompressedText):
+            exclude = list(exclude or []) + ["text"]
+        super(DataImport, self).clean_fields(exclude)
+
     def full_clean(self, *args, **kwargs):
         super(DataImport, self).full_clean(*args, **kwargs)
         # if import is not yet applied, test running it as part of full_clean
-        if not self.applied:
-            self.run_import()
+        # (unless the same text, driver, and args have already been validated)
+        if not self.applied and not preview_cache().get(self._cache_key("valid")):
+            for chunk in self.iter_import():
+                pass
+            preview_cache().set(self._cache_key("valid"), True, self._cache_timeout())
 
     def save(self, *args, **kwargs):
+        # previews of the old text, driver, or args are no longer needed
+        content_hash = self.get_content_hash()
+        if self.content_hash and self.content_hash != content_hash:
+            self.clear_preview_cache(self.content_hash)
+        self.content_hash = content_hash
         # save self
         super(DataImport, self).save(*args, **kwargs)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(DataImport, cls).from_db(db, field_names, values)
+        # the stored hash is reused until the text, driver, or args change
+        # (the text is compared by identity, so that it is not decompressed)
+        if all(name in instance.__dict__ for name in ("driver", "args", "content_hash")) and \
+                instance.content_hash:
+            instance._hashed = (instance.driver, instance.args, instance.__dict__.get("text", models.DEFERRED),
+                                instance.content_hash)
+        return instance
+
+    def get_content_hash(self):
+        """
+        Hash of the inputs to the importer, used to cache previews
+        """
+        hashed = getattr(self, "_hashed", None)
+        text = self.__dict__.get("text", models.DEFERRED)
+        if hashed is not None and hashed[:2] == (self.driver, self.args) and text is hashed[2]:
+            return hashed[3]
+
+        # the text is hashed as it is decompressed, a piece at a time
+        content_hash = hashlib.sha1(("%s\0%s\0" % (self.driver, self.args)).encode("utf-8"))
+        raw_text = DataImport.text.raw(self)
+        if isinstance(raw_text, CompressedText):
+            for chunk in raw_text.byte_chunks():
+                content_hash.update(chunk)
+        else:
+            content_hash.update(str(raw_text).encode("utf-8"))
+        self._hashed = (self.driver, self.args, raw_text, content_hash.hexdigest())
+        return self._hashed[3]
+
+    def _cache_key(self, name, content_hash=None):
+        return "pylims:data_import:%s:%s" % (content_hash or self.get_content_hash(), name)
+
+    def _attach(self, items, data_import, user):
+        # previews are cached without this import (and its text) or its user
+        for item in items:
+            if hasattr(item, "data_import"):
+                item.data_import = data_import
+            if hasattr(item, "user"):
+                item.user = user
+
+    @staticmethod
+    def _cache_timeout():
+        return getattr(settings, "PYLIMS_PREVIEW_CACHE_TIMEOUT", 60 * 60 * 24)
+
+    def clear_preview_cache(self, content_hash=None):
+        cache = preview_cache()
+        previews = cache.get(self._cache_key("previews", content_hash), [])
+        keys = [self._cache_key(name, content_hash) for name in ["valid", "previews"]]
+        keys += [self._cache_key("preview:%s" % n, content_hash) for n in previews]
+        cache.delete_many(keys)
+
+    def preview(self, n_samples=100):
+        """
+        Run the importer until n_samples samples have been validated. Results are
+        cached using the hash of the text, driver, and args, so repeated previews
+        of the same import do not run the importer.
+        :param n_samples: The maximum number of samples to preview
+        :return: A tuple of the validated objects and whether more samples were available
+        """
+        cache = preview_cache()
+        key = self._cache_key("preview:%s" % n_samples)
+        cached = cache.get(key)
+        if cached is not None:
+            self._attach(cached[0], self, self.user)
+            return cached
+
+        result = []
+        samples_seen = 0
+        for chunk in self.iter_import(chunk_size=n_samples):
+            for item in chunk:
+                if isinstance(item, Sample):
+                    samples_seen += 1
+                if samples_seen > n_samples:
+                    break
+                result.append(item)
+            if samples_seen > n_samples:
+                break
+
+        preview = (result, samples_seen > n_samples)
+        self._attach(result, None, None)
+        cache.set(key, preview, self._cache_timeout())
+        self._attach(result, self, self.user)
+        # keep track of cached previews so that they can be deleted
+        previews = cache.get(self._cache_key("previews"), [])
+        if n_samples not in previews:
+            cache.set(self._cache_key("previews"), previews + [n_samples], self._cache_timeout())
+        return preview
+
     def run_import(self):
+        """
+        Runs the importer and returns a list of validated (unsaved) objects
+        """
+        return [item for chunk in self.iter_import() for item in chunk]
+
+    def iter_import(self, chunk_size=1000, skip=0):
+        """
+        Runs the importer and yields the validated (unsaved) objects it returns
+        in lists of up to chunk_size objects, so that importers that generate
+        objects lazily never have the whole result in memory. Importers that
+        validate objects themselves can set obj._pylims_cleaned = True to skip
+        full_clean(). A chunk may be longer than chunk_size so that objects
+        referring to unsaved objects (e.g., tags) are in the same chunk as those
+        objects. The first skip objects are not validated or yielded.
+
+        If the import args contain match_on (a list of field names of the row model),
+        objects are matched to existing objects (see data_import.NaturalKeyMatcher).
+        Matched objects have the primary key of the existing object, and objects that
+        would not change are marked with _pylims_unchanged = True.
+        """
 
         # raise error if import is already applied
         if self.applied:
             raise ValidationError("This import has already been applied")
 
+        # get the import function
+        import_fun = data_import.resolve_function(self.driver)
+        if not import_fun:
+            raise ValidationError("No import function could be found for driver: %s" % self.driver)
+
+        return self._iter_import(import_fun, chunk_size, skip)
+
+    def _iter_import(self, import_fun, chunk_size, skip):
         # get args as a dict
         import_args = TagsField.parse(self.args, dict)
+        # match_on is used to match rows to existing objects, not by the importer
+        match_on = import_args.pop("match_on", None)
         # get import function
         model_objects = {
             "Project": Project,
@@ -328,16 +1497,16 @@ class DataImport(models.Model):
             "Measurement": Measurement
         }
 
-        # get the import function
-        import_fun = data_import.resolve_function(self.driver)
-        if not import_fun:
-            raise ValidationError("No import function could be found for driver: %s" % self.driver)
         try:
             # execute import function
-            result = import_fun(self.text, models=model_objects, **import_args)
+            # streaming importers read the stored text as it is decompressed
+            text = DataImport.text.raw(self)
+            if not (getattr(import_fun, "pylims_streaming", False) and isinstance(text, CompressedText)):
+                text = self.text
+            result = import_fun(text, models=model_objects, **import_args)
 
             # check for empty result
-            if not result:
+            if result is None:
                 raise ValidationError("Nothing to import from data")
 
             # check for iterable result
@@ -350,56 +1519,236 @@ class DataImport(models.Model):
                 has_full_clean = hasattr(item, "full_clean") and callable(item.full_clean)
                 return has_save and has_full_clean
 
+            # match rows to existing objects if a natural key was given
+            if match_on:
+                matcher = data_import.NaturalKeyMatcher(model_objects, import_args.get("row_model", "Sample"),
+                                                        match_on)
+            else:
+                matcher = None
+
             # run clean() on each object, set the slug for samples
+            slug_allocator = SlugAllocator()
+            n_items = 0
+            chunk = []
             for item in result:
-                item.full_clean(exclude=('parent', ))
-                if isinstance(item, Sample):
-                    item.set_slug()
+                if not valid_item(item):
+                    raise ValidationError("Invalid objects were returned at positions %s" % n_items)
+
+                # skip objects that were committed by a previous partial application
+                if n_items < skip:
+                    n_items += 1
+                    continue
+
+                if not getattr(item, "_pylims_cleaned", False):
+                    item.full_clean(exclude=('parent', ))
                 if hasattr(item, "user"):
                     item.user = self.user
                 if hasattr(item, "data_import"):
                     item.data_import = self
+                if isinstance(item, Sample):
+                    item.set_slug(slug_allocator)
+
+                # only start a new chunk at an object that does not refer to an unsaved object,
+                # so that objects are never separated from their tags and measurements
+                if len(chunk) >= chunk_size and not _refresh_foreign_keys(item):
+                    if matcher is not None:
+                        matcher.match(chunk)
+                    yield chunk
+                    chunk = []
+                n_items += 1
+                chunk.append(item)
+
+            if chunk:
+                if matcher is not None:
+                    matcher.match(chunk)
+                yield chunk
+            elif n_items == 0:
+                raise ValidationError("Nothing to import from data")
 
-            invalid_objects = [str(i) for i in range(len(result)) if not valid_item(result[i])]
-            if invalid_objects:
-                raise ValidationError("Invalid objects were returned at positions %s" % ", ".join(invalid_objects))
-
-            return result
         except Exception as e:
             raise ValidationError("Import failed with %s: %s" % (type(e).__name__, e))
 
-    def apply_import(self, save=False):
+    def apply_import(self, save=False, bulk=None, batch_size=500, chunk_size=5000, progress=None,
+                     commit_every=None):
         """
         This applies the result (or tests the application of the result
-        if save=False) to the database
+        if save=False) to the database and returns the list of validated
+        objects. If save=True, the objects are saved as in save_import(),
+        which should be used for large imports, since it does not keep
+        every object in memory.
         """
 
         # raise error if import is already applied
         if self.applied:
             raise ValidationError("This import has already been applied")
 
-        # run the importer
-        result = self.run_import()
+        # preview: return the result without saving
+        if not save:
+            return self.run_import()
+
+        result = []
+        self._save_import(bulk, batch_size, chunk_size, progress, commit_every, result)
+        return result
+
+    def save_import(self, bulk=None, batch_size=500, chunk_size=5000, progress=None, commit_every=None):
+        """
+        Validate and save the importer result chunk_size objects at a time and
+        return the number of objects saved. With bulk=True, objects are inserted
+        with multi-row inserts of up to batch_size objects (see bulk_save())
+        instead of one save() per object. By default, bulk is True for importers
+        registered with bulk=True (e.g., wide_csv_import). progress is called with
+        the number of objects saved so far after each chunk.
+
+        By default, the whole import is saved in one transaction. With commit_every=N,
+        every N objects are committed in their own transaction and recorded in
+        checkpoint, so that an import that fails part way through can be fixed and
+        applied again starting after the last committed object. The applied flag is
+        only set once every object has been committed.
+
+        Instead of a version of every object, the IDs of created objects and the
+        previous values of updated objects are recorded in a DataImportChangeset,
+        which can be used to revert the import (see revert_import()).
+        """
 
-        # save if requested
-        if save:
-            with reversion.create_revision():
-                # Store some meta-information.
-                reversion.set_user(self.user)
-                reversion.set_comment("Applied data import: %s" % self)
+        # raise error if import is already applied
+        if self.applied:
+            raise ValidationError("This import has already been applied")
 
-                for item in result:
-                    # reset parent objects so that parent IDs get added properly
-                    if hasattr(item, "parent"):
-                        item.parent = item.parent
+        return self._save_import(bulk, batch_size, chunk_size, progress, commit_every)
+
+    def _save_import(self, bulk, batch_size, chunk_size, progress, commit_every, result=None):
+        # objects are added to result (if it is a list) as they are saved
+        if bulk is None:
+            bulk = getattr(data_import.resolve_function(self.driver), "pylims_bulk", False)
+        if commit_every:
+            return self._apply_checkpointed(bulk, batch_size, commit_every, progress, result)
+
+        with transaction.atomic():
+            # another process applying this import waits until this one is done
+            if self._lock()[0]:
+                raise ValidationError("This import has already been applied")
+            changeset, created = DataImportChangeset.objects.get_or_create(data_import=self)
+
+            n_saved = 0
+            for chunk in self.iter_import(chunk_size=chunk_size, skip=self.checkpoint):
+                n_saved += self._save_chunk(chunk, bulk, batch_size, changeset, result)
+                if progress is not None:
+                    progress(n_saved)
+            changeset.save()
+
+            # set the applied flag to "True", save self
+            self.applied = True
+            self.apply_status = self.APPLIED
+            self.save()
+
+        return n_saved
+
+    def _apply_checkpointed(self, bulk, batch_size, commit_every, progress, result=None):
+        self.apply_status = self.IN_PROGRESS
+        self.apply_error = ""
+        self.save()
+
+        n_saved = 0
+        try:
+            changeset, created = DataImportChangeset.objects.get_or_create(data_import=self)
+            for chunk in self.iter_import(chunk_size=commit_every, skip=self.checkpoint):
+                with transaction.atomic():
+                    # a chunk is only committed if no other process (e.g., a job started after
+                    # this one was failed as stale) has committed chunks in the meantime
+                    applied, checkpoint = self._lock()
+                    if applied or checkpoint != self.checkpoint:
+                        raise ValidationError("This import is being applied by another process")
+                    n_saved += self._save_chunk(chunk, bulk, batch_size, changeset, result)
+                    changeset.save()
+                    DataImport.objects.filter(pk=self.pk).update(checkpoint=self.checkpoint + len(chunk))
+                self.checkpoint += len(chunk)
+                if progress is not None:
+                    progress(n_saved)
+        except Exception as e:
+            self.apply_status = self.FAILED
+            self.apply_error = str(e)
+            # the failure is not recorded if another process has committed chunks since
+            DataImport.objects.filter(pk=self.pk, applied=False, checkpoint=self.checkpoint)\
+                .update(apply_status=self.apply_status, apply_error=self.apply_error)
+            raise
+
+        # set the applied flag to "True", save self
+        self.applied = True
+        self.apply_status = self.APPLIED
+        self.save()
+        return n_saved
+
+    def _lock(self):
+        # lock the row of this import until the end of the transaction
+        return DataImport.objects.select_for_update().filter(pk=self.pk).values_list("applied", "checkpoint").get()
+
+    def _save_chunk(self, chunk, bulk, batch_size, changeset, result=None):
+        if result is not None:
+            result.extend(chunk)
+        # objects matched to an existing object that would not change are skipped
+        chunk = [item for item in chunk if not getattr(item, "_pylims_unchanged", False)]
+        inserted = [item for item in chunk if item._state.adding]
+        updated = [item for item in chunk if not item._state.adding]
+
+        if bulk:
+            # objects were cleaned by iter_import(); parent IDs are set by bulk_save()
+            n_saved = bulk_save(chunk, batch_size=batch_size)
+        else:
+            with coalesce_parent_updates():
+                for item in chunk:
+                    # reset parent (and other related) objects so that their IDs get added properly
+                    _refresh_foreign_keys(item)
                     item.full_clean()
                     item.save()
+            n_saved = len(chunk)
 
-                # set the applied flag to "True", save self
-                self.applied = True
+        changeset.record(self, inserted, updated)
+        return n_saved
+
+    def revert_import(self):
+        """
+        Revert an applied (or partially applied) import using its changeset:
+        updated objects get their previous values back and created objects are
+        deleted. The import can then be applied again.
+        """
+        try:
+            changeset = self.dataimportchangeset
+        except ObjectDoesNotExist:
+            raise ValidationError("There are no changes to revert for this import")
+
+        try:
+            with transaction.atomic():
+                changeset.revert()
+                changeset.delete()
+                # the deleted changeset is no longer cached, so reverting again raises ValidationError
+                self.dataimportchangeset = None
+                self.applied = False
+                self.apply_status = self.NOT_APPLIED
+                self.apply_error = ""
+                self.checkpoint = 0
                 self.save()
+        except models.ProtectedError as e:
+            raise ValidationError("Could not revert import: %s" % e.args[0])
 
-        return result
+    def queue_job(self, action="apply", user=None):
+        """
+        Queue this import to be previewed or applied by a worker process
+        (see the pylims_worker management command). A job that is already
+        queued or running for the same action is returned instead of a new one
+        (unless its worker stopped responding, see DataImportJob.fail_stale_jobs()).
+        """
+        DataImportJob.fail_stale_jobs()
+        active = self.dataimportjob_set.filter(action=action,
+                                               status__in=(DataImportJob.QUEUED, DataImportJob.RUNNING))
+        job = active.order_by('-created').first()
+        if job is None:
+            job = DataImportJob(data_import=self, action=action, user=user)
+            job.full_clean()
+            job.save()
+        return job
+
+    def latest_job(self):
+        return self.dataimportjob_set.order_by('-created').first()
 
     def __str__(self):
         return "Data Import: %s" % self.pk
@@ -409,3 +1758,314 @@ class DataImportTag(models.Model):
     parent = models.ForeignKey(DataImport, on_delete=models.CASCADE)
     key = models.SlugField(max_length=55)
     value = models.TextField(blank=False)
+
+
+def _extend_ranges(ranges, ids):
+    # IDs are stored as [first, last] ranges, which are short for bulk inserts
+    for pk in sorted(ids):
+        if ranges and ranges[-1][0] <= pk <= ranges[-1][1]:
+            continue
+        elif ranges and pk == ranges[-1][1] + 1:
+            ranges[-1][1] = pk
+        else:
+            ranges.append([pk, pk])
+    return ranges
+
+
+class ExactJSONEncoder(DjangoJSONEncoder):
+    # DjangoJSONEncoder rounds times to milliseconds, so restored or compared values would differ
+    def default(self, o):
+        if isinstance(o, (datetime.datetime, datetime.time)):
+            return o.isoformat()
+        return super(ExactJSONEncoder, self).default(o)
+
+
+class DataImportChangeset(models.Model):
+    """
+    A compact record of the changes made by applying a DataImport: the IDs of
+    created objects (as ranges) and the previous values of updated objects, by model
+    name. This is used to revert an import as a unit instead of recording a
+    version of every imported object.
+    """
+    data_import = models.OneToOneField(DataImport, on_delete=models.CASCADE)
+    changes = CompressedTextField(blank=True, editable=False)
+
+    created = models.DateTimeField("created", auto_now_add=True)
+    modified = models.DateTimeField("modified", auto_now=True)
+
+    def get_changes(self):
+        if not hasattr(self, "_changes"):
+            changes = TagsField.parse(self.changes, dict)
+            changes.setdefault("created", {})
+            changes.setdefault("updated", {})
+            self._changes = changes
+        return self._changes
+
+    def save(self, *args, **kwargs):
+        if hasattr(self, "_changes"):
+            self.changes = json.dumps(self._changes, cls=ExactJSONEncoder)
+        super(DataImportChangeset, self).save(*args, **kwargs)
+
+    def record(self, data_import, inserted, updated):
+        """
+        Record objects saved by data_import (call save() to store the changes)
+        :param data_import: The DataImport that saved the objects
+        :param inserted: A list of objects that were inserted
+        :param updated: A list of existing objects that were updated
+        """
+        changes = self.get_changes()
+        for item in updated:
+            previous = changes["updated"].setdefault(type(item).__name__, {})
+            # the first recorded values are the ones from before the import
+            previous.setdefault(str(item.pk), getattr(item, "_pylims_previous", {}))
+
+        by_class = OrderedDict()
+        for item in inserted:
+            by_class.setdefault(type(item), []).append(item)
+
+        for model_class, objects in by_class.items():
+            name = model_class.__name__
+            ranges = changes["created"].setdefault(name, [])
+            ids = {item.pk for item in objects if item.pk is not None}
+            if len(ids) < len(objects):
+                # backends that cannot return IDs from bulk inserts leave pk as None;
+                # new IDs are higher than the ones recorded for previous chunks
+                last = max([last for first, last in ranges] or [0])
+                updated_ids = set(changes["updated"].get(name, {}))
+                for pk in model_class.objects.filter(data_import=data_import, pk__gt=last)\
+                        .values_list('pk', flat=True):
+                    if str(pk) not in updated_ids:
+                        ids.add(pk)
+            _extend_ranges(ranges, ids)
+
+    def revert(self):
+        """
+        Restore the previous values of updated objects and delete created objects
+        """
+        with suspend_signal_updates():
+            self._revert()
+        invalidate_sample_counts()
+
+    def _revert(self):
+        changes = self.get_changes()
+        apps = self._meta.apps
+
+        # measurement summaries are updated with aggregates instead of by the signal receivers:
+        # created measurements are uncounted, and measurements that are restored or whose sample
+        # is moved back to another project or location are uncounted and counted again
+        summary_changes = SummaryChanges()
+        for queryset in self._created_objects(Measurement):
+            self._add_summary_totals(summary_changes, queryset, -1)
+        restored_ids = self._restored_measurement_ids()
+        for start in range(0, len(restored_ids), 500):
+            queryset = Measurement.objects.filter(pk__in=restored_ids[start:start + 500])
+            self._add_summary_totals(summary_changes, queryset, -1)
+
+        for name, previous in changes["updated"].items():
+            model_class = apps.get_model(self._meta.app_label, name)
+            for pk, values in previous.items():
+                if model_class is Measurement and "value" in values:
+                    values = dict(values)
+                    values["numeric_value"], values["non_numeric"] = Measurement.parse_numeric(values["value"])
+                if values:
+                    model_class.objects.filter(pk=int(pk)).update(**values)
+
+        for start in range(0, len(restored_ids), 500):
+            queryset = Measurement.objects.filter(pk__in=restored_ids[start:start + 500])
+            self._add_summary_totals(summary_changes, queryset, 1)
+
+        # objects are deleted in the reverse of the order they were inserted
+        def order(name):
+            return BULK_SAVE_ORDER.index(name) if name in BULK_SAVE_ORDER else len(BULK_SAVE_ORDER)
+
+        names = sorted(changes["created"], key=order, reverse=True)
+        for name in names:
+            # references between created objects (e.g. sub-samples) would protect them from deletion
+            model_class = apps.get_model(self._meta.app_label, name)
+            if any(field.name == "parent" and field.remote_field.model is model_class
+                   for field in model_class._meta.concrete_fields):
+                for queryset in self._created_objects(model_class):
+                    queryset.update(parent=None)
+
+        for name in names:
+            model_class = apps.get_model(self._meta.app_label, name)
+            for queryset in self._created_objects(model_class):
+                queryset.delete()
+        # applied once created measurements are gone, since a removed min or max is recalculated
+        summary_changes.apply()
+
+        # restored parents are not indexed by save()
+        for name, previous in changes["updated"].items():
+            model_class = apps.get_model(self._meta.app_label, name)
+            if issubclass(model_class, HierarchyModel) and any("parent_id" in values for values in previous.values()):
+                rebuild_closures(model_class)
+
+    @staticmethod
+    def _add_summary_totals(summary_changes, measurements, sign):
+        totals = measurements.order_by().values("param_id", "sample__project_id", "sample__location_id")\
+            .annotate(**_summary_aggregates())
+        for row in totals:
+            summary_changes.add_totals(row["param_id"], (row["sample__project_id"], row["sample__location_id"]),
+                                       row, sign)
+
+    def _restored_measurement_ids(self):
+        # existing measurements whose summary group or value changes when updates are reverted
+        changes = self.get_changes()
+        ids = {int(pk) for pk, values in changes["updated"].get("Measurement", {}).items() if values}
+        moved_samples = [int(pk) for pk, values in changes["updated"].get("Sample", {}).items()
+                         if "project_id" in values or "location_id" in values]
+        for start in range(0, len(moved_samples), 500):
+            ids.update(Measurement.objects.filter(sample_id__in=moved_samples[start:start + 500])
+                       .values_list("pk", flat=True))
+
+        created = changes["created"].get("Measurement", [])
+        return sorted(pk for pk in ids if not any(first <= pk <= last for first, last in created))
+
+    def _created_objects(self, model_class, n_ranges=200):
+        # querysets selecting created objects by ID range, n_ranges ranges per query
+        ranges = self.get_changes()["created"].get(model_class.__name__, [])
+        for start in range(0, len(ranges), n_ranges):
+            condition = models.Q()
+            for first, last in ranges[start:start + n_ranges]:
+                condition |= models.Q(pk__gte=first, pk__lte=last)
+            yield model_class.objects.filter(condition, data_import=self.data_import)
+
+    def __str__(self):
+        return "Changes from %s" % self.data_import
+
+
+class DataImportJob(models.Model):
+    """
+    A queued preview or application of a DataImport, run by the pylims_worker
+    management command outside of the request/response cycle
+    """
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    STATUS_CHOICES = (
+        (QUEUED, "Queued"),
+        (RUNNING, "Running"),
+        (DONE, "Done"),
+        (FAILED, "Failed")
+    )
+
+    PREVIEW = "preview"
+    APPLY = "apply"
+    ACTION_CHOICES = (
+        (PREVIEW, "Preview"),
+        (APPLY, "Apply")
+    )
+
+    data_import = models.ForeignKey(DataImport, on_delete=models.CASCADE)
+    action = models.CharField(max_length=55, choices=ACTION_CHOICES, default=APPLY)
+    status = models.CharField(max_length=55, choices=STATUS_CHOICES, default=QUEUED)
+    objects_processed = models.IntegerField(default=0)
+    message = models.TextField(blank=True)
+    worker = models.CharField(max_length=255, blank=True)
+
+    user = models.ForeignKey(User, on_delete=models.PROTECT, null=True, blank=True, editable=False)
+    created = models.DateTimeField("created", auto_now_add=True)
+    started = models.DateTimeField("started", null=True, blank=True)
+    finished = models.DateTimeField("finished", null=True, blank=True)
+    # updated by the worker whenever progress is reported
+    heartbeat = models.DateTimeField("heartbeat", null=True, blank=True, editable=False)
+
+    # apply jobs commit (and report progress) every commit_every objects
+    commit_every = 5000
+    # apply jobs insert objects using multi-row inserts (see bulk_save())
+    bulk = True
+
+    @classmethod
+    def stale_after(cls):
+        # seconds without a heartbeat after which a running job's worker is assumed to have died
+        return getattr(settings, "PYLIMS_JOB_STALE_AFTER", 60 * 30)
+
+    @classmethod
+    def fail_stale_jobs(cls):
+        """
+        Mark running jobs whose worker stopped reporting progress (e.g., because it
+        was killed) as failed, so that the import can be queued again. Applying it
+        again continues after the last committed object (see DataImport.checkpoint).
+        If the worker was only slow, its next chunk is rolled back instead of being
+        committed twice (see DataImport.save_import()).
+        :return: The number of jobs that were failed
+        """
+        now = timezone.now()
+        cutoff = now - datetime.timedelta(seconds=cls.stale_after())
+        # jobs started before heartbeats were recorded only have a start time
+        stale = models.Q(heartbeat__lt=cutoff) | models.Q(heartbeat__isnull=True, started__lt=cutoff)
+        return cls.objects.filter(stale, status=cls.RUNNING)\
+            .update(status=cls.FAILED, finished=now, message="The worker running this job stopped responding")
+
+    @classmethod
+    def claim_next(cls, worker):
+        """
+        Claim the oldest queued job for worker. The status is changed using a
+        conditional UPDATE, so a job is only ever claimed by one worker. Jobs are
+        not claimed while another job for the same import is running, and the
+        DataImport row is locked while checking, so that two workers never
+        start jobs for the same import at the same time.
+        :param worker: A name identifying the worker
+        :return: A DataImportJob or None if the queue is empty
+        """
+        cls.fail_stale_jobs()
+        queued = cls.objects.filter(status=cls.QUEUED).order_by('created')
+        for job_id, data_import_id in queued.values_list('pk', 'data_import_id')[:10]:
+            with transaction.atomic():
+                list(DataImport.objects.select_for_update().filter(pk=data_import_id).values_list('pk'))
+                if cls.objects.filter(data_import_id=data_import_id, status=cls.RUNNING).exists():
+                    continue
+                now = timezone.now()
+                n_claimed = cls.objects.filter(pk=job_id, status=cls.QUEUED)\
+                    .update(status=cls.RUNNING, worker=worker, started=now, heartbeat=now)
+            if n_claimed:
+                return cls.objects.get(pk=job_id)
+        return None
+
+    def set_progress(self, objects_processed):
+        self.objects_processed = objects_processed
+        self.heartbeat = timezone.now()
+        DataImportJob.objects.filter(pk=self.pk).update(objects_processed=objects_processed,
+                                                        heartbeat=self.heartbeat)
+
+    def run(self):
+        """
+        Run the job, recording its outcome in status and message
+        """
+        try:
+            if self.action == self.APPLY:
+                n_saved = self.data_import.save_import(bulk=self.bulk, progress=self.set_progress,
+                                                       commit_every=self.commit_every)
+                self.message = "Imported %s objects" % n_saved
+            else:
+                n_items = 0
+                for chunk in self.data_import.iter_import():
+                    n_items += len(chunk)
+                    self.set_progress(n_items)
+                self.message = "Validated %s objects" % n_items
+                preview_cache().set(self.data_import._cache_key("valid"), True,
+                                    self.data_import._cache_timeout())
+            self.status = self.DONE
+        except Exception as e:
+            self.status = self.FAILED
+            self.message = str(e)
+
+        self.finished = timezone.now()
+        self.save()
+
+    def as_dict(self):
+        return {
+            "id": self.pk,
+            "data_import": self.data_import_id,
+            "action": self.action,
+            "status": self.status,
+            "objects_processed": self.objects_processed,
+            "message": self.message,
+            "created": self.created.isoformat() if self.created else None,
+            "started": self.started.isoformat() if self.started else None,
+            "finished": self.finished.isoformat() if self.finished else None
+        }
+
+    def __str__(self):
+        return "%s %s: %s" % (self.data_import, self.action, self.status)
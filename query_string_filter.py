@@ -1,7 +1,154 @@
 
 import re
+import json
+import math
+import hashlib
+import base64
+import binascii
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import Prefetch, F, Q, Exists, OuterRef
+from django.core.exceptions import FieldDoesNotExist
+
+from . import models
 
 TAG_QUERY_KEY = re.compile(r"^tag_(.*)$")
+VALUE_QUERY_KEY = re.compile(r"^value_(min|max)_(.*)$")
+
+
+def eager_load_samples(queryset):
+    """
+    Load everything sample_table.html shows for each sample (user, project,
+    location, tags, measurements and their parameters) using a fixed number
+    of queries, no matter how many samples there are
+    :param queryset: A queryset of samples
+    :return: The queryset with select_related() and prefetch_related() applied
+    """
+    measurements = models.Measurement.objects.select_related("param")
+    return queryset.select_related("user", "project", "location")\
+        .prefetch_related("sampletag_set", Prefetch("measurement_set", queryset=measurements))
+
+
+def filter_exists(queryset, subquery, exists=True):
+    """
+    Filter queryset using a correlated EXISTS (or NOT EXISTS) subquery. Unlike
+    filtering across a relation, this never returns an object more than once.
+    :param queryset: A queryset
+    :param subquery: A queryset referring to the outer queryset using OuterRef()
+    :param exists: Use False to keep objects for which subquery is empty
+    :return: The filtered queryset
+    """
+    # the subquery is annotated and then filtered, since filter(Exists()) needs Django 3.0
+    name = "_exists_%s" % len(queryset.query.annotations)
+    return queryset.annotate(**{name: Exists(subquery.values("pk"))}).filter(**{name: exists})
+
+
+def _descendant_ids(model_class, lookup, values, include_self=True):
+    # a subquery of the IDs of the objects matching lookup and all of their descendants
+    links = model_class.closure_model().objects.filter(**{"ancestor__" + lookup: values})
+    if not include_self:
+        links = links.filter(depth__gt=0)
+    return links.values("descendant_id")
+
+
+def filter_samples(queryset, q):
+    """
+    Apply the filters of filter_sample_table() (but not ordering or pagination)
+    :param queryset: The queryset of samples to filter
+    :param q: A QueryDict of query parameters
+    :return: The filtered queryset
+    """
+
+    # Date/times:
+    if q.get("created_start"):
+        queryset = queryset.filter(created__gte=q["created_start"])
+
+    if q.get("collected_start"):
+        queryset = queryset.filter(collected__gte=q["collected_start"])
+
+    if q.get("modified_start"):
+        queryset = queryset.filter(modified__gte=q["modified_start"])
+
+    if q.get("created_end"):
+        queryset = queryset.filter(created__lte=q["created_end"])
+
+    if q.get("collected_end"):
+        queryset = queryset.filter(collected__lte=q["collected_end"])
+
+    if q.get("modified_end"):
+        queryset = queryset.filter(modified__lte=q["modified_end"])
+
+    # sub-projects, sub-locations and sub-samples are matched using the closure tables
+    include_descendants = q.get("include_descendants", "").lower() in ("1", "true", "yes", "on")
+
+    # Projects (can pass multiple IDs/slugs
+    for key, lookup in (("project_slug", "slug__in"), ("project_id", "id__in")):
+        values = q.getlist(key)
+        if values and include_descendants:
+            queryset = queryset.filter(project__in=_descendant_ids(models.Project, lookup, values))
+        elif values:
+            queryset = queryset.filter(**{"project__" + lookup: values})
+
+    # Locations (can pass multiple IDs/slugs
+    for key, lookup in (("location_slug", "slug__in"), ("location_id", "id__in")):
+        values = q.getlist(key)
+        if values and include_descendants:
+            queryset = queryset.filter(location__in=_descendant_ids(models.Location, lookup, values))
+        elif values:
+            queryset = queryset.filter(**{"location__" + lookup: values})
+
+    # Parent samples (can pass multiple IDs/slugs
+    for key, lookup in (("sample_slug", "slug__in"), ("sample_id", "id__in")):
+        values = q.getlist(key)
+        if values and include_descendants:
+            queryset = queryset.filter(pk__in=_descendant_ids(models.Sample, lookup, values, include_self=False))
+        elif values:
+            queryset = queryset.filter(**{"parent__" + lookup: values})
+
+    # Has measurement with parameter (can pass multiple IDs/slugs)
+    # measurement and tag filters use EXISTS subqueries so that samples are never duplicated
+    measurements = models.Measurement.objects.filter(sample=OuterRef("pk"))
+    param_slugs = q.getlist("param_slug")
+    if param_slugs:
+        queryset = filter_exists(queryset, measurements.filter(param__slug__in=param_slugs))
+    param_ids = q.getlist("param_id")
+    if param_ids:
+        queryset = filter_exists(queryset, measurements.filter(param__id__in=param_ids))
+
+    # Numeric value ranges (the min and max for a parameter apply to the same measurement)
+    value_ranges = {}
+    for key in q:
+        match = VALUE_QUERY_KEY.match(key)
+        if match and q.get(key):
+            bound, slug = match.groups()
+            # bounds that aren't finite numbers are ignored like empty ones
+            try:
+                value = float(q[key])
+            except ValueError:
+                continue
+            if math.isnan(value) or math.isinf(value):
+                continue
+            lookup = "numeric_value__gte" if bound == "min" else "numeric_value__lte"
+            value_ranges.setdefault(slug, {})[lookup] = value
+    for slug, bounds in sorted(value_ranges.items()):
+        queryset = filter_exists(queryset, measurements.filter(param__slug=slug, **bounds))
+
+    # Tags (can pass query param as anything like tag_*)
+    tags = models.SampleTag.objects.filter(parent=OuterRef("pk"))
+    tag_keys = [key for key in q if TAG_QUERY_KEY.match(key)]
+    for tag_key in tag_keys:
+        tag = TAG_QUERY_KEY.match(tag_key).group(1)
+        values = q.getlist(tag_key)
+        # if any value is '__exists__', just filter anything that has that tag
+        if any(value == "__exists__" for value in values):
+            queryset = filter_exists(queryset, tags.filter(key=tag))
+        elif any(value == "" for value in values):
+            queryset = filter_exists(queryset, tags.filter(key=tag), exists=False)
+        else:
+            queryset = filter_exists(queryset, tags.filter(key=tag, value__in=values))
+
+    return queryset
 
 
 def filter_sample_table(queryset, q):
@@ -27,6 +174,9 @@ def filter_sample_table(queryset, q):
     Parent samples:
     sample_slug = value (matches parent sample slug)
     sample_id = value (matches parent sample ID)
+
+    include_descendants = "true" (project, location and sample filters also match
+    sub-projects, sub-locations and all sub-samples)
     
     Has measurement with parameter:
     param_slug = value (has at least one measurement with param matching slug)
@@ -34,96 +184,292 @@ def filter_sample_table(queryset, q):
     
     Tags:
     tag_* = "" (tag * not defined), = "__exists__" (tag * is defined), = value (tag = value)
+
+    Numeric measurement values:
+    value_min_* = value (has a measurement of parameter * with a numeric value >= value)
+    value_max_* = value (has a measurement of parameter * with a numeric value <= value)
+    (values that are not numbers are ignored)
     
     Pagination and ordering
     n_samples = number of results to show on a page (>1)
     paged = number of pages in (>1)
+    after = cursor of the last sample on the previous page (see next_query)
+    before = cursor of the first sample on the next page (see prev_query)
     order_by = values passed to QuerySet.order_by()
+
+    Without paged, samples are paged using the after/before cursors, which select
+    samples relative to a sample's order_by values (and ID) instead of using OFFSET,
+    so that any page takes about the same time to fetch. Orderings that are not
+    fields (e.g., "?") are always paged using paged. The next_query and prev_query
+    context variables are the query strings of the next and previous pages.
+
+    The number of matching samples (sample_count) and pages (page_count) are cached
+    (see count_samples()).
     
     
     :param queryset: The quereyset of samples to filter
     :param request: The request with a GET attribute
     :return: A dictionary with additional context variables for the sample_table.html template
     """
+    base_queryset = queryset
+    queryset = filter_samples(queryset, q)
 
-    # Date/times:
-    if q.get("created_start"):
-        queryset = queryset.filter(created__gte=q["created_start"])
-
-    if q.get("collected_start"):
-        queryset = queryset.filter(collected__gte=q["collected_start"])
-
-    if q.get("modified_start"):
-        queryset = queryset.filter(modified__gte=q["modified_start"])
-
-    if q.get("created_end"):
-        queryset = queryset.filter(created__lte=q["created_end"])
-
-    if q.get("collected_end"):
-        queryset = queryset.filter(collected__lte=q["collected_end"])
-
-    if q.get("modified_end"):
-        queryset = queryset.filter(modified__lte=q["modified_end"])
-
-    # Projects (can pass multiple IDs/slugs
-    project_slugs = q.getlist("project_slug")
-    if project_slugs:
-        queryset = queryset.filter(project__slug__in=project_slugs)
-    project_ids = q.getlist("project_id")
-    if project_ids:
-        queryset = queryset.filter(project__id__in=project_ids)
+    # Number of results (cached)
+    sample_count, count_estimated = count_samples(queryset, count_key(base_queryset, q))
 
-    # Locations (can pass multiple IDs/slugs
-    location_slugs = q.getlist("location_slug")
-    if location_slugs:
-        queryset = queryset.filter(location__slug__in=location_slugs)
-    location_ids = q.getlist("location_id")
-    if location_ids:
-        queryset = queryset.filter(location__id__in=location_ids)
+    # Ordering
+    order_by = q.getlist("order_by", ['-modified'])
 
-    # Parent samples (can pass multiple IDs/slugs
-    sample_slugs = q.getlist("sample_slug")
-    if sample_slugs:
-        queryset = queryset.filter(parent__slug__in=sample_slugs)
-    sample_ids = q.getlist("sample_id")
-    if sample_ids:
-        queryset = queryset.filter(parent__id__in=sample_ids)
+    # Load related objects shown in the table
+    queryset = eager_load_samples(queryset)
 
-    # Has measurement with parameter (can pass multiple IDs/slugs)
-    param_slugs = q.getlist("param_slug")
-    if param_slugs:
-        queryset = queryset.filter(measurement__param__slug__in=param_slugs)
-    param_ids = q.getlist("param_id")
-    if param_ids:
-        queryset = queryset.filter(measurement__param__id__in=param_ids)
+    # Pagination
+    n_results_int = int(q.get("n_samples", "100"))
+    n_results = max(n_results_int, 1)  # make sure n_results is never negative
+    count_context = {
+        "sample_count": sample_count,
+        "count_estimated": count_estimated,
+        "page_count": max(int(math.ceil(sample_count / float(n_results))), 1)
+    }
 
-    # Tags (can pass query param as anything like tag_*)
-    tag_keys = [key for key in q if TAG_QUERY_KEY.match(key)]
-    for tag_key in tag_keys:
-        tag = TAG_QUERY_KEY.match(tag_key).group(1)
-        values = q.getlist(tag_key)
-        # if any value is '__exists__', just filter anything that has that tag
-        if any(value == "__exists__" for value in values):
-            queryset = queryset.filter(sampletag__key=tag)
-        elif any(value == "" for value in values):
-            queryset = queryset.exclude(sampletag__key=tag)
-        else:
-            queryset = queryset.filter(sampletag__key=tag, sampletag__value__in=values)
+    # orderings that are not fields (e.g., "?") are paged using OFFSET
+    cursor_keys = _cursor_keys(queryset.model, order_by)
+    if "paged" not in q and cursor_keys is not None:
+        context = _cursor_page(queryset, q, cursor_keys, n_results)
+        context.update(count_context)
+        return context
 
-    # Ordering
-    order_by = q.getlist("order_by", ['-modified'])
     if order_by:
         queryset = queryset.order_by(*order_by)
 
-    # Pagination
-    n_results_int = int(q.get("n_samples", "100"))
     paged_int = int(q.get("paged", "1"))
-
-    n_results = max(n_results_int, 1)  # make sure n_results is never negative
     paged = max(paged_int, 1)  # make sure paged is never negative
     start = n_results * (paged - 1)
     end = n_results * paged
     queryset = queryset[start:end]
 
+    def page_query(page):
+        page_q = q.copy()
+        for key in ("after", "before", "page"):
+            page_q.pop(key, None)
+        page_q["paged"] = page
+        return page_q.urlencode()
+
     # return the sample list and the query
-    return {"sample_list": queryset, "query": q}
+    context = {"sample_list": queryset, "query": q, "page_number": paged,
+               "next_query": page_query(paged + 1) if paged < count_context["page_count"] else None,
+               "prev_query": page_query(paged - 1) if paged > 1 else None}
+    context.update(count_context)
+    return context
+
+
+# query parameters that do not change which samples match
+PAGING_KEYS = ("n_samples", "paged", "page", "after", "before", "order_by")
+
+
+def count_key(queryset, q):
+    """
+    The cache key for the number of samples in queryset matching the filters
+    in q (ignoring paging and ordering parameters)
+    """
+    filters = sorted((key, sorted(q.getlist(key))) for key in q if key not in PAGING_KEYS)
+    key_json = json.dumps([str(queryset.query), filters])
+    return "pylims:sample_count:%s:%s" % (models.sample_count_generation(),
+                                          hashlib.sha1(key_json.encode("utf-8")).hexdigest())
+
+
+def count_samples(queryset, key):
+    """
+    Count the objects in queryset, using the count cached under key if there is one.
+    Cached counts are invalidated when a Sample, SampleTag or Measurement is saved
+    or deleted (see models.invalidate_sample_counts()); with more than one process
+    PYLIMS_COUNT_CACHE should be a shared cache. If PYLIMS_COUNT_ESTIMATE_THRESHOLD is
+    set and the database is PostgreSQL, the query planner's estimate is used instead
+    of COUNT(*) when it is above the threshold.
+    :return: A tuple of the count and whether it is an estimate
+    """
+    cache = models.sample_count_cache()
+    count = cache.get(key)
+    if count is None:
+        threshold = getattr(settings, "PYLIMS_COUNT_ESTIMATE_THRESHOLD", None)
+        estimate = estimate_count(queryset) if threshold is not None else None
+        if estimate is not None and estimate > threshold:
+            count = (estimate, True)
+        else:
+            count = (queryset.count(), False)
+        cache.set(key, count, getattr(settings, "PYLIMS_COUNT_CACHE_TIMEOUT", 60 * 60))
+    return count
+
+
+def estimate_count(queryset):
+    """
+    The query planner's estimate of the number of rows in queryset, or None if
+    the database does not provide one
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != "postgresql":
+        return None
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+def _cursor_keys(model, order_by):
+    """
+    The order_by fields, ending with the ID to make the order unique, or None if
+    an ordering is not a field (e.g., "?"), since cursors can't be used for these.
+    Relations are replaced by their ID (e.g., "project" by "project_id") so that
+    cursor values are never model instances.
+    """
+    keys = []
+    for key in order_by:
+        names = key.lstrip("-").split("__")
+        if names[-1] == "pk":
+            names[-1] = model._meta.pk.name if len(names) == 1 else "id"
+        related_model = model
+        for i, name in enumerate(names):
+            try:
+                field = related_model._meta.get_field(name)
+            except FieldDoesNotExist:
+                return None
+            if not field.concrete or field.many_to_many or field.one_to_many:
+                return None
+            if field.is_relation and i == len(names) - 1:
+                names[i] = field.attname
+            related_model = field.related_model
+        key = ("-" if key.startswith("-") else "") + "__".join(names)
+        keys.append(key)
+        if key.lstrip("-") == model._meta.pk.attname:
+            return keys
+    return keys + ["-id" if keys and keys[-1].startswith("-") else "id"]
+
+
+def _cursor_value(obj, key):
+    value = obj
+    for attr in key.lstrip("-").split("__"):
+        value = getattr(value, attr, None)
+        if value is None:
+            break
+    return value
+
+
+# DjangoJSONEncoder rounds times to milliseconds, which would skip rows
+CursorEncoder = models.ExactJSONEncoder
+
+
+def encode_cursor(obj, keys):
+    values = [_cursor_value(obj, key) for key in keys]
+    cursor_json = json.dumps([keys, values], cls=CursorEncoder)
+    return base64.urlsafe_b64encode(cursor_json.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor, keys):
+    """
+    Get the values of keys from a cursor, or None if the cursor is not
+    valid for keys (e.g., because the ordering changed)
+    """
+    try:
+        cursor_keys, values = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8"))
+    except (ValueError, TypeError, binascii.Error):
+        return None
+    if cursor_keys != keys or len(values) != len(keys):
+        return None
+    return values
+
+
+def _cursor_filter(model, keys, values, reverse=False):
+    """
+    A filter selecting rows after values in the order given by keys (or before
+    values if reverse=True). NULLs sort before other values (see _cursor_order()).
+    """
+    condition = Q(pk__in=[])
+    equal = Q()
+    for key, value in zip(keys, values):
+        field = key.lstrip("-")
+        ascending = key.startswith("-") == reverse
+        if value is None:
+            beyond = Q(**{field + "__isnull": False}) if ascending else Q(pk__in=[])
+            same = Q(**{field + "__isnull": True})
+        else:
+            beyond = Q(**{field + ("__gt" if ascending else "__lt"): value})
+            if not ascending and _nullable(model, key):
+                beyond |= Q(**{field + "__isnull": True})
+            same = Q(**{field: value})
+        condition |= equal & beyond
+        equal &= same
+
+    # a range on the first key lets the database start at the cursor using an index
+    field, value = keys[0].lstrip("-"), values[0]
+    if value is not None and not _nullable(model, keys[0]):
+        ascending = keys[0].startswith("-") == reverse
+        condition &= Q(**{field + ("__gte" if ascending else "__lte"): value})
+    return condition
+
+
+def _nullable(model, key):
+    # True if the value of a (possibly related) field can be NULL (see _cursor_keys())
+    for name in key.lstrip("-").split("__"):
+        field = model._meta.get_field(name[:-3] if name.endswith("_id") else name)
+        if field.null:
+            return True
+        model = field.related_model
+    return False
+
+
+def _cursor_order(model, keys, reverse=False):
+    order = []
+    for key in keys:
+        expression = F(key.lstrip("-"))
+        # NULLS FIRST/LAST is only used where needed, since it can prevent an index from being used
+        nulls = _nullable(model, key)
+        if key.startswith("-") == reverse:
+            order.append(expression.asc(nulls_first=True) if nulls else expression.asc())
+        else:
+            order.append(expression.desc(nulls_last=True) if nulls else expression.desc())
+    return order
+
+
+def _cursor_page(queryset, q, keys, n_results):
+    after = decode_cursor(q["after"], keys) if q.get("after") else None
+    before = decode_cursor(q["before"], keys) if q.get("before") and after is None else None
+
+    # one more sample than needed is fetched to find out if there is another page
+    if before is not None:
+        page = queryset.filter(_cursor_filter(queryset.model, keys, before, reverse=True)).order_by(*_cursor_order(queryset.model, keys, True))
+        sample_list = list(page[:n_results + 1])
+        has_prev = len(sample_list) > n_results
+        sample_list = sample_list[:n_results][::-1]
+        has_next = True
+    else:
+        if after is not None:
+            queryset = queryset.filter(_cursor_filter(queryset.model, keys, after))
+        sample_list = list(queryset.order_by(*_cursor_order(queryset.model, keys))[:n_results + 1])
+        has_next = len(sample_list) > n_results
+        sample_list = sample_list[:n_results]
+        has_prev = after is not None
+
+    # the page number is passed along so that it can be shown
+    try:
+        page_number = max(int(q.get("page", "1")), 1) if after is not None or before is not None else 1
+    except ValueError:
+        page_number = 1
+
+    def page_query(name, obj, page):
+        page_q = q.copy()
+        for key in ("after", "before", "paged"):
+            page_q.pop(key, None)
+        page_q[name] = encode_cursor(obj, keys)
+        page_q["page"] = page
+        return page_q.urlencode()
+
+    return {
+        "sample_list": sample_list,
+        "query": q,
+        "page_number": page_number,
+        "next_query": page_query("after", sample_list[-1], page_number + 1) if has_next and sample_list else None,
+        "prev_query": page_query("before", sample_list[0], page_number - 1) if has_prev and sample_list else None
+    }
@@ -1,6 +1,27 @@
-from django.test import TestCase
+import os
+import csv
+import json
+import datetime
+import tempfile
+import warnings
+from collections import OrderedDict
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import DatabaseError, connection, transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.http import QueryDict
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
 from .models import *
+from . import data_import, data_view, data_view_funcs, export, time_series
+from .management.commands import pylims_worker
+from .query_string_filter import filter_sample_table, filter_samples, count_samples, count_key
+from .benchmark import QueryCounter, run_benchmark
 import numpy as np
+from unittest import mock
 
 
 def create_base_data():
@@ -45,3 +66,1022 @@ def clear_db():
         location.delete()
     for project in Project.objects.all():
         project.delete()
+
+
+def summary_rows():
+    # the non-empty measurement summaries (rounded, since sums are updated incrementally)
+    return sorted((s.param_id, s.project_id or 0, s.location_id or 0, s.count, s.numeric_count,
+                   s.non_numeric_count, round(s.sum, 6), round(s.sum_squares, 6), s.min, s.max)
+                  for s in MeasurementSummary.objects.filter(count__gt=0))
+
+
+def rebuilt_summary_rows():
+    with transaction.atomic():
+        rebuild_measurement_summaries()
+        rows = summary_rows()
+        transaction.set_rollback(True)
+    return rows
+
+
+def closure_rows(model_class):
+    return sorted(model_class.closure_model().objects.values_list("ancestor_id", "descendant_id", "depth"))
+
+
+WIDE_CSV = "\n".join([
+    "name,location.slug,project.slug,collected,depth,ph,alk",
+    "Import 1,location1,fish,2017-01-01 10:00:00,1,7.1,20",
+    "Import 2,location1,fish,2017-01-01 10:00:00,2,7.2,<DL",
+    "Import 2,location1,fish,2017-01-01 10:00:00,2,7.3,21",
+    "Import 3,location2,,2017-01-02 10:00:00,3,,22",
+    "Import 4,,fish,2017-01-03 10:00:00,4,6.9,",
+])
+
+
+class BulkImportTest(TestCase):
+
+    def setUp(self):
+        create_base_data()
+        self.user = User.objects.create(username="importer")
+
+    def apply(self, bulk, text=WIDE_CSV, driver="wide_csv_import"):
+        # apply the import, describe the rows it created, then roll it back
+        with transaction.atomic():
+            data_import = DataImport(text=text, driver=driver, user=self.user)
+            data_import.save()
+            data_import.apply_import(save=True, bulk=bulk, batch_size=2, chunk_size=3)
+
+            samples = []
+            for sample in Sample.objects.filter(data_import=data_import).order_by("slug"):
+                tags = sorted((tag.key, tag.value, tag.parent_id == sample.pk)
+                              for tag in SampleTag.objects.filter(parent=sample))
+                measurements = sorted((m.param.slug, m.value, m.numeric_value, m.non_numeric, m.user_id,
+                                       m.data_import_id == data_import.pk)
+                                      for m in Measurement.objects.filter(sample=sample))
+                samples.append((sample.name, sample.slug, sample.collected, sample.project_id,
+                                sample.location_id, sample.parent_id, sample.user_id,
+                                sample.data_import_id == data_import.pk, tags, measurements))
+            result = (samples, closure_rows(Sample), summary_rows(), rebuilt_summary_rows())
+            transaction.set_rollback(True)
+        return result
+
+    def test_bulk_matches_save(self):
+        saved = self.apply(bulk=False)
+        bulk = self.apply(bulk=True)
+        self.assertEqual(len(saved[0]), 5)
+        self.assertTrue(all(sample[6] == self.user.pk and sample[7] for sample in saved[0]))
+        self.assertEqual(saved, bulk)
+        self.assertEqual(bulk[2], bulk[3])
+
+    def test_csv_bulk_matches_save(self):
+        text = "\n".join(["name,location.slug,project.slug,depth,color"] +
+                         ["Sample %d,location%d,fish,%d,red" % (n, n % 2 + 1, n) for n in range(7)])
+        saved = self.apply(False, text, "csv_import")
+        self.assertEqual(len(saved[0]), 7)
+        self.assertEqual(saved, self.apply(True, text, "csv_import"))
+
+
+
+
+IMPORT_MODELS = {"Project": Project, "Location": Location, "Sample": Sample, "SampleTag": SampleTag,
+                 "Parameter": Parameter, "Measurement": Measurement}
+
+
+class ForeignKeyResolverTest(TestCase):
+
+    def setUp(self):
+        create_base_data()
+
+    def test_lookups_are_prefetched(self):
+        text = "\n".join(["name,location.name,project.slug"] +
+                         ["s%d,location%d,fish" % (n, n % 2 + 1) for n in range(50)])
+        # one query per model and field, however many rows
+        with self.assertNumQueries(2):
+            objects = list(data_import.csv_import(text, models=IMPORT_MODELS))
+        self.assertEqual(len(objects), 50)
+        self.assertEqual([obj.location.name for obj in objects[:2]], ["location1", "location2"])
+        self.assertTrue(all(obj.project.slug == "fish" for obj in objects))
+
+    def test_lookup_errors(self):
+        with self.assertRaises(Location.DoesNotExist):
+            list(data_import.csv_import("name,location.name\nx,Nowhere", models=IMPORT_MODELS))
+
+        Location.objects.create(name="location3", description="same")
+        Location.objects.create(name="location4", description="same")
+        with self.assertRaises(Location.MultipleObjectsReturned):
+            list(data_import.csv_import("name,location.description\nx,same", models=IMPORT_MODELS))
+
+
+class FieldCacheTest(TestCase):
+
+    def test_fields_are_built_once(self):
+        data_view_funcs.clear_field_cache()
+        text = "\n".join(["name,location.name,depth"] + ["s%d,location1,%d" % (n, n) for n in range(50)])
+        create_base_data()
+        with mock.patch.object(data_view_funcs, "fields_for_model",
+                               wraps=data_view_funcs.fields_for_model) as fields_for_model:
+            objects = list(data_import.csv_import(text, models=IMPORT_MODELS))
+            fields = data_view_funcs.list_fields(Sample)
+            self.assertEqual(fields_for_model.call_count, 1)
+        self.assertEqual(len(objects), 100)
+        self.assertIn("collected", fields)
+
+        # callers get a copy of the mapping
+        del fields["collected"]
+        self.assertIn("collected", data_view_funcs.list_fields(Sample))
+
+        data_view_funcs.clear_field_cache()
+        with mock.patch.object(data_view_funcs, "fields_for_model",
+                               wraps=data_view_funcs.fields_for_model) as fields_for_model:
+            data_view_funcs.list_fields(Sample)
+            self.assertEqual(fields_for_model.call_count, 1)
+
+
+class DataImportJobTest(TestCase):
+
+    def setUp(self):
+        create_base_data()
+        self.user = User.objects.create(username="importer")
+        self.text = "\n".join(["name,location.slug,depth"] + ["s%d,location1,%d" % (n, n) for n in range(10)])
+
+    def create_import(self, text=None):
+        data_import = DataImport(text=text or self.text, user=self.user)
+        data_import.save()
+        return data_import
+
+    def test_claim_and_run(self):
+        data_import = self.create_import()
+        job = data_import.queue_job(DataImportJob.APPLY, user=self.user)
+        self.assertEqual(data_import.queue_job(DataImportJob.APPLY, user=self.user), job)
+
+        claimed = DataImportJob.claim_next("worker")
+        self.assertEqual((claimed.pk, claimed.status, claimed.worker), (job.pk, DataImportJob.RUNNING, "worker"))
+        self.assertIsNone(DataImportJob.claim_next("other worker"))
+        claimed.run()
+
+        job = DataImportJob.objects.get(pk=job.pk)
+        self.assertEqual((job.status, job.objects_processed, job.message),
+                         (DataImportJob.DONE, 20, "Imported 20 objects"))
+        self.assertTrue(DataImport.objects.get(pk=data_import.pk).applied)
+        self.assertEqual(Sample.objects.filter(data_import=data_import).count(), 10)
+
+    def test_failed_job(self):
+        data_import = self.create_import("name,location.slug\ns1,nowhere")
+        data_import.queue_job(DataImportJob.APPLY)
+        job = DataImportJob.claim_next("worker")
+        job.run()
+        job = DataImportJob.objects.get(pk=job.pk)
+        self.assertEqual(job.status, DataImportJob.FAILED)
+        self.assertIn("DoesNotExist", job.message)
+        data_import = DataImport.objects.get(pk=data_import.pk)
+        self.assertEqual((data_import.applied, data_import.apply_status), (False, DataImport.FAILED))
+
+    def test_one_running_job_per_import(self):
+        data_import = self.create_import()
+        data_import.queue_job(DataImportJob.PREVIEW)
+        data_import.queue_job(DataImportJob.APPLY)
+        other_job = self.create_import().queue_job(DataImportJob.APPLY)
+
+        DataImportJob.claim_next("worker 1")
+        # the apply job waits until the preview of the same import is done
+        self.assertEqual(DataImportJob.claim_next("worker 2"), other_job)
+        self.assertIsNone(DataImportJob.claim_next("worker 3"))
+
+    @override_settings(USE_TZ=True)
+    def test_stale_jobs(self):
+        data_import = self.create_import()
+        with warnings.catch_warnings():
+            warnings.simplefilter("error", RuntimeWarning)
+            job = data_import.queue_job(DataImportJob.APPLY)
+            DataImportJob.claim_next("worker")
+            self.assertEqual(DataImportJob.fail_stale_jobs(), 0)
+
+            DataImportJob.objects.filter(pk=job.pk).update(
+                heartbeat=timezone.now() - datetime.timedelta(seconds=DataImportJob.stale_after() + 60))
+            # queueing the import again fails the stale job
+            new_job = data_import.queue_job(DataImportJob.APPLY)
+        self.assertNotEqual(new_job, job)
+        self.assertEqual(DataImportJob.objects.get(pk=job.pk).status, DataImportJob.FAILED)
+        self.assertEqual(DataImportJob.claim_next("worker"), new_job)
+
+    def test_chunks_are_not_committed_twice(self):
+        data_import = self.create_import()
+
+        def progress(n_saved):
+            # another process (e.g., a job started after this one was failed as stale) applies the rest
+            if n_saved == 4:
+                DataImport.objects.get(pk=data_import.pk).save_import(commit_every=4)
+
+        with self.assertRaises(ValidationError):
+            data_import.save_import(commit_every=4, progress=progress)
+        self.assertEqual(Sample.objects.filter(data_import=data_import).count(), 10)
+        data_import = DataImport.objects.get(pk=data_import.pk)
+        self.assertEqual((data_import.applied, data_import.apply_status), (True, DataImport.APPLIED))
+
+    def test_worker_survives_errors(self):
+        job = self.create_import().queue_job(DataImportJob.APPLY)
+        claim_next = DataImportJob.claim_next
+        claims = [DatabaseError("connection lost"), lambda name: claim_next(name), None]
+
+        def next_claim(name):
+            claim = claims.pop(0)
+            if isinstance(claim, Exception):
+                raise claim
+            return claim(name) if callable(claim) else claim
+
+        with mock.patch.object(DataImportJob, "claim_next", side_effect=next_claim), \
+                mock.patch.object(pylims_worker.time, "sleep", side_effect=[None, KeyboardInterrupt]), \
+                mock.patch.object(pylims_worker.db, "close_old_connections") as close_old_connections, \
+                self.assertLogs(pylims_worker.logger.name, "ERROR"):
+            with self.assertRaises(KeyboardInterrupt):
+                pylims_worker.run_worker("worker")
+        self.assertEqual(close_old_connections.call_count, 3)
+        self.assertEqual(DataImportJob.objects.get(pk=job.pk).status, DataImportJob.DONE)
+
+
+class PreviewCacheTest(TestCase):
+
+    def setUp(self):
+        create_base_data()
+        preview_cache().clear()
+        self.user = User.objects.create(username="importer")
+        self.text = "\n".join(["name,location.slug,depth"] + ["s%d,location1,%d" % (n, n) for n in range(10)])
+
+    def test_previews_are_cached(self):
+        obj = DataImport(text=self.text, user=self.user)
+        obj.save()
+        with mock.patch.object(data_import, "resolve_function", wraps=data_import.resolve_function) as resolve:
+            result, truncated = obj.preview(5)
+            self.assertEqual(resolve.call_count, 1)
+            self.assertEqual((len(result), truncated), (10, True))
+
+            # cache hits skip the importer, for the same or a reloaded import
+            for obj in (obj, DataImport.objects.get(pk=obj.pk)):
+                cached, truncated = obj.preview(5)
+                self.assertEqual(resolve.call_count, 1)
+                self.assertEqual([item.name for item in cached if isinstance(item, Sample)],
+                                 [item.name for item in result if isinstance(item, Sample)])
+                self.assertTrue(all(item.data_import is obj and getattr(item, "user", self.user) == self.user
+                                    for item in cached))
+
+            obj.full_clean()
+            obj.full_clean()
+            self.assertEqual(resolve.call_count, 2)
+
+            # changing the text, driver or args invalidates the cached previews
+            old_hash = obj.content_hash
+            obj.args = '{"chunk_size": 2}'
+            obj.save()
+            self.assertIsNone(preview_cache().get(obj._cache_key("preview:5", old_hash)))
+            obj.preview(5)
+            self.assertEqual(resolve.call_count, 3)
+
+
+class ParallelImportTest(TestCase):
+
+    def setUp(self):
+        create_base_data()
+
+    def describe(self, objects):
+        return [(type(obj).__name__, getattr(obj, "name", None), getattr(obj, "slug", None),
+                 getattr(obj, "location_id", None),
+                 getattr(obj, "collected", None), getattr(obj, "key", None), getattr(obj, "value", None),
+                 obj.parent.name if isinstance(obj, SampleTag) else None) for obj in objects]
+
+    def test_same_objects(self):
+        text = "\n".join(["name,location.slug,collected,depth"] +
+                         ["s%d,location%d,2017-01-%02d 10:00,%d" % (n, n % 2 + 1, n % 28 + 1, n) for n in range(50)])
+        serial = DataImport(text=text, args='{"chunk_size": 7}').run_import()
+        parallel = DataImport(text=text, args='{"chunk_size": 7, "processes": 2}').run_import()
+        self.assertEqual(len(parallel), 100)
+        self.assertEqual(self.describe(parallel), self.describe(serial))
+
+    def test_row_numbers(self):
+        rows = ["s%d,location1,2017-01-01 10:00" % n for n in range(20)]
+        rows[3] = "s3,location1,not a date"
+        rows[12] = "s12,location1,also not a date"
+        text = "\n".join(["name,location.slug,collected"] + rows)
+        with self.assertRaisesRegex(ValueError, r"^Row 5: ValidationError.*; Row 14: ValidationError"):
+            list(data_import.csv_import(text, models=IMPORT_MODELS, chunk_size=50, processes=2))
+
+        rows = ["s%d,location1" % n for n in range(20)]
+        rows[15] = "s15,nowhere"
+        text = "\n".join(["name,location.slug"] + rows)
+        with self.assertRaisesRegex(ValueError, r"^Row 17: DoesNotExist"):
+            list(data_import.csv_import(text, models=IMPORT_MODELS, chunk_size=6, processes=2))
+
+
+class WideImportTest(TestCase):
+
+    def setUp(self):
+        create_base_data()
+        self.params = [Parameter.objects.create(name="param %d" % n, slug="p%d" % n) for n in range(10)]
+
+    def wide_csv(self, n_rows, start=0):
+        return "\n".join(["name,location.slug,depth," + ",".join(param.slug for param in self.params)] +
+                         ["w%d,location1,%d,%s" % (n, n, ",".join(str(n * 10 + m) for m in range(10)))
+                          for n in range(start, start + n_rows)])
+
+    def test_measurements(self):
+        obj = DataImport(text=self.wide_csv(3), driver="wide_csv_import")
+        obj.save()
+        obj.apply_import(save=True)
+        sample = Sample.objects.get(name="w2")
+        self.assertEqual(dict(sample.sampletag_set.values_list("key", "value")), {"depth": "2"})
+        self.assertEqual(dict(sample.measurement_set.values_list("param__slug", "numeric_value")),
+                         {"p%d" % m: 20.0 + m for m in range(10)})
+
+        with self.assertRaisesRegex(ValueError, "Parameter column"):
+            list(data_import.wide_csv_import(self.wide_csv(1), models=IMPORT_MODELS, param_columns=["ph"]))
+
+    def test_query_count(self):
+        # the number of queries does not grow with the number of cells
+        counts = []
+        for n_rows, start in ((20, 0), (80, 100)):
+            obj = DataImport(text=self.wide_csv(n_rows, start), driver="wide_csv_import")
+            obj.save()
+            with QueryCounter() as queries:
+                obj.apply_import(save=True)
+            counts.append(queries.count)
+            self.assertEqual(Measurement.objects.filter(data_import=obj).count(), n_rows * 10)
+        self.assertLess(counts[1], 60)
+        self.assertLessEqual(counts[1] - counts[0], 5)
+
+
+class BenchmarkTest(TestCase):
+
+    def test_benchmark(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "benchmark.json")
+            call_command("pylims_benchmark", rows=30, tag_columns=2, fk_columns=2, measurement_columns=3,
+                         output=path)
+            with open(path) as f:
+                result = json.load(f)
+
+        self.assertEqual(result["config"]["driver"], "wide_csv_import")
+        self.assertEqual(set(result["results"]), {"wide_csv_import", "run_import", "preview", "apply_import"})
+        for stage in result["results"].values():
+            self.assertGreater(stage["queries"], 0)
+            self.assertGreater(stage["peak_memory_bytes"], 0)
+        # everything is rolled back
+        self.assertFalse(DataImport.objects.exists())
+        self.assertFalse(Sample.objects.exists())
+
+        result = run_benchmark(rows=30, keep=True)
+        self.assertEqual(Sample.objects.count(), 30)
+        self.assertEqual(SampleTag.objects.count(), 150)
+        self.assertTrue(DataImport.objects.get().applied)
+
+
+class CheckpointTest(TestCase):
+
+    def setUp(self):
+        create_base_data()
+
+    def test_resume(self):
+        rows = ["r%d,location1,2017-01-01 10:%02d" % (n, n) for n in range(10)]
+        rows[6] = "r6,location1,not a date"
+        obj = DataImport(text="\n".join(["name,location.slug,collected"] + rows))
+        obj.save()
+        with self.assertRaises(ValidationError):
+            obj.save_import(commit_every=4)
+
+        # the first chunk was committed
+        obj = DataImport.objects.get(pk=obj.pk)
+        self.assertEqual((obj.checkpoint, obj.applied, obj.apply_status), (4, False, DataImport.FAILED))
+        self.assertIn("collected", obj.apply_error)
+        self.assertEqual(Sample.objects.filter(data_import=obj).count(), 4)
+
+        applied = []
+
+        def progress(n_saved):
+            applied.append(DataImport.objects.get(pk=obj.pk).applied)
+
+        rows[6] = "r6,location1,2017-01-01 10:06"
+        obj.text = "\n".join(["name,location.slug,collected"] + rows)
+        obj.save()
+        self.assertEqual(obj.save_import(commit_every=4, progress=progress), 6)
+        self.assertEqual(applied, [False, False])
+
+        obj = DataImport.objects.get(pk=obj.pk)
+        self.assertEqual((obj.checkpoint, obj.applied, obj.apply_status), (10, True, DataImport.APPLIED))
+        self.assertEqual(sorted(Sample.objects.filter(data_import=obj).values_list("name", flat=True)),
+                         sorted("r%d" % n for n in range(10)))
+
+        # the changeset covers both runs
+        obj.revert_import()
+        self.assertFalse(Sample.objects.filter(name__startswith="r").exists())
+
+
+class UpsertTest(TestCase):
+
+    def setUp(self):
+        create_base_data()
+
+    def apply(self, text):
+        obj = DataImport(text=text, driver="wide_csv_import", args='{"match_on": ["name", "collected"]}')
+        obj.save()
+        return obj.save_import()
+
+    def test_reimport(self):
+        for use_tz in (False, True):
+            with override_settings(USE_TZ=use_tz), warnings.catch_warnings():
+                warnings.simplefilter("ignore", RuntimeWarning)
+                rows = ["u%d,location1,2017-01-01 10:00:00.%06d,%d,%d" % (n, n, n, n) for n in range(3)]
+                header = "name,location.slug,collected,depth,ph"
+                self.assertEqual(self.apply("\n".join([header] + rows)), 9)
+                pks = set(Sample.objects.filter(name__startswith="u").values_list("pk", flat=True))
+
+                # unchanged rows are skipped, and changed rows update the existing objects
+                self.assertEqual(self.apply("\n".join([header] + rows)), 0)
+                rows[1] = "u1,location1,2017-01-01 10:00:00.000001,1,7.5"
+                self.assertEqual(self.apply("\n".join([header] + rows)), 1)
+                self.assertEqual(set(Sample.objects.filter(name__startswith="u").values_list("pk", flat=True)), pks)
+                self.assertEqual(Measurement.objects.get(sample__name="u1", param__slug="ph").numeric_value, 7.5)
+                Sample.objects.filter(pk__in=pks).delete()
+
+
+class RevertImportTest(TestCase):
+
+    def setUp(self):
+        create_base_data()
+        self.user = User.objects.create(username="importer")
+
+    def snapshot(self):
+        return (
+            sorted(Sample.objects.values_list("pk", "name", "slug", "collected", "project_id", "location_id",
+                                              "user_id", "data_import_id")),
+            sorted(SampleTag.objects.values_list("pk", "parent_id", "key", "value")),
+            sorted(Measurement.objects.values_list("pk", "sample_id", "param_id", "value", "numeric_value",
+                                                   "non_numeric", "data_import_id")),
+            summary_rows(),
+            closure_rows(Sample)
+        )
+
+    def test_revert(self):
+        text = "\n".join([
+            "name,location.slug,depth,ph,alk",
+            "Sample 0,location2,1,<DL,2",
+            "Sample 6,location2,2,,3",
+            "New sample,location1,3,7.5,4",
+        ])
+        for bulk in (False, True):
+            before = self.snapshot()
+            data_import = DataImport(text=text, driver="wide_csv_import", args='{"match_on": ["name"]}',
+                                     user=self.user)
+            data_import.save()
+            data_import.apply_import(save=True, bulk=bulk)
+            self.assertEqual(Sample.objects.get(name="Sample 0").location.slug, "location2")
+            self.assertEqual(summary_rows(), rebuilt_summary_rows())
+
+            data_import = DataImport.objects.get(pk=data_import.pk)
+            data_import.revert_import()
+            self.assertEqual(self.snapshot(), before)
+            self.assertFalse(DataImport.objects.get(pk=data_import.pk).applied)
+            with self.assertRaises(ValidationError):
+                data_import.revert_import()
+
+
+class ParentUpdateTest(TestCase):
+
+    def setUp(self):
+        create_base_data()
+
+    def test_coalesced(self):
+        samples = list(Sample.objects.all()[:3])
+        old = datetime.datetime(2000, 1, 1)
+        Sample.objects.filter(pk__in=[sample.pk for sample in samples]).update(modified=old)
+
+        with CaptureQueriesContext(connection) as queries:
+            with coalesce_parent_updates():
+                for sample in samples:
+                    for n in range(4):
+                        SampleTag(parent_id=sample.pk, key="coalesced%d" % n, value="1").save()
+                # not updated until the end of the block
+                self.assertEqual(Sample.objects.get(pk=samples[0].pk).modified, old)
+        updates = [query for query in queries.captured_queries if query["sql"].startswith("UPDATE")]
+        self.assertEqual(len(updates), 1)
+        self.assertTrue(all(sample.modified > old for sample in Sample.objects.filter(pk__in=[s.pk for s in samples])))
+
+        # outside a block, each tag updates its parent
+        Sample.objects.filter(pk=samples[0].pk).update(modified=old)
+        SampleTag(parent=samples[0], key="single", value="1").save()
+        self.assertGreater(Sample.objects.get(pk=samples[0].pk).modified, old)
+        self.assertGreater(samples[0].modified, old)
+
+
+class SampleTableTest(TestCase):
+
+    def setUp(self):
+        create_base_data()
+        self.user = User.objects.create(username="viewer")
+        self.client.force_login(self.user)
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_query_count(self):
+        urls = [reverse("pylims:sample_list"),
+                reverse("pylims:project_detail", kwargs={"pk": Project.objects.get().pk}),
+                reverse("pylims:location_detail", kwargs={"pk": Location.objects.get(slug="location1").pk})]
+        counts = [self.count_queries(url) for url in urls]
+
+        # tags, users and more samples don't add queries
+        for sample in Sample.objects.all():
+            SampleTag(parent=sample, key="site", value="a").save()
+            Sample(name=sample.name + " replicate", project=sample.project, location=sample.location,
+                   user=self.user).save()
+        self.assertEqual([self.count_queries(url) for url in urls], counts)
+
+
+class CursorPagingTest(TestCase):
+
+    def setUp(self):
+        projects = [Project.objects.create(name="project%d" % n) for n in range(3)]
+        for n in range(25):
+            # repeated and NULL keys
+            Sample(name="Sample %d" % n, project=projects[n % 3] if n % 4 else None,
+                   collected=datetime.datetime(2017, 1, 1 + n % 5) if n % 3 else None).save()
+
+    def expected(self, order_by):
+        # NULLs sort first in ascending order, and ties are ordered by ID in the direction of the last key
+        samples = sorted(Sample.objects.all(), key=lambda sample: sample.pk,
+                         reverse=order_by[-1].startswith("-"))
+        for key in reversed(order_by):
+            field = key.lstrip("-")
+            samples.sort(key=lambda sample: (getattr(sample, field) is not None, getattr(sample, field)),
+                         reverse=key.startswith("-"))
+        return [sample.pk for sample in samples]
+
+    def walk(self, order_by):
+        query = "n_samples=4&" + "&".join("order_by=%s" % key for key in order_by)
+        pages = []
+        while query is not None:
+            context = filter_sample_table(Sample.objects.all(), QueryDict(query))
+            pages.append(([sample.pk for sample in context["sample_list"]], context["prev_query"]))
+            query = context["next_query"]
+        return pages
+
+    def test_pages(self):
+        for order_by in (["project_id"], ["-project_id"], ["collected", "-project_id"], ["-collected"]):
+            pages = self.walk(order_by)
+            self.assertEqual([pk for page, prev_query in pages for pk in page], self.expected(order_by))
+            # going back returns the same pages
+            for previous, (page, prev_query) in zip(pages, pages[1:]):
+                context = filter_sample_table(Sample.objects.all(), QueryDict(prev_query))
+                self.assertEqual([sample.pk for sample in context["sample_list"]], previous[0])
+
+
+class SampleFilterTest(TestCase):
+
+    def setUp(self):
+        create_base_data()
+        self.samples = list(Sample.objects.order_by("pk"))
+        alk = Parameter.objects.get(slug="alk")
+        # several matching tags and measurements for one sample
+        for sample in self.samples[:3]:
+            SampleTag(parent=sample, key="site", value="a").save()
+        SampleTag(parent=self.samples[0], key="site2", value="a").save()
+        Measurement(sample=self.samples[0], param=alk, value="0.5").save()
+
+    def filtered(self, query):
+        return list(filter_samples(Sample.objects.order_by("pk"), QueryDict(query)))
+
+    def test_exists(self):
+        self.assertEqual(self.filtered("param_slug=alk&param_slug=ph"), self.samples)
+        self.assertEqual(self.filtered("param_id=%d" % Parameter.objects.get(slug="alk").pk), self.samples)
+        self.assertEqual(self.filtered("tag_site=a&tag_site=b"), self.samples[:3])
+        self.assertEqual(self.filtered("tag_site=__exists__&param_slug=alk"), self.samples[:3])
+        self.assertEqual(self.filtered("tag_site2="), self.samples[1:])
+        self.assertEqual(self.filtered("tag_site=b"), [])
+
+    def test_value_ranges(self):
+        ph = Measurement.objects.filter(param__slug="ph").order_by("numeric_value")
+        values = list(ph.values_list("numeric_value", flat=True))
+        middle = [m.sample for m in ph[3:7]]
+        self.assertEqual(self.filtered("value_min_ph=%r&value_max_ph=%r" % (values[3], values[6])),
+                         sorted(middle, key=lambda sample: sample.pk))
+        self.assertEqual(self.filtered("value_min_ph=%r" % values[9]), [ph[9].sample])
+        # the minimum and maximum apply to the same measurement
+        self.assertEqual(self.filtered("value_min_alk=0.5&value_max_alk=0.5"), self.samples[:1])
+
+        # bounds that aren't numbers are ignored
+        self.assertEqual(self.filtered("value_min_ph=abc&value_max_ph=nan"), self.samples)
+        self.client.force_login(User.objects.create(username="viewer"))
+        response = self.client.get(reverse("pylims:sample_list") + "?value_min_ph=abc")
+        self.assertEqual(response.status_code, 200)
+
+
+class SampleCountCacheTest(TestCase):
+
+    def setUp(self):
+        create_base_data()
+        sample_count_cache().clear()
+
+    def count(self, query="tag_site=__exists__"):
+        q = QueryDict(query)
+        return count_samples(filter_samples(Sample.objects.all(), q), count_key(Sample.objects.all(), q))[0]
+
+    def test_invalidation(self):
+        self.assertEqual(self.count(), 0)
+        # cached
+        with self.assertNumQueries(0):
+            self.assertEqual(self.count(), 0)
+
+        tag = SampleTag(parent=Sample.objects.first(), key="site", value="a")
+        tag.save()
+        self.assertEqual(self.count(), 1)
+        tag.delete()
+        self.assertEqual(self.count(), 0)
+
+        self.assertEqual(self.count("param_slug=ph"), 10)
+        Measurement.objects.filter(param__slug="ph").first().delete()
+        self.assertEqual(self.count("param_slug=ph"), 9)
+
+        # bulk imports skip the signals
+        data_import = DataImport(text=WIDE_CSV, driver="wide_csv_import")
+        data_import.save()
+        data_import.save_import(bulk=True)
+        self.assertEqual(self.count(""), Sample.objects.count())
+
+
+class ExportTest(TestCase):
+
+    def setUp(self):
+        create_base_data()
+        self.client.force_login(User.objects.create(username="exporter"))
+        self.sample = Sample.objects.get(name="Sample 0")
+        SampleTag(parent=self.sample, key="site", value="a").save()
+        Measurement(sample=self.sample, param=Parameter.objects.get(slug="ph"), value="<DL").save()
+
+    def export(self, query):
+        response = self.client.get(reverse("pylims:sample_export") + "?" + query)
+        self.assertEqual(response.status_code, 200)
+        return b"".join(response.streaming_content).decode("utf-8")
+
+    def test_csv(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(export.export_columns(Sample.objects.all()), (["site"], ["alk", "ph"]))
+
+        rows = list(csv.reader(self.export("location_slug=location1").splitlines()))
+        self.assertEqual(rows[0], list(export.SAMPLE_COLUMNS) + ["site", "alk", "ph"])
+        self.assertEqual(len(rows), 6)
+        row = dict(zip(rows[0], rows[1]))
+        self.assertEqual((row["name"], row["location.slug"], row["site"]), ("Sample 0", "location1", "a"))
+        self.assertEqual(len(row["ph"].split("; ")), 2)
+
+        # the columns can be given
+        rows = list(csv.reader(self.export("export_tag=site&export_param=ph&export_param=other").splitlines()))
+        self.assertEqual(rows[0][-3:], ["site", "ph", "other"])
+        self.assertEqual(len(rows), 11)
+
+    def test_ndjson(self):
+        lines = [json.loads(line) for line in self.export("format=ndjson&order_by=-pk").splitlines()]
+        self.assertEqual([line["id"] for line in lines],
+                         list(Sample.objects.order_by("-pk").values_list("pk", flat=True)))
+        line = lines[-1]
+        self.assertEqual(line["tags"], {"site": "a"})
+        self.assertEqual(sorted(measurement["param"] for measurement in line["measurements"]), ["alk", "ph", "ph"])
+
+        response = self.client.get(reverse("pylims:sample_export") + "?format=xml")
+        self.assertEqual(response.status_code, 400)
+
+
+class DataViewTest(TestCase):
+
+    def setUp(self):
+        create_base_data()
+        for sample in Sample.objects.all():
+            SampleTag(parent=sample, key="site", value=sample.name[-1]).save()
+        self.sample = Sample.objects.get(name="Sample 0")
+        Measurement.objects.filter(sample=self.sample, param__slug="ph").update(tags='{"lab": "A"}')
+        Measurement.objects.filter(sample__name="Sample 1", param__slug="alk").delete()
+
+    def test_data_iter(self):
+        view = data_view.SampleDataView(["::name", "::location", "::site", "::missing", "ph::value", "ph::lab",
+                                         "alk::value"])
+        # one query for the samples, and one per chunk for their tags and their measurements
+        with self.assertNumQueries(7):
+            rows = list(view.data_iter(Sample.objects.order_by("pk"), chunk_size=4))
+        self.assertEqual(len(rows), 10)
+
+        ph = Measurement.objects.get(sample=self.sample, param__slug="ph")
+        self.assertEqual(rows[0], OrderedDict([
+            ("::name", "Sample 0"), ("::location", self.sample.location_id), ("::site", "0"), ("::missing", None),
+            ("ph::value", ph.value), ("ph::lab", "A"),
+            ("alk::value", Measurement.objects.get(sample=self.sample, param__slug="alk").value)
+        ]))
+        self.assertIsNone(rows[1]["alk::value"])
+        self.assertIsNone(rows[1]["ph::lab"])
+
+        with self.assertRaises(ValueError):
+            data_view.SampleDataView(["nothing::value"])
+
+
+class MeasurementSummaryTest(TestCase):
+
+    def setUp(self):
+        create_base_data()
+
+    def test_update_and_delete(self):
+        self.assertEqual(summary_rows(), rebuilt_summary_rows())
+        ph = Parameter.objects.get(slug="ph")
+        location1 = Location.objects.get(slug="location1")
+        location2 = Location.objects.get(slug="location2")
+
+        # a new minimum, a non-numeric value and a removed maximum
+        measurements = list(Measurement.objects.filter(param=ph, sample__location=location1).order_by("numeric_value"))
+        measurements[0].value = "-1"
+        measurements[0].save()
+        measurements[1].value = "<DL"
+        measurements[1].save()
+        measurements[-1].delete()
+        self.assertEqual(summary_rows(), rebuilt_summary_rows())
+
+        summary = MeasurementSummary.objects.get(param=ph, location=location1)
+        self.assertEqual((summary.count, summary.numeric_count, summary.non_numeric_count, summary.min),
+                         (4, 3, 1, -1.0))
+        self.assertEqual(summary.max, max(m.numeric_value for m in measurements[2:-1]))
+
+        # moving and deleting samples
+        sample = Sample.objects.filter(location=location1).first()
+        sample.location = location2
+        sample.save()
+        self.assertEqual(summary_rows(), rebuilt_summary_rows())
+        Sample.objects.filter(location=location2).first().delete()
+        self.assertEqual(summary_rows(), rebuilt_summary_rows())
+
+
+class SummaryMigrationTest(TransactionTestCase):
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def test_migration(self):
+        leaf_nodes = MigrationExecutor(connection).loader.graph.leaf_nodes()
+        try:
+            apps = self.migrate([("pylims", "0010_measurement_numeric_value")])
+            param = apps.get_model("pylims", "Parameter").objects.create(name="pH", slug="ph")
+            location = apps.get_model("pylims", "Location").objects.create(name="location1", slug="location1")
+            sample = apps.get_model("pylims", "Sample").objects.create(name="Sample 0", slug="sample-0",
+                                                                         location=location)
+            # measurements saved before 0010 have no numeric value
+            for value in ("1", "3", "<DL", ""):
+                apps.get_model("pylims", "Measurement").objects.create(sample=sample, param=param, value=value)
+
+            apps = self.migrate([("pylims", "0011_measurement_summary")])
+            summary = apps.get_model("pylims", "MeasurementSummary").objects.get()
+            self.assertEqual((summary.param_id, summary.project_id, summary.location_id), (param.pk, None, location.pk))
+            self.assertEqual((summary.count, summary.numeric_count, summary.non_numeric_count), (4, 2, 1))
+            self.assertEqual((summary.sum, summary.sum_squares, summary.min, summary.max), (4, 10, 1, 3))
+        finally:
+            self.migrate(leaf_nodes)
+
+
+class TimeSeriesTest(TestCase):
+
+    def setUp(self):
+        create_base_data()
+        self.param = Parameter.objects.get(slug="ph")
+        location = Location.objects.get(slug="location1")
+        start = datetime.datetime(2017, 1, 1)
+        values = np.random.permutation(150) / 10.0
+        # a peak in the middle of the series
+        values[75] = 1000
+        self.values = []
+        for n, value in enumerate(values):
+            sample = Sample(name="Series %d" % n, location=location,
+                            collected=start + datetime.timedelta(hours=n * 7 % 150))
+            sample.save()
+            Measurement(sample=sample, param=self.param, value=str(value)).save()
+            self.values.append((sample.collected, float(value)))
+        Measurement(sample=sample, param=self.param, value="<DL").save()
+
+    def test_downsampled(self):
+        series = time_series.parameter_series(self.param, QueryDict("location_slug=location1"), n_points=20)
+        self.assertEqual((series["n_measurements"], series["downsampled"]), (150, True))
+
+        # the lowest and highest value in each of 10 equal buckets
+        start = min(collected for collected, value in self.values)
+        width = (max(collected for collected, value in self.values) - start) / 10
+        buckets = {}
+        for collected, value in self.values:
+            buckets.setdefault(min(int((collected - start) / width), 9), []).append((value, collected))
+        expected = set()
+        for bucket in buckets.values():
+            expected.update([min(bucket)[::-1], max(bucket)[::-1]])
+        self.assertEqual(series["points"], sorted(expected))
+        self.assertIn(1000, [value for collected, value in series["points"]])
+
+        series = time_series.parameter_series(self.param, QueryDict("location_slug=location1"), n_points=150)
+        self.assertFalse(series["downsampled"])
+        self.assertEqual(series["points"], sorted(self.values))
+
+    def test_view(self):
+        self.client.force_login(User.objects.create(username="viewer"))
+        url = reverse("pylims:parameter_series", kwargs={"pk": self.param.pk})
+        response = self.client.get(url + "?points=20")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()["points"]), 20)
+        for query in ("?points=abc", "?points=0"):
+            self.assertEqual(self.client.get(url + query).status_code, 400)
+
+
+class ClosureTest(TestCase):
+
+    def test_move(self):
+        root = Location.objects.create(name="root")
+        child = Location.objects.create(name="child", parent=root)
+        grandchild = Location.objects.create(name="grandchild", parent=child)
+        other = Location.objects.create(name="other")
+
+        child.parent = other
+        child.save()
+        self.assertEqual(set(root.descendants()), {root})
+        self.assertEqual(set(other.descendants()), {other, child, grandchild})
+        self.assertEqual(list(grandchild.ancestors(include_self=False).order_by("pk")), [child, other])
+
+        rows = closure_rows(Location)
+        rebuild_closures(Location)
+        self.assertEqual(rows, closure_rows(Location))
+
+        # a location can't be moved into its own subtree
+        other = Location.objects.get(pk=other.pk)
+        other.parent = grandchild
+        with self.assertRaises(ValidationError):
+            other.full_clean()
+
+
+class ClosureMigrationTest(TransactionTestCase):
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def test_migration(self):
+        leaf_nodes = MigrationExecutor(connection).loader.graph.leaf_nodes()
+        try:
+            apps = self.migrate([("pylims", "0011_measurement_summary")])
+            Location = apps.get_model("pylims", "Location")
+            root = Location.objects.create(name="root", slug="root")
+            child = Location.objects.create(name="child", slug="child", parent=root)
+            grandchild = Location.objects.create(name="grandchild", slug="grandchild", parent=child)
+
+            apps = self.migrate([("pylims", "0012_hierarchy_closure")])
+            links = apps.get_model("pylims", "LocationClosure").objects.values_list("ancestor_id", "descendant_id",
+                                                                                   "depth")
+            self.assertEqual(set(links), {(root.pk, root.pk, 0), (child.pk, child.pk, 0),
+                                          (grandchild.pk, grandchild.pk, 0), (root.pk, child.pk, 1),
+                                          (child.pk, grandchild.pk, 1), (root.pk, grandchild.pk, 2)})
+        finally:
+            self.migrate(leaf_nodes)
+
+
+class SlugAllocatorTest(TestCase):
+
+    def test_replicates(self):
+        location = Location.objects.create(name="A very long location name")
+        collected = datetime.datetime(2017, 1, 1, 10)
+        existing = Sample(name="replicate", location=location, collected=collected)
+        existing.save()
+
+        allocator = SlugAllocator()
+        samples = [Sample(name="replicate", location=location, collected=collected) for n in range(5)]
+        slugs = [allocator.allocate(sample) for sample in samples]
+        self.assertNotIn(existing.slug, slugs)
+        self.assertEqual(len(set(slugs)), len(slugs))
+        self.assertEqual(slugs[-1], samples[-1].slug_candidates()[-1] + "_4")
+
+        # numbered slugs are truncated to fit and skip saved ones
+        Sample(name="x" * 80, slug="x" * 53 + "_2").save()
+        allocator = SlugAllocator()
+        long_samples = [Sample(name="x" * 80) for n in range(5)]
+        long_slugs = [allocator.allocate(sample) for sample in long_samples]
+        self.assertEqual(len(set(long_slugs)), len(long_slugs))
+        self.assertTrue(all(len(slug) <= 55 for slug in long_slugs))
+        self.assertNotIn("x" * 53 + "_2", long_slugs)
+
+
+
+    def test_single_sample(self):
+        collected = datetime.datetime(2017, 1, 1, 10)
+        for n in range(20):
+            Sample(name="sample %d" % n, collected=collected).save()
+
+        # one query for the candidates, not one for every slug with the same date
+        sample = Sample(name="replicate", collected=collected)
+        with self.assertNumQueries(1):
+            sample.set_slug()
+        self.assertEqual(sample.slug, sample.slug_candidates()[0])
+
+        for n in range(3):
+            Sample(name="replicate", collected=collected).save()
+        sample = Sample(name="replicate", collected=collected)
+        with self.assertNumQueries(2):
+            sample.set_slug()
+        self.assertEqual(sample.slug, sample.slug_candidates()[-1] + "_2")
+
+
+class CompressedTextTest(TestCase):
+
+    def test_round_trip(self):
+        text = "name,depth\n" + "\n".join("Sample %d,%d" % (n, n) for n in range(1000)) + "\nUnicode \u00e9,1\n"
+        data_import = DataImport(text=text)
+        data_import.save()
+
+        loaded = DataImport.objects.get(pk=data_import.pk)
+        stored = loaded.__dict__["text"]
+        self.assertIsInstance(stored, CompressedText)
+        self.assertLess(len(stored.compressed), len(text))
+        self.assertEqual("".join(stored.chunks(100)), text)
+
+        # saving without reading the text does not decompress it
+        loaded.description = "changed"
+        loaded.save()
+        self.assertIsNone(stored._text)
+        self.assertEqual(loaded.content_hash, data_import.content_hash)
+
+        # the hash of the compressed text is the hash of the text
+        del loaded._hashed
+        self.assertEqual(loaded.get_content_hash(), data_import.content_hash)
+        self.assertEqual(loaded.text, text)
+
+        deferred = DataImport.objects.defer("text").get(pk=data_import.pk)
+        deferred.save()
+        self.assertNotIn("text", deferred.__dict__)
+        self.assertEqual(deferred.text, text)
+
+
+class CompressTextMigrationTest(TransactionTestCase):
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def test_migration(self):
+        before = [("pylims", "0005_data_import_checkpoint")]
+        after = [("pylims", "0006_compress_data_import_text")]
+        leaf_nodes = MigrationExecutor(connection).loader.graph.leaf_nodes()
+        try:
+            apps = self.migrate(before)
+            pk = apps.get_model("pylims", "DataImport").objects.create(text="name\nSample \u00e9").pk
+
+            apps = self.migrate(after)
+            self.assertEqual(apps.get_model("pylims", "DataImport").objects.get(pk=pk).text, "name\nSample \u00e9")
+
+            apps = self.migrate(before)
+            self.assertEqual(apps.get_model("pylims", "DataImport").objects.get(pk=pk).text, "name\nSample \u00e9")
+        finally:
+            self.migrate(leaf_nodes)
+
+
+class StreamingImportTest(TestCase):
+
+    def setUp(self):
+        create_base_data()
+        self.user = User.objects.create(username="importer")
+        self.text = "\r\n".join(["name,location.slug,depth"] +
+                                 ["Sample \u00e9 %d,location1,%d" % (n, n) for n in range(300)]) + "\r\n"
+        self.text = self.text.replace("Sample \u00e9 7,", '"Sample\x0c\u00e9\n7",')
+
+    def test_text_lines(self):
+        lines = [line + "\n" for line in self.text.split("\n")[:-1]]
+        self.assertEqual(list(data_import.text_lines(self.text, chunk_size=7)), lines)
+        self.assertEqual(list(data_import.text_lines(SimpleUploadedFile("a.csv", self.text.encode("utf-8")),
+                                                     chunk_size=7)), lines)
+        # multi-byte characters and line endings split between chunks
+        encoded = self.text.encode("utf-8")
+        compressed = CompressedText.from_chunks(encoded[start:start + 5] for start in range(0, len(encoded), 5))
+        self.assertEqual(list(data_import.text_lines(compressed, chunk_size=7)), lines)
+
+    def test_upload(self):
+        self.client.force_login(self.user)
+        upload = SimpleUploadedFile("samples.csv", self.text.encode("utf-8"))
+        # the text is never decompressed all at once
+        with mock.patch.object(CompressedText, "text", new_callable=mock.PropertyMock,
+                               side_effect=AssertionError("decompressed")):
+            response = self.client.post(reverse("pylims:sample_import"), {"driver": "csv_import", "upload": upload})
+            self.assertEqual(response.status_code, 302)
+            obj = DataImport.objects.get()
+            self.assertEqual(obj.user, self.user)
+            self.assertEqual(obj.save_import(), 600)
+        self.assertEqual(obj.text, self.text)
+        self.assertEqual(Sample.objects.filter(data_import=obj).count(), 300)
+
+        response = self.client.post(reverse("pylims:sample_import"), {"driver": "csv_import", "text": ""})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(DataImport.objects.count(), 1)
+
+    def test_apply_import_returns_objects(self):
+        obj = DataImport(text=self.text, user=self.user)
+        obj.save()
+        result = obj.apply_import(save=True, chunk_size=100)
+        self.assertEqual(len(result), 600)
+        self.assertTrue(all(item.pk is not None for item in result))
+        self.assertTrue(DataImport.objects.get(pk=obj.pk).applied)
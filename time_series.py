@@ -0,0 +1,125 @@
+import datetime
+import itertools
+
+import numpy as np
+from django.db import models as db_models
+from django.conf import settings
+from django.utils import timezone
+
+from . import models
+from .query_string_filter import filter_samples
+
+EPOCH = datetime.datetime(1970, 1, 1)
+EPOCH_UTC = timezone.make_aware(EPOCH, timezone.utc)
+
+
+def to_seconds(value):
+    # seconds since the epoch (aware and naive datetimes are both supported)
+    return (value - (EPOCH_UTC if timezone.is_aware(value) else EPOCH)).total_seconds()
+
+
+def from_seconds(seconds, aware):
+    return (EPOCH_UTC if aware else EPOCH) + datetime.timedelta(seconds=seconds)
+
+
+class MinMaxBuckets(object):
+    """
+    Downsample a series by dividing the time range into equal buckets and keeping
+    the lowest and highest value in each bucket, so that peaks are preserved. Values
+    are added one chunk at a time (in any order), so the whole series is never in memory.
+    """
+
+    def __init__(self, start, end, n_buckets):
+        """
+        :param start: The first time (in seconds)
+        :param end: The last time (in seconds)
+        :param n_buckets: The number of buckets (the output has up to two points per bucket)
+        """
+        self.start = start
+        self.n_buckets = n_buckets
+        self.width = (end - start) / float(n_buckets) or 1.0
+        self.min_time = np.full(n_buckets, np.nan)
+        self.min_value = np.full(n_buckets, np.inf)
+        self.max_time = np.full(n_buckets, np.nan)
+        self.max_value = np.full(n_buckets, -np.inf)
+
+    def add(self, times, values):
+        """
+        Add a chunk of the series
+        :param times: A numpy array of times (in seconds)
+        :param values: A numpy array of values
+        """
+        if not len(values):
+            return
+        buckets = np.clip(((times - self.start) // self.width).astype(int), 0, self.n_buckets - 1)
+
+        # sorted by bucket then value, the first and last value of each bucket are its min and max
+        order = np.lexsort((values, buckets))
+        buckets, times, values = buckets[order], times[order], values[order]
+        changes = buckets[1:] != buckets[:-1]
+        first = np.concatenate(([True], changes))
+        last = np.concatenate((changes, [True]))
+
+        lower = values[first] < self.min_value[buckets[first]]
+        self.min_value[buckets[first][lower]] = values[first][lower]
+        self.min_time[buckets[first][lower]] = times[first][lower]
+
+        higher = values[last] > self.max_value[buckets[last]]
+        self.max_value[buckets[last][higher]] = values[last][higher]
+        self.max_time[buckets[last][higher]] = times[last][higher]
+
+    def points(self):
+        """
+        :return: The (times, values) of the downsampled series in time order
+        """
+        filled = np.isfinite(self.min_value)
+        # buckets with one distinct point only output it once
+        distinct = filled & ((self.min_time != self.max_time) | (self.min_value != self.max_value))
+        times = np.concatenate((self.min_time[filled], self.max_time[distinct]))
+        values = np.concatenate((self.min_value[filled], self.max_value[distinct]))
+        order = np.argsort(times, kind="mergesort")
+        return times[order], values[order]
+
+
+def parameter_series(param, q, n_points=500, chunk_size=5000):
+    """
+    The numeric values of param over Sample.collected for the samples matching the
+    filters of filter_sample_table(), downsampled to about n_points using MinMaxBuckets
+    if there are more measurements than that.
+    :param param: A Parameter
+    :param q: A QueryDict of query parameters
+    :param n_points: The maximum number of points
+    :param chunk_size: The number of measurements read from the database at a time
+    :return: A dict with the number of measurements, whether or not they were downsampled
+    and the (collected, value) points in time order
+    """
+    measurements = models.Measurement.objects.filter(
+        param=param, numeric_value__isnull=False, sample__collected__isnull=False,
+        sample__in=filter_samples(models.Sample.objects.all(), q).values("pk")
+    ).order_by()
+    extent = measurements.aggregate(n=db_models.Count("pk"), start=db_models.Min("sample__collected"),
+                                    end=db_models.Max("sample__collected"))
+    series = {"param": param.slug, "n_measurements": extent["n"], "downsampled": extent["n"] > n_points}
+
+    if not series["downsampled"]:
+        series["points"] = list(measurements.order_by("sample__collected", "pk")
+                                .values_list("sample__collected", "numeric_value"))
+        return series
+
+    buckets = MinMaxBuckets(to_seconds(extent["start"]), to_seconds(extent["end"]), max(n_points // 2, 1))
+    rows = measurements.values_list("sample__collected", "numeric_value").iterator()
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            break
+        buckets.add(np.array([to_seconds(collected) for collected, value in chunk]),
+                    np.array([value for collected, value in chunk]))
+
+    aware = timezone.is_aware(extent["start"])
+    times, values = buckets.points()
+    series["points"] = [(from_seconds(t, aware), v) for t, v in zip(times.tolist(), values.tolist())]
+    return series
+
+
+def max_series_points():
+    return getattr(settings, "PYLIMS_SERIES_MAX_POINTS", 5000)
@@ -8,17 +8,30 @@ urlpatterns = [
     url(r'^$', views.index, name="index"),
     url(r'^project/$', views.ProjectListView.as_view(), name="project_list"),
     url(r'^project/(?P<pk>[0-9]+)$', views.ProjectDetailView.as_view(), name="project_detail"),
+    url(r'^project/(?P<pk>[0-9]+)/export$', views.export_sample_table, {'table': 'project'}, name="project_export"),
     url(r'^location/$', views.LocationListView.as_view(), name="location_list"),
     url(r'^location/(?P<pk>[0-9]+)$', views.LocationDetailView.as_view(), name="location_detail"),
+    url(r'^location/(?P<pk>[0-9]+)/export$', views.export_sample_table, {'table': 'location'}, name="location_export"),
     url(r'^parameter/$', views.ParameterListView.as_view(), name="parameter_list"),
     url(r'^parameter/(?P<pk>[0-9]+)$', views.ParameterDetailView.as_view(), name="parameter_detail"),
+    url(r'^parameter/(?P<pk>[0-9]+)/export$', views.export_sample_table, {'table': 'parameter'},
+        name="parameter_export"),
+    url(r'^parameter/(?P<pk>[0-9]+)/series$', views.parameter_time_series, name="parameter_series"),
     url(r'^user/$', views.UserListView.as_view(), name="user_list"),
     url(r'^user/(?P<pk>[0-9]+)$', views.UserDetailView.as_view(), name="user_detail"),
+    url(r'^user/(?P<pk>[0-9]+)/export$', views.export_sample_table, {'table': 'user'}, name="user_export"),
     url(r'^sample/$', views.SampleListView.as_view(), name="sample_list"),
+    url(r'^sample/export$', views.export_sample_table, {'table': 'sample'}, name="sample_export"),
     url(r'^sample/add$', views.SampleCreateView.as_view(), name="sample_create"),
     url(r'^sample/import$', views.SampleImportView.as_view(), name="sample_import"),
     url(r'^data_import/$', views.DataImportListView.as_view(), name="data_import_list"),
     url(r'^data_import/(?P<pk>[0-9]+)$', views.DataImportDetailView.as_view(), name="data_import_detail"),
     url(r'^data_import/(?P<pk>[0-9]+)/apply$', views.apply_data_import, name="data_import_apply"),
+    url(r'^data_import/(?P<pk>[0-9]+)/validate$', views.validate_data_import, name="data_import_validate"),
+    url(r'^data_import/(?P<pk>[0-9]+)/revert$', views.revert_data_import, name="data_import_revert"),
+    url(r'^data_import/(?P<pk>[0-9]+)/status$', views.data_import_status, name="data_import_status"),
+    url(r'^data_import/(?P<pk>[0-9]+)/export$', views.export_sample_table, {'table': 'data_import'},
+        name="data_import_export"),
+    url(r'^summary/$', views.measurement_summary, name="measurement_summary"),
     url(r'^sample/(?P<pk>[0-9]+)$', views.SampleDetailView.as_view(), name="sample_detail"),
 ]
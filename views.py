@@ -1,19 +1,68 @@
 
 from django.shortcuts import render, get_object_or_404, redirect
+from django.http import JsonResponse, HttpResponseBadRequest
 from django.views import generic
+from django.views.decorators.http import require_POST
 from django.utils.http import urlencode
 from django import forms
 from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.urls import reverse_lazy
+from django.db.models import OuterRef
 
 from . import models
-from .query_string_filter import filter_sample_table
+from .query_string_filter import filter_sample_table, filter_exists
+from .export import sample_export_response
+from .time_series import parameter_series, max_series_points
 
 # Create your views here.
 
 
+def sample_table_queryset(table, obj=None):
+    """
+    The samples listed in the sample table of a view
+    :param table: One of the keys of SAMPLE_TABLE_MODELS
+    :param obj: The object shown by the view (None for 'sample')
+    """
+    if table == "sample":
+        return models.Sample.objects.all()
+    elif table == "parameter":
+        measurements = models.Measurement.objects.filter(sample=OuterRef("pk"), param=obj)
+        return filter_exists(models.Sample.objects.all(), measurements)
+    else:
+        return models.Sample.objects.filter(**{table: obj})
+
+
+# the model of the object shown by each view with a sample table
+SAMPLE_TABLE_MODELS = {
+    "sample": None,
+    "project": models.Project,
+    "location": models.Location,
+    "parameter": models.Parameter,
+    "user": User,
+    "data_import": models.DataImport
+}
+
+
+@login_required
+def export_sample_table(request, table, pk=None):
+    """
+    Stream the samples of a sample table as CSV or NDJSON (see export.sample_export_response())
+    """
+    if pk is None:
+        obj = None
+        filename = "samples"
+    else:
+        obj = get_object_or_404(SAMPLE_TABLE_MODELS[table], pk=pk)
+        filename = "%s-%s-samples" % (table, pk)
+    try:
+        return sample_export_response(sample_table_queryset(table, obj), request.GET, filename)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+
+
 @login_required
 def index(request):
     return render(request, 'pylims/index.html')
@@ -34,7 +83,9 @@ class ProjectDetailView(LoginRequiredMixin, generic.DetailView):
     def get_context_data(self, **kwargs):
         context = super(ProjectDetailView, self).get_context_data(**kwargs)
         context['sample_list_title'] = "Project Samples"
-        context['sample_list'] = models.Sample.objects.filter(project=context['project'])
+        context['sample_list'] = sample_table_queryset("project", context['project'])
+        context['summary_list'] = models.MeasurementSummary.table(project=context['project'])
+        context['sample_export_url'] = reverse_lazy("pylims:project_export", kwargs={'pk': context['project'].pk})
         # apply sample list filtering based on query string params
         sample_list_context = filter_sample_table(context['sample_list'], self.request.GET)
         context.update(sample_list_context)
@@ -56,7 +107,9 @@ class LocationDetailView(LoginRequiredMixin, generic.DetailView):
     def get_context_data(self, **kwargs):
         context = super(LocationDetailView, self).get_context_data(**kwargs)
         context['sample_list_title'] = "Samples from %s" % context['location'].name
-        context['sample_list'] = models.Sample.objects.filter(location=context['location'])
+        context['sample_list'] = sample_table_queryset("location", context['location'])
+        context['summary_list'] = models.MeasurementSummary.table(location=context['location'])
+        context['sample_export_url'] = reverse_lazy("pylims:location_export", kwargs={'pk': context['location'].pk})
         # apply sample list filtering based on query string params
         sample_list_context = filter_sample_table(context['sample_list'], self.request.GET)
         context.update(sample_list_context)
@@ -78,7 +131,9 @@ class ParameterDetailView(LoginRequiredMixin, generic.DetailView):
     def get_context_data(self, **kwargs):
         context = super(ParameterDetailView, self).get_context_data(**kwargs)
         context['sample_list_title'] = "Samples with %s" % context['parameter'].name
-        context['sample_list'] = models.Sample.objects.filter(measurement__param=context['parameter'])
+        context['sample_list'] = sample_table_queryset("parameter", context['parameter'])
+        context['summary_list'] = models.MeasurementSummary.table(param=context['parameter'])
+        context['sample_export_url'] = reverse_lazy("pylims:parameter_export", kwargs={'pk': context['parameter'].pk})
         # apply sample list filtering based on query string params
         sample_list_context = filter_sample_table(context['sample_list'], self.request.GET)
         context.update(sample_list_context)
@@ -99,7 +154,8 @@ class UserDetailView(LoginRequiredMixin, generic.DetailView):
     def get_context_data(self, **kwargs):
         context = super(UserDetailView, self).get_context_data(**kwargs)
         context['sample_list_title'] = "Samples created by %s" % context['user'].username
-        context['sample_list'] = models.Sample.objects.filter(user=context['user'])
+        context['sample_list'] = sample_table_queryset("user", context['user'])
+        context['sample_export_url'] = reverse_lazy("pylims:user_export", kwargs={'pk': context['user'].pk})
         # apply sample list filtering based on query string params
         sample_list_context = filter_sample_table(context['sample_list'], self.request.GET)
         context.update(sample_list_context)
@@ -111,10 +167,11 @@ class SampleListView(LoginRequiredMixin, generic.ListView):
     context_object_name = 'sample_list'
 
     def get_queryset(self):
-        return models.Sample.objects.all()
+        return sample_table_queryset("sample")
 
     def get_context_data(self, **kwargs):
         context = super(SampleListView, self).get_context_data(**kwargs)
+        context['sample_export_url'] = reverse_lazy("pylims:sample_export")
         # apply sample list filtering based on query string params
         sample_list_context = filter_sample_table(context['sample_list'], self.request.GET)
         context.update(sample_list_context)
@@ -139,9 +196,36 @@ class SampleCreateView(LoginRequiredMixin, generic.CreateView):
         return super(SampleCreateView, self).form_valid(form)
 
 
+class DataImportForm(forms.ModelForm):
+    # an uploaded file is compressed as it is read instead of being pasted as text
+    upload = forms.FileField(required=False)
+
+    class Meta:
+        model = models.DataImport
+        fields = ['driver', 'text']
+
+    def __init__(self, *args, **kwargs):
+        super(DataImportForm, self).__init__(*args, **kwargs)
+        self.fields['text'].required = False
+
+    def clean(self):
+        cleaned_data = super(DataImportForm, self).clean()
+        upload = cleaned_data.get('upload')
+        if upload:
+            try:
+                self.instance.text = models.CompressedText.from_chunks(upload.chunks())
+            except UnicodeDecodeError:
+                raise forms.ValidationError({'upload': "The file is not UTF-8 encoded text"})
+            # the text of the instance is not replaced by the (blank) text field
+            cleaned_data.pop('text', None)
+        elif not cleaned_data.get('text'):
+            raise forms.ValidationError({'text': "Enter the text to import or upload a file"})
+        return cleaned_data
+
+
 class SampleImportView(LoginRequiredMixin, generic.CreateView):
     model = models.DataImport
-    fields = ['driver', 'text']
+    form_class = DataImportForm
     template_name = "pylims/sample_import_form.html"
 
     def form_valid(self, form):
@@ -156,7 +240,8 @@ class DataImportListView(LoginRequiredMixin, generic.ListView):
     template_name = 'pylims/data_import_list.html'
 
     def get_queryset(self):
-        return models.DataImport.objects.all()
+        # the (compressed) text is only loaded when it is needed
+        return models.DataImport.objects.defer('text')
 
 
 class DataImportDetailView(LoginRequiredMixin, generic.DetailView):
@@ -169,7 +254,9 @@ class DataImportDetailView(LoginRequiredMixin, generic.DetailView):
         # different contexts for imported versus non-imported data imports
         if context['dataimport'].applied:
             # get matching samples
-            context['sample_list'] = models.Sample.objects.filter(data_import=context['dataimport'])
+            context['sample_list'] = sample_table_queryset("data_import", context['dataimport'])
+            context['sample_export_url'] = reverse_lazy("pylims:data_import_export",
+                                                        kwargs={'pk': context['dataimport'].pk})
             # apply sample list filtering based on query string params
             sample_list_context = filter_sample_table(context['sample_list'], self.request.GET)
             # set sample table title
@@ -179,11 +266,15 @@ class DataImportDetailView(LoginRequiredMixin, generic.DetailView):
             # get the preview context
             context.update(self.preview_context(context))
 
+        # the most recent background job for this import
+        context['job'] = context['dataimport'].latest_job()
         return context
 
     def preview_context(self, context):
-        # run import in preview mode
-        result = context['dataimport'].apply_import(save=False)
+        # run import in preview mode, stopping after the first n_samples samples
+        # so that large imports can be previewed within a request
+        n_samples = max(int(self.request.GET.get("n_samples", "100")), 1)
+        result, truncated = context['dataimport'].preview(n_samples)
 
         # classify result by object type and if it currently exists or not
         out_dict = {'objects': {}, 'tags': {}}
@@ -210,22 +301,85 @@ class DataImportDetailView(LoginRequiredMixin, generic.DetailView):
                 obj.import_tags = tags[str(obj)] if str(obj) in tags else []
 
         # return dict to be added to the context
-        return {'sample_list': out_dict['objects']['Sample'],
-                'sample_list_title': 'Samples'}
+        return {'sample_list': out_dict['objects'].get('Sample', []),
+                'sample_list_title': 'Samples',
+                'preview_truncated': truncated}
 
 
 @login_required
+@require_POST
 def apply_data_import(request, pk):
     # get object
-    obj = get_object_or_404(models.DataImport, pk=pk)
+    obj = get_object_or_404(models.DataImport.objects.defer('text'), pk=pk)
+    url = reverse_lazy("pylims:data_import_detail", kwargs={'pk': pk})
+
+    if obj.applied:
+        return redirect(url + "?" + urlencode({'apply_error': "This import has already been applied"}))
+
+    # the import is applied by a worker process (see the pylims_worker command)
+    job = obj.queue_job(models.DataImportJob.APPLY, user=request.user)
+    message = "Import queued (job %s)" % job.pk
+    return redirect(url + "?" + urlencode({'apply_success': message}))
+
+
+@login_required
+@require_POST
+def validate_data_import(request, pk):
+    obj = get_object_or_404(models.DataImport.objects.defer('text'), pk=pk)
     url = reverse_lazy("pylims:data_import_detail", kwargs={'pk': pk})
+    job = obj.queue_job(models.DataImportJob.PREVIEW, user=request.user)
+    return redirect(url + "?" + urlencode({'apply_success': "Validation queued (job %s)" % job.pk}))
+
 
+@login_required
+@require_POST
+def revert_data_import(request, pk):
+    obj = get_object_or_404(models.DataImport.objects.defer('text'), pk=pk)
+    url = reverse_lazy("pylims:data_import_detail", kwargs={'pk': pk})
     try:
-        # try to apply import
-        result = obj.apply_import(save=True)
-        message = "Imported %s objects" % len(result)
-        # on success, redirect to the import detail page
-        return redirect(url + "?" + urlencode({'apply_success': message}))
-    except Exception as e:
-        # on fail, redirect to the import detail page and indicate failure
-        return redirect(url + "?" + urlencode({'apply_error': str(e)}))
+        obj.revert_import()
+    except ValidationError as e:
+        return redirect(url + "?" + urlencode({'apply_error': "; ".join(e.messages)}))
+    return redirect(url + "?" + urlencode({'apply_success': "Import reverted"}))
+
+
+@login_required
+def data_import_status(request, pk):
+    obj = get_object_or_404(models.DataImport.objects.defer('text'), pk=pk)
+    job = obj.latest_job()
+    return JsonResponse({'applied': obj.applied, 'job': job.as_dict() if job else None})
+
+
+@login_required
+def parameter_time_series(request, pk):
+    """
+    The values of a parameter over time as JSON (see time_series.parameter_series()),
+    for samples matching the query parameters of the sample table. The points query
+    parameter is the maximum number of points.
+    """
+    param = get_object_or_404(models.Parameter, pk=pk)
+    try:
+        n_points = int(request.GET.get("points", 500))
+    except ValueError:
+        return HttpResponseBadRequest("points must be an integer")
+    if not 1 <= n_points <= max_series_points():
+        return HttpResponseBadRequest("points must be between 1 and %s" % max_series_points())
+    return JsonResponse(parameter_series(param, request.GET, n_points))
+
+
+@login_required
+def measurement_summary(request):
+    """
+    Measurement statistics for each parameter as JSON, read from MeasurementSummary.
+    The param, project and location query parameters (slugs) limit which summaries
+    are combined.
+    """
+    filters = {}
+    for key, lookup in (("param", "param__slug"), ("project", "project__slug"), ("location", "location__slug")):
+        if key in request.GET:
+            filters[lookup] = request.GET[key]
+    summaries = []
+    for stats in models.MeasurementSummary.table(**filters):
+        param = stats.pop("param")
+        summaries.append(dict(stats, param=param.slug, param_name=param.name))
+    return JsonResponse({'summaries': summaries})